@@ -1,25 +1,133 @@
-from typing import List
+from typing import List, Iterator, Tuple
 
+import numpy as np
+import shapely
 from shapely import Point, Geometry
 
-from common import Entry, get_nearest, geometry_to_box, intersection
+from common import Entry, get_nearest, geometry_to_box, intersection, BoundaryBox, refine, refine_mask, iter_refine, \
+    iter_refine_rows, iter_nearest_rows, SpatialIndex
+from entry_store import EntryStore
 
+# Сколько ближайших по MBR кандидатов проверяем точно, чтобы получить первую верхнюю границу
+NEAREST_SEED_SIZE = 32
 
-class BruteForce():
-    def __init__(self):
-        self.entries: List[Entry] = []
+
+class BruteForce(SpatialIndex):
+    def __init__(self, vectorized: bool = False):
+        self.vectorized = vectorized
+
+        # В векторизованном режиме записи - только строки EntryStore, объекты Entry собираются по запросу
+        self.entries: List[Entry] | None = None if vectorized else []
+        self.store = EntryStore() if vectorized else None
+
+    @staticmethod
+    def from_store(store: EntryStore):
+        # Индекс прямо над строками хранилища, без копирования
+        structure = BruteForce(True)
+        structure.store = store
+        return structure
 
     def insert(self, entry: Entry):
-        self.entries.append(entry)
+        if self.vectorized:
+            self.store.add(entry.shape, entry.id)
+        else:
+            self.entries.append(entry)
+
+    def insert_rows(self, store: EntryStore, rows=None):
+        if not self.vectorized:
+            for entry in store.entries(rows):
+                self.insert(entry)
+            return
+
+        rows = np.arange(len(store)) if rows is None else np.asarray(rows, dtype=np.int64)
+        self.store.extend(store.geometries(rows), store.ids[rows])
 
     def find_nearest_neighbor(self, point: Point):
+        if self.vectorized:
+            return self.find_nearest_neighbor_vectorized(point)
+
         nearest, distance = get_nearest(self.entries, point)
         return nearest
 
+    def entry(self, row: int) -> Entry:
+        return self.store.entry(row) if self.vectorized else self.entries[row]
+
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        if self.vectorized:
+            # По нижней оценке до MBR, геометрии хранилища разбираются только для просмотренных строк
+            yield from iter_nearest_rows(self.store, point, max_distance)
+            return
+
+        if len(self.entries) == 0:
+            return
+
+        distances = shapely.distance(np.array([e.shape for e in self.entries], dtype=object), point)
+
+        for i in np.argsort(distances, kind='stable'):
+            if max_distance is not None and distances[i] > max_distance:
+                return
+            yield self.entries[i], float(distances[i])
+
     def search(self, search: Geometry):
+        if self.vectorized:
+            return self.search_vectorized(search)
+
         search_box = geometry_to_box(search)
 
         candidates = list(filter(lambda e: intersection(e, search_box), self.entries))
-        shapes = list(map(lambda e: e.shape, set(candidates)))
 
-        return list(filter(lambda s: s.intersects(search), shapes))
\ No newline at end of file
+        return refine(candidates, search)
+
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return list(self.iter_candidates(search_box))
+
+    def iter_candidates(self, search_box: BoundaryBox) -> Iterator[Entry]:
+        if not self.vectorized:
+            return filter(lambda e: intersection(e, search_box), self.entries)
+
+        return self.store.entries(self.candidate_rows(search_box))
+
+    def candidate_rows(self, search_box: BoundaryBox) -> np.ndarray:
+        # Пересечение MBR сразу по всем строкам хранилища
+        store = self.store
+        mask = ((store.x_min <= search_box.x_max) & (store.x_max >= search_box.x_min) &
+                (store.y_min <= search_box.y_max) & (store.y_max >= search_box.y_min))
+
+        return np.flatnonzero(mask)
+
+    def iter_refined(self, search_box: BoundaryBox, search: Geometry, limit: int | None) -> Iterator[Geometry]:
+        if not self.vectorized:
+            return iter_refine(self.iter_candidates(search_box), search, limit)
+
+        return iter_refine_rows(self.store, self.candidate_rows(search_box), search, limit)
+
+    def search_vectorized(self, search: Geometry):
+        store = self.store
+
+        rows = self.candidate_rows(geometry_to_box(search))
+        shapes = store.geometries(rows)
+
+        return list(shapes[refine_mask(shapes, store.bounds(rows), search)])
+
+    def find_nearest_neighbor_vectorized(self, point: Point):
+        store = self.store
+
+        if len(store) == 0:
+            return None
+
+        # Нижняя граница расстояния: от точки до MBR
+        dx = np.maximum(np.maximum(store.x_min - point.x, point.x - store.x_max), 0)
+        dy = np.maximum(np.maximum(store.y_min - point.y, point.y - store.y_max), 0)
+        lower_bounds = np.hypot(dx, dy)
+
+        # Точно считаем несколько ближайших по MBR, получаем верхнюю границу
+        seed_size = min(NEAREST_SEED_SIZE, len(store))
+        seed = np.argpartition(lower_bounds, seed_size - 1)[:seed_size]
+        best = shapely.distance(store.geometries(seed), point).min()
+
+        # Точную проверку проходят только записи, у которых MBR не дальше найденного
+        # (seed добавляем явно, чтобы округление hypot не отбросило найденного)
+        candidates = np.union1d(seed, np.flatnonzero(lower_bounds <= best))
+        distances = shapely.distance(store.geometries(candidates), point)
+
+        return store.entry(candidates[np.argmin(distances)])
@@ -1,35 +1,93 @@
+from __future__ import annotations
+
+import copy
+import heapq
+import itertools
 import math
 import random
 import sys
 import time
-from typing import List
+from typing import List, Iterable, Iterator, Tuple
 
 import numpy as np
 import shapely
 from matplotlib.typing import ColorType
 from shapely import Geometry, Polygon, Point
 
+import hilbert
+import z_curve
 from shapely_plot import add_to_plot_geometry
 
+# Размер пачки кандидатов при ленивом уточнении (iter_search): от REFINE_BATCH_MIN, растет вдвое до REFINE_BATCH_MAX
+REFINE_BATCH_MIN = 64
+REFINE_BATCH_MAX = 4096
+
 
 class BoundaryBox:
+    # Без __dict__ и без shapely: только четыре числа, геометрия строится по запросу
+    __slots__ = ('x_min', 'y_min', 'x_max', 'y_max')
+
     def __init__(self, x_min, y_min, x_max, y_max):
         self.x_min = x_min
         self.y_min = y_min
         self.x_max = x_max
         self.y_max = y_max
 
-        self.boundary = shapely.box(self.x_min, self.y_min, self.x_max, self.y_max)
+    @property
+    def boundary(self):
+        return shapely.box(self.x_min, self.y_min, self.x_max, self.y_max)
 
     def area(self) -> float:
         return (self.x_max - self.x_min) * (self.y_max - self.y_min)
 
+    def perimeter(self) -> float:
+        return 2 * ((self.x_max - self.x_min) + (self.y_max - self.y_min))
+
+    def centroid(self) -> (float, float):
+        return (self.x_min + self.x_max) / 2, (self.y_min + self.y_max) / 2
+
+    def extend(self, box: BoundaryBox):
+        # Расширение на месте, без создания промежуточного union
+        if box.x_min < self.x_min:
+            self.x_min = box.x_min
+        if box.y_min < self.y_min:
+            self.y_min = box.y_min
+        if box.x_max > self.x_max:
+            self.x_max = box.x_max
+        if box.y_max > self.y_max:
+            self.y_max = box.y_max
+
 
 class Entry(BoundaryBox):
-    def __init__(self, shape: Geometry):
-        x_min, y_min, x_max, y_max = (shapely.envelope(shape)).bounds
+    __slots__ = ('shape', 'id')
+
+    def __init__(self, shape: Geometry, id: int | None = None, bounds: tuple[float, float, float, float] | None = None):
+        # Границы можно передать заранее (например из EntryStore), чтобы не строить envelope
+        x_min, y_min, x_max, y_max = bounds if bounds is not None else shape.bounds
         super().__init__(x_min, y_min, x_max, y_max)
         self.shape = shape
+        # id задается явно (make_entries, EntryStore); без него запись нельзя вернуть из пакетных запросов по id
+        self.id = id
+
+
+def make_entries(shapes) -> List[Entry]:
+    # Записи с id = номер геометрии в списке, границы всех геометрий - одним вызовом shapely.bounds
+    shapes = list(shapes)
+    bounds = shapely.bounds(np.array(shapes, dtype=object)).reshape(-1, 4).tolist()
+    return [Entry(shape, i, tuple(b)) for i, (shape, b) in enumerate(zip(shapes, bounds))]
+
+
+def entry_ids(entries: Iterable[Entry]) -> np.ndarray:
+    ids = [e.id for e in entries]
+
+    if any(i is None for i in ids):
+        raise ValueError("EntryWithoutId")
+
+    return np.array(ids, dtype=np.int64)
+
+
+def entry_boxes(entries: Iterable[Entry]) -> np.ndarray:
+    return np.array([(e.x_min, e.y_min, e.x_max, e.y_max) for e in entries], dtype=np.float64).reshape(-1, 4)
 
 
 class StopWatch(object):
@@ -61,6 +119,16 @@ def union(*boundaries: BoundaryBox):
     return BoundaryBox(minx, miny, maxx, maxy)
 
 
+def union_area(rect1: BoundaryBox, rect2: BoundaryBox) -> float:
+    return ((max(rect1.x_max, rect2.x_max) - min(rect1.x_min, rect2.x_min)) *
+            (max(rect1.y_max, rect2.y_max) - min(rect1.y_min, rect2.y_min)))
+
+
+def enlargement(rect: BoundaryBox, box: BoundaryBox) -> float:
+    # Увеличение площади rect, если добавить в него box (то же, что union(rect, box).area() - rect.area())
+    return union_area(rect, box) - rect.area()
+
+
 def intersection(rect1: BoundaryBox, rect2: BoundaryBox) -> bool:
     return (rect1.x_min <= rect2.x_max and
             rect1.x_max >= rect2.x_min and
@@ -87,10 +155,235 @@ def box_to_geometry(box: BoundaryBox):
 
 
 def geometry_to_box(shape: Geometry):
-    x_min, y_min, x_max, y_max = Polygon(shapely.envelope(shape)).bounds
+    x_min, y_min, x_max, y_max = shape.bounds
     return BoundaryBox(x_min, y_min, x_max, y_max)
 
 
+def concat_ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    # Индексы всех полуинтервалов [starts[i], ends[i]) одним массивом, без цикла в Python
+    lengths = ends - starts
+    total = int(lengths.sum())
+
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+
+    shifts = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return np.arange(total, dtype=np.int64) + shifts
+
+
+def is_box(shapes) -> np.ndarray:
+    """
+    Для каждой геометрии: является ли она прямоугольником со сторонами, параллельными осям (совпадает со своим MBR).
+    """
+    shapes = np.asarray(shapes, dtype=object).reshape(-1)
+
+    # Полигон без дыр из 4 вершин + замыкающая
+    result = ((shapely.get_type_id(shapes) == 3) & (shapely.get_num_interior_rings(shapes) == 0) &
+              (shapely.get_num_coordinates(shapes) == 5))
+
+    candidates = np.flatnonzero(result)
+
+    if len(candidates) == 0:
+        return result
+
+    coords, index = shapely.get_coordinates(shapes[candidates], return_index=True)
+    bounds = shapely.bounds(shapes[candidates])
+    corner_bounds = bounds[index]
+
+    # Все вершины в углах MBR и площадь равна площади MBR (а не треугольник или "бабочка" по тем же углам)
+    on_corner = (((coords[:, 0] == corner_bounds[:, 0]) | (coords[:, 0] == corner_bounds[:, 2])) &
+                 ((coords[:, 1] == corner_bounds[:, 1]) | (coords[:, 1] == corner_bounds[:, 3])))
+    all_on_corners = np.bincount(index, weights=~on_corner, minlength=len(candidates)) == 0
+
+    box_area = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+    full_area = (box_area > 0) & np.isclose(shapely.area(shapes[candidates]), box_area)
+
+    result[candidates] = all_on_corners & full_area
+
+    return result
+
+
+def refine_mask(shapes, bounds, search: Geometry) -> np.ndarray:
+    """
+    Точная проверка кандидатов: для каждой геометрии shapes[i] (с MBR bounds[i]) - пересекает ли она search.
+    Запрос подготавливается (shapely.prepare) один раз и проверяется одним векторным вызовом.
+    Если запрос - прямоугольник, то точки, прямоугольники и записи с MBR внутри запроса решаются без GEOS.
+    bounds можно не передавать - тогда они считаются по геометриям, и только для прямоугольного запроса.
+    Геометрия search не меняется: если она не подготовлена, готовится ее копия (см. prepared).
+    """
+    shapes = np.asarray(shapes, dtype=object).reshape(-1)
+
+    mask = np.zeros(len(shapes), dtype=bool)
+
+    if len(shapes) == 0:
+        return mask
+
+    undecided = np.ones(len(shapes), dtype=bool)
+
+    # Сначала дешевая проверка числа вершин, чтобы не разбирать сложный запрос
+    if shapely.get_num_coordinates(search) == 5 and is_box(search)[0]:
+        x_min, y_min, x_max, y_max = search.bounds
+
+        bounds = shapely.bounds(shapes) if bounds is None else np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+
+        overlaps = ((bounds[:, 0] <= x_max) & (bounds[:, 2] >= x_min) &
+                    (bounds[:, 1] <= y_max) & (bounds[:, 3] >= y_min))
+        inside = ((bounds[:, 0] >= x_min) & (bounds[:, 2] <= x_max) &
+                  (bounds[:, 1] >= y_min) & (bounds[:, 3] <= y_max))
+        point = (bounds[:, 0] == bounds[:, 2]) & (bounds[:, 1] == bounds[:, 3])
+
+        mask = overlaps & (inside | point)
+        undecided = overlaps & ~mask
+
+        # Прямоугольник пересекает прямоугольный запрос тогда и только тогда, когда пересекаются их MBR
+        rest = np.flatnonzero(undecided)
+        boxes = rest[is_box(shapes[rest])]
+        mask[boxes] = True
+        undecided[boxes] = False
+
+    rest = np.flatnonzero(undecided)
+
+    if len(rest) > 0:
+        mask[rest] = shapely.intersects(prepared(search), shapes[rest])
+
+    return mask
+
+
+def prepared(search: Geometry) -> Geometry:
+    # shapely.prepare меняет сам объект - поэтому готовится копия, геометрия вызывающего остается как была
+    if shapely.is_prepared(search):
+        return search
+
+    search = copy.copy(search)
+    shapely.prepare(search)
+    return search
+
+
+def refine(candidates: List[Entry], search: Geometry) -> List[Geometry]:
+    # Геометрии кандидатов (записи с MBR, пересекающим запрос), которые точно пересекают search
+    shapes = np.array([e.shape for e in candidates], dtype=object)
+    return list(shapes[refine_mask(shapes, entry_boxes(candidates), search)])
+
+
+def _batch_sizes() -> Iterator[int]:
+    # Первая пачка маленькая, чтобы limit и exists не платили за лишнее; дальше растет вдвое
+    size = REFINE_BATCH_MIN
+
+    while True:
+        yield size
+        size = min(2 * size, REFINE_BATCH_MAX)
+
+
+def iter_refine(candidates: Iterable[Entry], search: Geometry, limit: int | None = None) -> Iterator[Geometry]:
+    """
+    Ленивое уточнение: кандидаты забираются из потока пачками растущего размера,
+    каждая пачка проверяется одним вызовом refine_mask, найденные геометрии выдаются сразу.
+    Повторяющиеся записи (несколько ячеек / листов) пропускаются. После limit найденных обход прекращается.
+    """
+    if limit is not None and limit <= 0:
+        return
+
+    candidates = iter(candidates)
+    search = prepared(search)
+    seen = set()
+    found = 0
+
+    for size in _batch_sizes():
+        batch = []
+
+        for entry in candidates:
+            if id(entry) in seen:
+                continue
+
+            seen.add(id(entry))
+            batch.append(entry)
+
+            if len(batch) >= size:
+                break
+
+        if len(batch) == 0:
+            return
+
+        shapes = np.array([e.shape for e in batch], dtype=object)
+
+        for shape in shapes[refine_mask(shapes, entry_boxes(batch), search)]:
+            yield shape
+            found += 1
+
+            if found == limit:
+                return
+
+        if len(batch) < size:
+            return
+
+
+def iter_refine_rows(store, rows: np.ndarray, search: Geometry, limit: int | None = None) -> Iterator[Geometry]:
+    # То же для строк EntryStore: геометрии разбираются (WKB) только для просмотренных пачек
+    if limit is not None and limit <= 0:
+        return
+
+    search = prepared(search)
+    position = 0
+    found = 0
+
+    for size in _batch_sizes():
+        batch = rows[position:position + size]
+        position += size
+
+        if len(batch) == 0:
+            return
+
+        shapes = store.geometries(batch)
+
+        for shape in shapes[refine_mask(shapes, store.bounds(batch), search)]:
+            yield shape
+            found += 1
+
+            if found == limit:
+                return
+
+
+def iter_nearest_rows(store, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+    """
+    Записи EntryStore по возрастанию расстояния до point. Строки упорядочиваются по расстоянию до MBR
+    (нижней оценке) одним векторным шагом, а геометрии разбираются пачками растущего размера -
+    только пока оценка следующей непросмотренной строки не больше уже найденных расстояний.
+    """
+    if len(store) == 0:
+        return
+
+    dx = np.maximum(np.maximum(store.x_min - point.x, point.x - store.x_max), 0)
+    dy = np.maximum(np.maximum(store.y_min - point.y, point.y - store.y_max), 0)
+    lower_bounds = np.hypot(dx, dy)
+
+    order = np.argsort(lower_bounds, kind='stable')
+    lower_bounds = lower_bounds[order]
+
+    found = []
+    position = 0
+
+    for size in _batch_sizes():
+        batch = order[position:position + size]
+        position += len(batch)
+
+        for row, row_distance in zip(batch.tolist(), shapely.distance(store.geometries(batch), point).tolist()):
+            heapq.heappush(found, (row_distance, row))
+
+        # Все непросмотренные строки не ближе bound
+        bound = lower_bounds[position] if position < len(order) else math.inf
+
+        while len(found) > 0 and found[0][0] <= bound:
+            row_distance, row = heapq.heappop(found)
+
+            if max_distance is not None and row_distance > max_distance:
+                return
+
+            yield store.entry(row), row_distance
+
+        if position == len(order) or (max_distance is not None and bound > max_distance):
+            return
+
+
 def get_nearest(entries: List[Entry], point: Point):
     min_distance = float('inf')
     nearest = None
@@ -112,6 +405,299 @@ def distance(box: BoundaryBox, point: Point):
     return math.sqrt((nearest_x - point.x) ** 2 + (nearest_y - point.y) ** 2)
 
 
+def iter_candidates(root, search_box: BoundaryBox) -> Iterator[Entry]:
+    """
+    Обход дерева в глубину явным стеком, без рекурсии: записи, MBR которых пересекает search_box,
+    выдаются по мере обнаружения (порядок тот же, что у рекурсивного обхода).
+    Узел должен иметь метод expand(), возвращающий (записи узла, дочерние узлы).
+    """
+    x_min, y_min, x_max, y_max = search_box.x_min, search_box.y_min, search_box.x_max, search_box.y_max
+
+    stack = [root]
+
+    while len(stack) > 0:
+        entries, children = stack.pop().expand()
+
+        for e in entries:
+            if e.x_min <= x_max and e.x_max >= x_min and e.y_min <= y_max and e.y_max >= y_min:
+                yield e
+
+        stack.extend([c for c in reversed(children)
+                      if c.x_min <= x_max and c.x_max >= x_min and c.y_min <= y_max and c.y_max >= y_min])
+
+
+def collect_candidates(root, search_box: BoundaryBox) -> List[Entry]:
+    # То же, что iter_candidates, но сразу в один список: без генератора и без копирования списков между уровнями
+    x_min, y_min, x_max, y_max = search_box.x_min, search_box.y_min, search_box.x_max, search_box.y_max
+
+    result = []
+    stack = [root]
+
+    while len(stack) > 0:
+        entries, children = stack.pop().expand()
+
+        result.extend([e for e in entries
+                       if e.x_min <= x_max and e.x_max >= x_min and e.y_min <= y_max and e.y_max >= y_min])
+        stack.extend([c for c in reversed(children)
+                      if c.x_min <= x_max and c.x_max >= x_min and c.y_min <= y_max and c.y_max >= y_min])
+
+    return result
+
+
+def count_candidates(root, search_box: BoundaryBox) -> int:
+    return sum(1 for _ in iter_candidates(root, search_box))
+
+
+def visit_candidates(root, search_box: BoundaryBox, visitor) -> bool:
+    """
+    Вызывает visitor(entry) для каждой записи с MBR, пересекающим search_box.
+    Если visitor вернул False, обход прекращается. Возвращает True, если обход дошел до конца.
+    """
+    for entry in iter_candidates(root, search_box):
+        if visitor(entry) is False:
+            return False
+
+    return True
+
+
+# Виды элементов в куче best-first обхода
+_NODE, _ENTRY, _EXACT = 0, 1, 2
+
+
+def nearest_iter(root, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+    """
+    Best-first обход от ближайшего к дальнему: записи выдаются по одной в порядке возрастания расстояния.
+    Узел должен иметь метод expand(), возвращающий (записи узла, дочерние узлы).
+    Записи сначала попадают в кучу с расстоянием до MBR (нижняя граница),
+    точное расстояние считается только когда запись дошла до верха кучи.
+    """
+    heap = [(distance(root, point), 0, _NODE, root)]
+    counter = 1
+    seen = set()
+
+    while len(heap) > 0:
+        item_distance, _, kind, item = heapq.heappop(heap)
+
+        if max_distance is not None and item_distance > max_distance:
+            return
+
+        if kind == _EXACT:
+            yield item, item_distance
+        elif kind == _ENTRY:
+            # Для точек расстояние до MBR и есть точное
+            if item.x_min == item.x_max and item.y_min == item.y_max:
+                yield item, item_distance
+            else:
+                heapq.heappush(heap, (shapely.distance(item.shape, point), counter, _EXACT, item))
+                counter += 1
+        else:
+            entries, children = item.expand()
+
+            for entry in entries:
+                # Одна запись может храниться в нескольких узлах
+                if id(entry) in seen:
+                    continue
+                seen.add(id(entry))
+
+                heapq.heappush(heap, (distance(entry, point), counter, _ENTRY, entry))
+                counter += 1
+
+            for child in children:
+                heapq.heappush(heap, (distance(child, point), counter, _NODE, child))
+                counter += 1
+
+
+class SpatialIndex(object):
+    """
+    Общие запросы индексов. Индекс задает iter_candidates(search_box) - записи с MBR, пересекающим запрос
+    (могут повторяться), search_candidates(search_box) и nearest_entries(point, max_distance) - поток записей
+    по возрастанию расстояния. Если запрос не лежит в области индекса (covers), search возвращает None,
+    а остальные запросы - пустой результат.
+    """
+    __slots__ = ()
+
+    def covers(self, search_box: BoundaryBox) -> bool:
+        # Переопределяют индексы с заданной при построении областью (KD-дерево, квадродерево, сетки).
+        # У R-деревьев корень - MBR данных, запрос шире него (окно просмотра) должен находить записи
+        return True
+
+    def iter_search(self, search: Geometry, limit: int | None = None) -> Iterator[Geometry]:
+        search_box = geometry_to_box(search)
+
+        if not self.covers(search_box):
+            return iter(())
+
+        return self.iter_refined(search_box, search, limit)
+
+    def iter_refined(self, search_box: BoundaryBox, search: Geometry, limit: int | None) -> Iterator[Geometry]:
+        # Индексы над строками EntryStore переопределяют, чтобы не собирать объекты Entry
+        return iter_refine(self.iter_candidates(search_box), search, limit)
+
+    def count(self, search: Geometry) -> int:
+        return sum(1 for _ in self.iter_search(search))
+
+    def exists(self, search: Geometry) -> bool:
+        return next(self.iter_search(search, 1), None) is not None
+
+    def search_many(self, geometries) -> List[np.ndarray]:
+        return search_many(self, geometries)
+
+    def find_nearest_many(self, points, k: int = 1):
+        return find_nearest_many(self, points, k)
+
+    def find_k_nearest(self, point: Point, k: int, max_distance: float | None = None):
+        for entry, entry_distance in itertools.islice(self.nearest_entries(point, max_distance), k):
+            yield entry.shape, entry_distance
+
+
+def merge_nearest(best_distances: np.ndarray, best_positions: np.ndarray, segment: np.ndarray, start: int,
+                  x: float, y: float, k: int, bound: float) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    Точки листа segment (позиции start, start + 1, ... в массиве points) добавляются к k ближайшим к (x, y):
+    берутся только точки не дальше bound, лишние отбрасываются np.argpartition.
+    Возвращает новых лучших и границу - k-е расстояние, как только найдено k точек. k > 0.
+    """
+    distances = np.hypot(segment[:, 0] - x, segment[:, 1] - y)
+    mask = distances <= bound
+
+    if not mask.any():
+        return best_distances, best_positions, bound
+
+    best_distances = np.concatenate((best_distances, distances[mask]))
+    best_positions = np.concatenate((best_positions, start + np.flatnonzero(mask)))
+
+    if len(best_distances) >= k:
+        if len(best_distances) > k:
+            keep = np.argpartition(best_distances, k - 1)[:k]
+            best_distances, best_positions = best_distances[keep], best_positions[keep]
+
+        bound = min(bound, best_distances.max())
+
+    return best_distances, best_positions, bound
+
+
+def points_within(segment: np.ndarray, ids: np.ndarray, x: float, y: float,
+                  radius: float) -> Tuple[np.ndarray, np.ndarray]:
+    # Расстояния и ids точек листа не дальше radius от (x, y)
+    distances = np.hypot(segment[:, 0] - x, segment[:, 1] - y)
+    mask = distances <= radius
+    return distances[mask], ids[mask]
+
+
+def sorted_by_distance(distances_parts: List[np.ndarray], ids_parts: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    # Части, собранные по листам, в один результат по возрастанию расстояния
+    if len(distances_parts) == 0:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+
+    distances, ids = np.concatenate(distances_parts), np.concatenate(ids_parts)
+    order = np.argsort(distances, kind='stable')
+
+    return distances[order], ids[order]
+
+
+class PointIndex(object):
+    """
+    Общие запросы индексов точек на массивах (ImplicitKDTree, LinearQuadtree) поверх
+    query_positions(x, y, k, max_distance) - расстояний и позиций в массиве points по возрастанию расстояния.
+    """
+    __slots__ = ()
+
+    def query(self, x: float, y: float, k: int = 1, max_distance: float | None = None) -> (np.ndarray, np.ndarray):
+        """
+        k ближайших точек к (x, y): (расстояния, ids) по возрастанию расстояния.
+        """
+        distances, positions = self.query_positions(x, y, k, max_distance)
+        return distances, self.ids[positions]
+
+    def find_nearest_neighbor(self, point: Point):
+        distances, positions = self.query_positions(point.x, point.y, 1)
+        return shapely.Point(self.points[positions[0]]) if len(positions) > 0 else None
+
+    def find_k_nearest(self, point: Point, k: int, max_distance: float | None = None):
+        distances, positions = self.query_positions(point.x, point.y, k, max_distance)
+
+        for position, object_distance in zip(positions.tolist(), distances.tolist()):
+            yield shapely.Point(self.points[position]), object_distance
+
+
+# Разрешение сетки, на которую проецируются центры запросов для упорядочивания по кривой
+QUERY_ORDER_BITS = 16
+
+
+def query_order(bounds: np.ndarray, curve: str = 'hilbert') -> np.ndarray:
+    """
+    Порядок обработки пачки запросов вдоль кривой Гильберта (или Z-кривой, curve='z') по центрам их MBR:
+    соседние в пространстве запросы идут подряд и проходят по одним и тем же (уже прогретым) узлам.
+    """
+    if len(bounds) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    centers_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    centers_y = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    extent = BoundaryBox(centers_x.min(), centers_y.min(), centers_x.max(), centers_y.max())
+    if curve == 'hilbert':
+        codes = hilbert.hilbert_encode_in_box(centers_x, centers_y, extent, QUERY_ORDER_BITS)
+    else:
+        codes = z_curve.z_encode_in_box(centers_x, centers_y, extent, QUERY_ORDER_BITS)
+
+    return np.argsort(codes, kind='stable')
+
+
+def search_many(structure, geometries) -> List[np.ndarray]:
+    """
+    Пачка запросов в диапазоне: для каждой геометрии массив id найденных записей (в порядке входа).
+    structure должна уметь search_candidates(search_box) - кандидаты по MBR - и covers(search_box).
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    bounds = shapely.bounds(geometries).reshape(-1, 4)
+
+    results: List[np.ndarray | None] = [None] * len(geometries)
+
+    for i in query_order(bounds):
+        x_min, y_min, x_max, y_max = bounds[i]
+        search_box = BoundaryBox(x_min, y_min, x_max, y_max)
+
+        if not structure.covers(search_box):
+            results[i] = np.empty(0, dtype=np.int64)
+            continue
+
+        candidates = structure.search_candidates(search_box)
+
+        # Записи могут повторяться (несколько ячеек / листов)
+        candidates = list({id(e): e for e in candidates}.values())
+
+        shapes = np.array([e.shape for e in candidates], dtype=object)
+        ids = entry_ids(candidates)
+
+        results[i] = ids[refine_mask(shapes, entry_boxes(candidates), geometries[i])]
+
+    return results
+
+
+def find_nearest_many(structure, points, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Пачка запросов k ближайших соседей: массивы (n, k) id и расстояний.
+    Если записей меньше k, хвост заполняется id = -1 и расстоянием inf.
+    structure должна уметь nearest_entries(point).
+    """
+    points = np.asarray(points, dtype=object)
+    coords = shapely.get_coordinates(points)
+
+    ids = np.full((len(points), k), -1, dtype=np.int64)
+    distances = np.full((len(points), k), np.inf)
+
+    for i in query_order(np.column_stack((coords, coords))):
+        for j, (entry, entry_distance) in enumerate(itertools.islice(structure.nearest_entries(points[i]), k)):
+            if entry.id is None:
+                raise ValueError("EntryWithoutId")
+
+            ids[i, j] = entry.id
+            distances[i, j] = entry_distance
+
+    return ids, distances
+
+
 def add_to_plot_box(box: BoundaryBox, color: ColorType = None):
     add_to_plot_geometry(shapely.box(box.x_min, box.y_min, box.x_max, box.y_max), color)
 
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import os
+from typing import Iterable, Iterator, List
+
+import numpy as np
+import shapely
+from shapely import Geometry
+
+from common import Entry
+
+
+class EntryStore(object):
+    """
+    Колоночное хранилище записей: MBR всех объектов лежат в непрерывных массивах float64,
+    рядом хранится колонка идентификаторов объектов и сами геометрии.
+    StaticFixedGrid, ZOrderIndex и BruteForce(vectorized=True) обращаются к записи по номеру строки (row),
+    деревья и FixedGrid хранят объекты Entry.
+    """
+
+    def __init__(self, capacity: int = 16):
+        self.size = 0
+
+        self._x_min = np.empty(capacity, dtype=np.float64)
+        self._y_min = np.empty(capacity, dtype=np.float64)
+        self._x_max = np.empty(capacity, dtype=np.float64)
+        self._y_max = np.empty(capacity, dtype=np.float64)
+        self._ids = np.empty(capacity, dtype=np.int64)
+        self._shapes = np.empty(capacity, dtype=object)
+
+        # Для хранилища, открытого с диска: геометрии в WKB (data + offsets), разбираются по запросу
+        self._wkb: tuple[np.ndarray, np.ndarray] | None = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def x_min(self) -> np.ndarray:
+        return self._x_min[:self.size]
+
+    @property
+    def y_min(self) -> np.ndarray:
+        return self._y_min[:self.size]
+
+    @property
+    def x_max(self) -> np.ndarray:
+        return self._x_max[:self.size]
+
+    @property
+    def y_max(self) -> np.ndarray:
+        return self._y_max[:self.size]
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self.size]
+
+    @property
+    def shapes(self) -> np.ndarray:
+        if self._wkb is not None:
+            self.geometries(np.arange(self.size))
+        return self._shapes[:self.size]
+
+    def geometries(self, rows) -> np.ndarray:
+        if self._wkb is None:
+            return self._shapes[rows]
+
+        rows = np.asarray(rows, dtype=np.int64)
+        missing = rows[np.equal(self._shapes[rows], None)]
+
+        if len(missing) > 0:
+            data, offsets = self._wkb
+            self._shapes[missing] = shapely.from_wkb([data[offsets[r]:offsets[r + 1]].tobytes() for r in missing])
+
+        return self._shapes[rows]
+
+    def reserve(self, capacity: int):
+        if capacity <= len(self._ids):
+            return
+
+        # Увеличиваем емкость в 2 раза, чтобы добавление по одному было амортизированно O(1)
+        capacity = max(capacity, 2 * len(self._ids))
+
+        if self._wkb is not None:
+            self.geometries(np.arange(self.size))
+            self._wkb = None
+
+        for name in ['_x_min', '_y_min', '_x_max', '_y_max', '_ids', '_shapes']:
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add(self, shape: Geometry, object_id: int | None = None) -> int:
+        row = self.size
+        self.reserve(row + 1)
+
+        x_min, y_min, x_max, y_max = shapely.bounds(shape)
+
+        self._x_min[row], self._y_min[row], self._x_max[row], self._y_max[row] = x_min, y_min, x_max, y_max
+        self._ids[row] = row if object_id is None else object_id
+        self._shapes[row] = shape
+
+        self.size += 1
+
+        return row
+
+    def extend(self, shapes: Iterable[Geometry], object_ids: Iterable[int] | None = None) -> np.ndarray:
+        shapes = np.asarray(list(shapes) if not isinstance(shapes, np.ndarray) else shapes, dtype=object)
+
+        start = self.size
+        end = start + len(shapes)
+        self.reserve(end)
+
+        # Границы всех геометрий одним вызовом
+        bounds = shapely.bounds(shapes).reshape(-1, 4)
+
+        self._x_min[start:end] = bounds[:, 0]
+        self._y_min[start:end] = bounds[:, 1]
+        self._x_max[start:end] = bounds[:, 2]
+        self._y_max[start:end] = bounds[:, 3]
+        self._ids[start:end] = np.arange(start, end) if object_ids is None else np.fromiter(object_ids, np.int64)
+        self._shapes[start:end] = shapes
+
+        self.size = end
+
+        return np.arange(start, end)
+
+    def bounds(self, rows=None) -> np.ndarray:
+        rows = slice(0, self.size) if rows is None else rows
+        return np.column_stack((self._x_min[rows], self._y_min[rows], self._x_max[rows], self._y_max[rows]))
+
+    def entry(self, row: int) -> Entry:
+        shape = self._shapes[row] if self._wkb is None else self.geometries([row])[0]
+        return Entry(shape, int(self._ids[row]),
+                     (float(self._x_min[row]), float(self._y_min[row]),
+                      float(self._x_max[row]), float(self._y_max[row])))
+
+    def entries(self, rows=None) -> Iterator[Entry]:
+        rows = range(self.size) if rows is None else rows
+        for row in rows:
+            yield self.entry(row)
+
+    def load_into(self, structure, rows=None):
+        # Индексы над строками (insert_rows, например BruteForce) копируют колонки без объектов Entry.
+        # Деревья и FixedGrid хранят объекты Entry: для них каждая строка собирается в Entry и вставляется
+        if hasattr(structure, 'insert_rows'):
+            structure.insert_rows(self, rows)
+            return structure
+
+        for entry in self.entries(rows):
+            structure.insert(entry)
+
+        return structure
+
+    def save(self, path: str):
+        # Каждая колонка - отдельный .npy, чтобы открывать через np.load(mmap_mode=...)
+        os.makedirs(path, exist_ok=True)
+
+        for name in ['x_min', 'y_min', 'x_max', 'y_max', 'ids']:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+
+        wkb = shapely.to_wkb(self.shapes)
+        lengths = np.fromiter((len(w) for w in wkb), dtype=np.int64, count=len(wkb))
+
+        np.save(os.path.join(path, 'wkb_offsets.npy'), np.concatenate(([0], np.cumsum(lengths))))
+        np.save(os.path.join(path, 'wkb_data.npy'), np.frombuffer(b''.join(wkb), dtype=np.uint8))
+
+    @staticmethod
+    def open(path: str, mmap_mode: str | None = 'r') -> EntryStore:
+        store = EntryStore(0)
+
+        def load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        store._x_min, store._y_min = load('x_min'), load('y_min')
+        store._x_max, store._y_max = load('x_max'), load('y_max')
+        store._ids = load('ids')
+        store.size = len(store._ids)
+        store._shapes = np.empty(store.size, dtype=object)
+        store._wkb = (load('wkb_data'), load('wkb_offsets'))
+
+        return store
+
+    @staticmethod
+    def from_shapes(shapes: Iterable[Geometry], object_ids: Iterable[int] | None = None) -> EntryStore:
+        shapes = list(shapes)
+        store = EntryStore(max(len(shapes), 1))
+        store.extend(shapes, object_ids)
+        return store
+
+    @staticmethod
+    def from_entries(entries: List[Entry]) -> EntryStore:
+        store = EntryStore(max(len(entries), 1))
+        store.extend([e.shape for e in entries],
+                     [e.id if e.id is not None else i for i, e in enumerate(entries)])
+        return store
@@ -1,13 +1,22 @@
-from typing import List, Dict
+from __future__ import annotations
 
+import heapq
+import json
+import math
+import os
+from typing import List, Dict, Iterator, Tuple
+
+import numpy as np
 import shapely
 from shapely import Polygon, Point, Geometry
 
-from common import Entry, get_nearest, geometry_to_box, intersection, BoundaryBox, contains
+from common import Entry, geometry_to_box, intersection, BoundaryBox, contains, concat_ranges, refine, refine_mask, \
+    iter_refine_rows, SpatialIndex
+from entry_store import EntryStore
 from shapely_plot import add_to_plot_geometry
 
 
-class FixedGrid(BoundaryBox):
+class FixedGrid(BoundaryBox, SpatialIndex):
     def __init__(self, boundary: Polygon, grid_size: int = 4):
         x_min, y_min, x_max, y_max = (shapely.envelope(boundary)).bounds
         super().__init__(x_min, y_min, x_max, y_max)
@@ -22,118 +31,372 @@ class FixedGrid(BoundaryBox):
 
         self.cells: Dict[tuple[int, int], List[Entry]] = {}
 
+        # Массив ключей занятых ячеек для поиска ближайших, строится по запросу и сбрасывается при новой ячейке
+        self._occupied: np.ndarray | None = None
+
     def insert(self, entry: Entry):
         if not contains(self, entry):
             raise ValueError("ElementOutside")
 
-        grid_x1, grid_y1 = int(entry.x_min // self.cell_width), int(entry.y_min // self.cell_height)
-        grid_x2, grid_y2 = int(entry.x_max // self.cell_width), int(entry.y_max // self.cell_height)
+        grid_x1, grid_y1 = self.get_cell(entry.x_min, entry.y_min)
+        grid_x2, grid_y2 = self.get_cell(entry.x_max, entry.y_max)
 
         for x in range(grid_x1, grid_x2 + 1):
             for y in range(grid_y1, grid_y2 + 1):
                 if (x, y) not in self.cells:
                     self.cells[(x, y)] = []
+                    self._occupied = None
 
                 self.cells[(x, y)].append(entry)
 
     def find_nearest_neighbor(self, point: Point):
-        query_x, query_y = point.x, point.y
+        nearest = next(self.nearest_entries(point), None)
+        return nearest[0].shape if nearest is not None else None
 
-        cell_x, cell_y = int(query_x // self.cell_width), int(query_y // self.cell_height)
+    def search(self, search: Geometry):
+        search_box = geometry_to_box(search)
 
-        # Содержащая ячейка
-        neighbors = self.get_objects_in_cell(cell_x, cell_y)
-        nearest = get_nearest_entry(neighbors, point)
+        if self.covers(search_box):
+            # Запись из нескольких ячеек берется один раз
+            return refine(list({id(e): e for e in self.iter_candidates(search_box)}.values()), search)
+        else:
+            return None
 
-        if nearest is not None:
-            return nearest.shape
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return list(self.iter_candidates(search_box))
 
-        # Если в ячейке нет соседей, то бежим по остальным
-        max_x_radius = max(cell_x, self.grid_size - cell_x + 1)
-        max_y_radius = max(cell_y, self.grid_size - cell_y + 1)
-        max_radius = max(max_x_radius, max_y_radius)
+    def iter_candidates(self, search_box: BoundaryBox) -> Iterator[Entry]:
+        # Ячейки просматриваются по одной, записи выдаются по мере обхода (с повторами из соседних ячеек)
+        cell_min_x, cell_min_y = self.get_cell(search_box.x_min, search_box.y_min)
+        cell_max_x, cell_max_y = self.get_cell(search_box.x_max, search_box.y_max)
 
-        for r in range(1, max_radius + 1):
-            nearest_cells = circular_traversal(cell_x, cell_y, r, self.grid_size)
-            neighbors = list(set([cc for c in nearest_cells for cc in self.get_objects_in_cell(c[0], c[1])]))
-            nearest = get_nearest_entry(neighbors, point)
+        for x in range(cell_min_x, cell_max_x + 1):
+            for y in range(cell_min_y, cell_max_y + 1):
+                yield from filter(lambda e: intersection(e, search_box), self.get_objects_in_cell(x, y))
 
-            # Если ближайший найден, то нужен поиск еще по одному кругу
-            if nearest is not None:
-                if r < max_radius:
-                    nearest_cells = circular_traversal(cell_x, cell_y, r + 1, self.grid_size)
-                    neighbors = list(set([cc for c in nearest_cells for cc in self.get_objects_in_cell(c[0], c[1])]))
-                    nearest = get_nearest_entry([*neighbors, nearest], point)
+    def covers(self, search_box: BoundaryBox) -> bool:
+        return contains(self, search_box)
 
-                return nearest.shape
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        found = []
+        seen = set()
+        counter = 0
 
-        return None
+        for cells, bound in cells_by_distance(self, point):
+            for x, y in cells:
+                for entry in self.get_objects_in_cell(x, y):
+                    if id(entry) in seen:
+                        continue
+                    seen.add(id(entry))
 
-    def search(self, search: Geometry):
-        search_box = geometry_to_box(search)
+                    heapq.heappush(found, (shapely.distance(entry.shape, point), counter, entry))
+                    counter += 1
 
-        if contains(self, search_box):
-            x_min, y_min, x_max, y_max = search_box.x_min, search_box.y_min, search_box.x_max, search_box.y_max
+            # Все непросмотренные ячейки не ближе bound - найденное до нее уже окончательно
+            while len(found) > 0 and found[0][0] <= bound:
+                entry_distance, _, entry = heapq.heappop(found)
 
-            cell_min_x, cell_min_y = int(x_min // self.cell_width), int(y_min // self.cell_height)
-            cell_max_x, cell_max_y = int(x_max // self.cell_width), int(y_max // self.cell_height)
+                if max_distance is not None and entry_distance > max_distance:
+                    return
 
-            candidates = []
+                yield entry, entry_distance
 
-            for x in range(cell_min_x, cell_max_x + 1):
-                for y in range(cell_min_y, cell_max_y + 1):
-                    entries = list(filter(lambda e: intersection(e, search_box), self.get_objects_in_cell(x, y)))
-                    candidates.extend(entries)
+            if max_distance is not None and bound > max_distance:
+                return
 
-            shapes = list(map(lambda e: e.shape, set(candidates)))
-            return list(filter(lambda s: s.intersects(search), shapes))
-        else:
-            return None
+    def cell_count(self) -> int:
+        return len(self.cells)
+
+    def occupied_cells(self) -> np.ndarray:
+        if self._occupied is None:
+            self._occupied = np.array(list(self.cells.keys()), dtype=np.int64).reshape(-1, 2)
+
+        return self._occupied
+
+    def get_cell(self, x, y) -> Tuple[int, int]:
+        return grid_cell(self, x, y)
 
     def get_objects_in_cell(self, x, y) -> List[Entry]:
         return self.cells.get((x, y), [])
 
+    def freeze(self) -> StaticFixedGrid:
+        entries = list({id(e): e for cell in self.cells.values() for e in cell}.values())
+        boundary = shapely.box(self.x_min, self.y_min, self.x_max, self.y_max)
+        return StaticFixedGrid.build(boundary, EntryStore.from_entries(entries), self.grid_size)
+
+
+class StaticFixedGrid(BoundaryBox, SpatialIndex):
+    """
+    Неизменяемая сетка в формате CSR: отсортированные ключи занятых ячеек (cell_keys),
+    смещения их списков (cell_offsets) и один массив номеров строк EntryStore (rows).
+    Список ячейки cell_keys[i] - это rows[cell_offsets[i]:cell_offsets[i + 1]].
+    Все массивы можно сохранить на диск и открыть через mmap.
+    """
+
+    def __init__(self, boundary: Polygon, grid_size: int, store: EntryStore,
+                 cell_keys: np.ndarray, cell_offsets: np.ndarray, rows: np.ndarray):
+        x_min, y_min, x_max, y_max = boundary.bounds
+        super().__init__(x_min, y_min, x_max, y_max)
+
+        self.grid_size = grid_size
+
+        self.cell_width = (x_max - x_min) / self.grid_size
+        self.cell_height = (y_max - y_min) / self.grid_size
+
+        self.store = store
+        self.cell_keys = cell_keys
+        self.cell_offsets = cell_offsets
+        self.rows = rows
+
+    @staticmethod
+    def build(boundary: Polygon, store: EntryStore, grid_size: int = 4) -> StaticFixedGrid:
+        x_min, y_min, x_max, y_max = boundary.bounds
+        cell_width, cell_height = (x_max - x_min) / grid_size, (y_max - y_min) / grid_size
 
-def get_nearest_entry(entries: List[Entry], point: Point):
-    nearest, _ = get_nearest(entries, point)
-    return nearest
+        def cells(values, origin, size):
+            # То же отображение, что grid_cell, сразу для всех записей
+            return np.clip(np.floor((values - origin) / size), 0, grid_size).astype(np.int64)
+
+        # Диапазоны ячеек, покрытых MBR каждой записи
+        grid_x1, grid_y1 = cells(store.x_min, x_min, cell_width), cells(store.y_min, y_min, cell_height)
+        grid_x2, grid_y2 = cells(store.x_max, x_min, cell_width), cells(store.y_max, y_min, cell_height)
+
+        widths = grid_x2 - grid_x1 + 1
+        counts = widths * (grid_y2 - grid_y1 + 1)
+
+        # Пары (ячейка, запись) для всех записей сразу
+        local = concat_ranges(np.zeros_like(counts), counts)
+        cell_x = np.repeat(grid_x1, counts) + local % np.repeat(widths, counts)
+        cell_y = np.repeat(grid_y1, counts) + local // np.repeat(widths, counts)
+
+        row_dtype = np.int32 if len(store) < 2 ** 31 else np.int64
+        rows = np.repeat(np.arange(len(store), dtype=row_dtype), counts)
+        keys = cell_x * (grid_size + 1) + cell_y
+
+        order = np.argsort(keys, kind='stable')
+        keys, rows = keys[order], rows[order]
+
+        cell_keys, starts = np.unique(keys, return_index=True)
+        cell_offsets = np.append(starts, len(keys)).astype(np.int64)
+
+        return StaticFixedGrid(boundary, grid_size, store, cell_keys, cell_offsets, rows)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+        self.store.save(os.path.join(path, 'store'))
+
+        np.save(os.path.join(path, 'cell_keys.npy'), self.cell_keys)
+        np.save(os.path.join(path, 'cell_offsets.npy'), self.cell_offsets)
+        np.save(os.path.join(path, 'rows.npy'), self.rows)
+
+        with open(os.path.join(path, 'grid.json'), 'w') as f:
+            json.dump({'bounds': [self.x_min, self.y_min, self.x_max, self.y_max], 'grid_size': self.grid_size}, f)
+
+    @staticmethod
+    def open(path: str, mmap_mode: str | None = 'r') -> StaticFixedGrid:
+        with open(os.path.join(path, 'grid.json'), 'r') as f:
+            info = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        return StaticFixedGrid(shapely.box(*info['bounds']), info['grid_size'],
+                               EntryStore.open(os.path.join(path, 'store'), mmap_mode),
+                               load('cell_keys'), load('cell_offsets'), load('rows'))
+
+    def search_rows(self, search_box: BoundaryBox) -> np.ndarray:
+        cell_min_x, cell_min_y = self.get_cell(search_box.x_min, search_box.y_min)
+        cell_max_x, cell_max_y = self.get_cell(search_box.x_max, search_box.y_max)
+
+        # Для каждого столбца сетки ячейки запроса - непрерывный диапазон ключей
+        columns = np.arange(cell_min_x, cell_max_x + 1, dtype=np.int64) * (self.grid_size + 1)
+        low = np.searchsorted(self.cell_keys, columns + cell_min_y, 'left')
+        high = np.searchsorted(self.cell_keys, columns + cell_max_y, 'right')
+
+        rows = np.unique(self.rows[concat_ranges(self.cell_offsets[low], self.cell_offsets[high])])
+
+        store = self.store
+        mask = ((store.x_min[rows] <= search_box.x_max) & (store.x_max[rows] >= search_box.x_min) &
+                (store.y_min[rows] <= search_box.y_max) & (store.y_max[rows] >= search_box.y_min))
+
+        return rows[mask]
+
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return list(self.store.entries(self.search_rows(search_box)))
+
+    def search_ids(self, search: Geometry) -> np.ndarray:
+        search_box = geometry_to_box(search)
 
+        if not self.covers(search_box):
+            return np.empty(0, dtype=np.int64)
 
-def circular_traversal(x_c, y_c, r, grid_size):
-    def circle_points(x, y):
-        return [
-            (x_c + x, y_c + y),
-            (x_c + x, y_c - y),
-            (x_c - x, y_c + y),
-            (x_c - x, y_c - y),
-            (x_c + y, y_c + x),
-            (x_c + y, y_c - x),
-            (x_c - y, y_c + x),
-            (x_c - y, y_c - x),
-        ]
+        rows = self.search_rows(search_box)
+        return self.store.ids[rows[refine_mask(self.store.geometries(rows), self.store.bounds(rows), search)]]
+
+    def search(self, search: Geometry):
+        search_box = geometry_to_box(search)
+
+        if not self.covers(search_box):
+            return None
+
+        rows = self.search_rows(search_box)
+        shapes = self.store.geometries(rows)
+        return list(shapes[refine_mask(shapes, self.store.bounds(rows), search)])
+
+    def covers(self, search_box: BoundaryBox) -> bool:
+        return contains(self, search_box)
+
+    def iter_refined(self, search_box: BoundaryBox, search: Geometry, limit: int | None) -> Iterator[Geometry]:
+        return iter_refine_rows(self.store, self.search_rows(search_box), search, limit)
+
+    def get_cell(self, x, y) -> Tuple[int, int]:
+        return grid_cell(self, x, y)
+
+    def find_nearest_neighbor(self, point: Point):
+        nearest = next(self.nearest_entries(point), None)
+        return nearest[0].shape if nearest is not None else None
+
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        found = []
+        seen = set()
+
+        for cells, bound in cells_by_distance(self, point):
+            rows = [row for x, y in cells for row in self.get_rows_in_cell(x, y).tolist() if row not in seen]
+
+            if len(rows) > 0:
+                rows = list(dict.fromkeys(rows))
+                seen.update(rows)
+
+                for row, row_distance in zip(rows, shapely.distance(self.store.geometries(rows), point).tolist()):
+                    heapq.heappush(found, (row_distance, row))
+
+            while len(found) > 0 and found[0][0] <= bound:
+                row_distance, row = heapq.heappop(found)
+
+                if max_distance is not None and row_distance > max_distance:
+                    return
+
+                yield self.store.entry(row), row_distance
+
+            if max_distance is not None and bound > max_distance:
+                return
+
+    def cell_count(self) -> int:
+        return len(self.cell_keys)
+
+    def occupied_cells(self) -> np.ndarray:
+        keys = np.asarray(self.cell_keys, dtype=np.int64)
+        return np.column_stack((keys // (self.grid_size + 1), keys % (self.grid_size + 1)))
+
+    def get_rows_in_cell(self, x, y) -> np.ndarray:
+        key = x * (self.grid_size + 1) + y
+        i = np.searchsorted(self.cell_keys, key)
+
+        if i == len(self.cell_keys) or self.cell_keys[i] != key:
+            return self.rows[0:0]
+
+        return self.rows[self.cell_offsets[i]:self.cell_offsets[i + 1]]
+
+
+def grid_cell(grid, x, y) -> Tuple[int, int]:
+    """
+    Ячейка сетки с началом в (grid.x_min, grid.y_min): floor((x - x_min) / cell_width) по каждой оси.
+    Ячейки нумеруются от 0 до grid_size включительно (правая/верхняя граница попадает в ячейку grid_size),
+    точки за границей сетки прижимаются к крайним ячейкам.
+    """
+    cell_x = min(max(math.floor((x - grid.x_min) / grid.cell_width), 0), grid.grid_size)
+    cell_y = min(max(math.floor((y - grid.y_min) / grid.cell_height), 0), grid.grid_size)
+    return cell_x, cell_y
+
+
+def square_ring(x_c, y_c, r, grid_size):
+    # Ячейки на расстоянии ровно r по Чебышеву, в пределах 0..grid_size
+    if r == 0:
+        return [(x_c, y_c)]
+
+    x_min, x_max = max(x_c - r, 0), min(x_c + r, grid_size)
+    y_min, y_max = max(y_c - r + 1, 0), min(y_c + r - 1, grid_size)
 
-    x, y = 0, r
-    delta = 3 - 2 * r
     cells = []
 
-    while x <= y:
-        cells.extend(filter(lambda c: (0 <= c[0] < grid_size) and (0 <= c[1] < grid_size), circle_points(x, y)))
+    if y_c - r >= 0:
+        cells.extend((x, y_c - r) for x in range(x_min, x_max + 1))
+    if y_c + r <= grid_size:
+        cells.extend((x, y_c + r) for x in range(x_min, x_max + 1))
+    if x_c - r >= 0:
+        cells.extend((x_c - r, y) for y in range(y_min, y_max + 1))
+    if x_c + r <= grid_size:
+        cells.extend((x_c + r, y) for y in range(y_min, y_max + 1))
 
-        if delta < 0:
-            delta += 4 * x + 6
-        else:
-            delta += 4 * (x - y) + 10
+    return cells
+
+
+def ring_lower_bound(grid, point: Point, cell_x: int, cell_y: int, r: int) -> float:
+    # Нижняя граница расстояния до ячеек на кольце r и дальше:
+    # расстояние от точки до края квадрата из колец 0..r-1 (стороны, упершиеся в край сетки, не учитываем)
+    bounds = []
+
+    if cell_x - r >= 0:
+        bounds.append(point.x - (grid.x_min + (cell_x - r + 1) * grid.cell_width))
+    if cell_x + r <= grid.grid_size:
+        bounds.append(grid.x_min + (cell_x + r) * grid.cell_width - point.x)
+    if cell_y - r >= 0:
+        bounds.append(point.y - (grid.y_min + (cell_y - r + 1) * grid.cell_height))
+    if cell_y + r <= grid.grid_size:
+        bounds.append(grid.y_min + (cell_y + r) * grid.cell_height - point.y)
+
+    return max(0.0, min(bounds)) if len(bounds) > 0 else float('inf')
+
+
+def cells_lower_bounds(grid, point: Point, cells: np.ndarray) -> np.ndarray:
+    # Расстояние от точки до прямоугольников ячеек; крайние ячейки открыты наружу (туда попадает все за границей)
+    low_x = np.where(cells[:, 0] == 0, -np.inf, grid.x_min + cells[:, 0] * grid.cell_width)
+    high_x = np.where(cells[:, 0] == grid.grid_size, np.inf, grid.x_min + (cells[:, 0] + 1) * grid.cell_width)
+    low_y = np.where(cells[:, 1] == 0, -np.inf, grid.y_min + cells[:, 1] * grid.cell_height)
+    high_y = np.where(cells[:, 1] == grid.grid_size, np.inf, grid.y_min + (cells[:, 1] + 1) * grid.cell_height)
+
+    dx = np.maximum(np.maximum(low_x - point.x, point.x - high_x), 0)
+    dy = np.maximum(np.maximum(low_y - point.y, point.y - high_y), 0)
+
+    return np.hypot(dx, dy)
+
+
+def cells_by_distance(grid, point: Point) -> Iterator[Tuple[List[Tuple[int, int]], float]]:
+    """
+    Обход ячеек сетки от точки: выдает пары (ячейки, bound), где bound - нижняя граница расстояния
+    до всех еще не выданных ячеек. Сначала идут квадратные кольца (по Чебышеву); когда кольцо становится
+    больше числа занятых ячеек, оставшиеся занятые ячейки перебираются по возрастанию расстояния,
+    чтобы на разреженной мелкой сетке не проходить тысячи пустых колец.
+    """
+    cell_x, cell_y = grid.get_cell(point.x, point.y)
+    max_radius = max(cell_x, cell_y, grid.grid_size - cell_x, grid.grid_size - cell_y)
+    occupied_count = grid.cell_count()
+
+    for r in range(0, max_radius + 1):
+        if (2 * r + 1) ** 2 > occupied_count:
+            occupied = grid.occupied_cells()
+            rest = occupied[np.maximum(np.abs(occupied[:, 0] - cell_x), np.abs(occupied[:, 1] - cell_y)) >= r]
+
+            lower_bounds = cells_lower_bounds(grid, point, rest)
+            order = np.argsort(lower_bounds, kind='stable')
+
+            for i, j in enumerate(order):
+                bound = lower_bounds[order[i + 1]] if i + 1 < len(order) else float('inf')
+                yield [(int(rest[j, 0]), int(rest[j, 1]))], bound
 
-        x += 1
+            # Занятых ячеек дальше нет - найденное раньше уже окончательно
+            yield [], float('inf')
+            return
 
-    return set(cells)
+        yield square_ring(cell_x, cell_y, r, grid.grid_size), ring_lower_bound(grid, point, cell_x, cell_y, r + 1)
 
 
 def plot_fixed_grid(grid: FixedGrid):
     for i in range(grid.grid_size):
         for j in range(grid.grid_size):
-            x = i * grid.cell_width
-            y = j * grid.cell_height
+            x = grid.x_min + i * grid.cell_width
+            y = grid.y_min + j * grid.cell_height
 
             box = shapely.box(x, y, x + grid.cell_width, y + grid.cell_height)
             add_to_plot_geometry(box, 'black')
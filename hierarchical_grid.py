@@ -1,238 +1,360 @@
-import timeit
-from typing import List, Dict
+from __future__ import annotations
 
+import heapq
+import math
+from bisect import bisect_left
+from typing import List, Dict, Iterator, Tuple
+
+import numpy as np
 import shapely
 from shapely import Geometry, Polygon, Point
 
+import hilbert
 import z_curve
+from common import Entry, BoundaryBox, geometry_to_box, intersection, contains, distance, concat_ranges, refine, \
+    SpatialIndex
 from shapely_plot import add_to_plot_geometry
 
+INF = float('inf')
+
+_LEVEL, _ENTRY = 1, 0
+
+# Запрос, накрывающий не больше стольких ячеек уровня, проверяется по словарю без разложения на отрезки кодов
+DIRECT_LOOKUP_CELLS = 64
+
 
-# TODO Наверное стоит избавиться от z_curve
-class HierarchicalGrid:
-    def __init__(self, boundary: Polygon, grid_size: int = 4, limit_cells: int = 16, levels: int = 4):
+class GridLevel(object):
+    """
+    Один уровень иерархической сетки: (grid_size + 1) x (grid_size + 1) ячеек, ключ ячейки - ее код
+    на Z-кривой или на кривой Гильберта (curve = 'z' | 'hilbert').
+    Кроме словаря ячеек уровень держит отсортированный массив занятых кодов (codes), он перестраивается лениво
+    после вставки в новую ячейку. Для обеих кривых выровненный блок 2^k x 2^k ячеек - непрерывный отрезок кодов,
+    поэтому прямоугольник запроса раскладывается на несколько отрезков, а пустые блоки отсекаются бинарным поиском.
+    extent - MBR всех записей уровня, нижняя граница расстояния до любой записи уровня.
+    """
+
+    def __init__(self, grid_size: int, cell_width: float, cell_height: float, curve: str = 'z'):
+        self.grid_size = grid_size
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.curve = curve
+
+        self.cells: Dict[int, List[Entry]] = {}
+        self.extent: BoundaryBox | None = None
+
+        # Сторона корневого блока - степень двойки, покрывающая индексы 0..grid_size
+        self.bits = grid_size.bit_length()
+        self.root_size = 1 << self.bits
+
+        self._codes = np.empty(0, dtype=np.uint64)
+        self._codes_list: List[int] = []
+        self._dirty = False
+
+    def add(self, entry: Entry):
+        grid_x1, grid_y1 = self.get_cell(entry.x_min, entry.y_min)
+        grid_x2, grid_y2 = self.get_cell(entry.x_max, entry.y_max)
+
+        for x in range(grid_x1, grid_x2 + 1):
+            for y in range(grid_y1, grid_y2 + 1):
+                cell_id = self.encode(x, y)
+                if cell_id not in self.cells:
+                    self.cells[cell_id] = []
+                    self._dirty = True
+
+                self.cells[cell_id].append(entry)
+
+        if self.extent is None:
+            self.extent = BoundaryBox(entry.x_min, entry.y_min, entry.x_max, entry.y_max)
+        else:
+            self.extent.extend(entry)
+
+    @property
+    def codes(self) -> np.ndarray:
+        self.refresh_codes()
+        return self._codes
+
+    def refresh_codes(self):
+        if self._dirty:
+            self._codes = np.sort(np.fromiter(self.cells.keys(), dtype=np.uint64, count=len(self.cells)))
+            # Копия списком: для одиночных проверок bisect быстрее вызова numpy
+            self._codes_list = self._codes.tolist()
+            self._dirty = False
+
+    def encode(self, x: int, y: int) -> int:
+        if self.curve == 'hilbert':
+            return hilbert.hilbert_encode(x, y, self.bits)
+        return z_curve.z_encode(x, y)
+
+    def decode(self, code: int) -> Tuple[int, int]:
+        if self.curve == 'hilbert':
+            return hilbert.hilbert_decode(code, self.bits)
+        return z_curve.z_decode(code)
+
+    def get_cell(self, x, y) -> Tuple[int, int]:
+        cell_x = min(max(int(x // self.cell_width), 0), self.grid_size)
+        cell_y = min(max(int(y // self.cell_height), 0), self.grid_size)
+        return cell_x, cell_y
+
+    def get_objects_in_cell(self, x, y) -> List[Entry]:
+        return self.cells.get(self.encode(x, y), [])
+
+    def cell_count(self) -> int:
+        return len(self.cells)
+
+    def occupied(self, block_x: int, block_y: int, size: int) -> bool:
+        self.refresh_codes()
+        codes = self._codes_list
+        # Начало отрезка блока: код любой его ячейки без младших 2k бит
+        low = self.encode(block_x, block_y) & ~(size * size - 1)
+        i = bisect_left(codes, low)
+        return i < len(codes) and codes[i] < low + size * size
+
+    def code_runs(self, cell_min_x, cell_min_y, cell_max_x, cell_max_y) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Отрезки кодов [start, end), из которых состоит прямоугольник ячеек.
+        Блоки, целиком лежащие в прямоугольнике, дают один отрезок; пустые блоки не раскладываются дальше.
+        """
+        starts, ends = [], []
+        stack = [(0, 0, self.root_size)]
+
+        while len(stack) > 0:
+            block_x, block_y, size = stack.pop()
+
+            if (block_x > cell_max_x or block_x + size - 1 < cell_min_x or
+                    block_y > cell_max_y or block_y + size - 1 < cell_min_y):
+                continue
+
+            if not self.occupied(block_x, block_y, size):
+                continue
+
+            if (cell_min_x <= block_x and block_x + size - 1 <= cell_max_x and
+                    cell_min_y <= block_y and block_y + size - 1 <= cell_max_y):
+                low = self.encode(block_x, block_y) & ~(size * size - 1)
+
+                # Соседние по кривой блоки склеиваются в один отрезок
+                if len(ends) > 0 and ends[-1] == low:
+                    ends[-1] = low + size * size
+                else:
+                    starts.append(low)
+                    ends.append(low + size * size)
+                continue
+
+            half = size // 2
+            # В стек в обратном Z-порядке, чтобы для Z-кривой отрезки получались по возрастанию
+            stack.extend([(block_x + half, block_y + half, half), (block_x, block_y + half, half),
+                          (block_x + half, block_y, half), (block_x, block_y, half)])
+
+        return np.array(starts, dtype=np.uint64), np.array(ends, dtype=np.uint64)
+
+    def search_candidates(self, search_box: BoundaryBox) -> Iterator[Entry]:
+        cell_min_x, cell_min_y = self.get_cell(search_box.x_min, search_box.y_min)
+        cell_max_x, cell_max_y = self.get_cell(search_box.x_max, search_box.y_max)
+
+        # Маленький запрос дешевле проверить по ячейкам напрямую
+        if (cell_max_x - cell_min_x + 1) * (cell_max_y - cell_min_y + 1) <= DIRECT_LOOKUP_CELLS:
+            for x in range(cell_min_x, cell_max_x + 1):
+                for y in range(cell_min_y, cell_max_y + 1):
+                    yield from self.get_objects_in_cell(x, y)
+            return
+
+        codes = self.codes
+        starts, ends = self.code_runs(cell_min_x, cell_min_y, cell_max_x, cell_max_y)
+
+        low = np.searchsorted(codes, starts, 'left')
+        high = np.searchsorted(codes, ends, 'left')
+
+        for code in codes[concat_ranges(low, high)].tolist():
+            yield from self.cells[code]
+
+    def block_lower_bound(self, point: Point, block_x: int, block_y: int, size: int) -> float:
+        # Крайние ячейки открыты наружу (туда попадает все за границей)
+        low_x = -INF if block_x == 0 else block_x * self.cell_width
+        high_x = INF if block_x + size > self.grid_size else (block_x + size) * self.cell_width
+        low_y = -INF if block_y == 0 else block_y * self.cell_height
+        high_y = INF if block_y + size > self.grid_size else (block_y + size) * self.cell_height
+
+        dx = max(low_x - point.x, point.x - high_x, 0.0)
+        dy = max(low_y - point.y, point.y - high_y, 0.0)
+
+        return math.hypot(dx, dy)
+
+    def cells_by_distance(self, point: Point) -> Iterator[Tuple[List[int], float]]:
+        """
+        Занятые ячейки по возрастанию расстояния: best-first по блокам квадродерева над кодами ячеек.
+        Выдает пары (коды ячеек, bound), где bound - нижняя граница расстояния до еще не выданных ячеек.
+        Пустые блоки отсекаются сразу, поэтому пустые кольца вокруг точки не перебираются.
+        """
+        heap = []
+        counter = 0
+
+        if self.occupied(0, 0, self.root_size):
+            heap.append((self.block_lower_bound(point, 0, 0, self.root_size), counter, (0, 0, self.root_size)))
+            counter += 1
+
+        while len(heap) > 0:
+            _, _, (block_x, block_y, size) = heapq.heappop(heap)
+
+            if size == 1:
+                yield [self.encode(block_x, block_y)], heap[0][0] if len(heap) > 0 else INF
+                continue
+
+            half = size // 2
+
+            for x, y in [(block_x, block_y), (block_x + half, block_y),
+                         (block_x, block_y + half), (block_x + half, block_y + half)]:
+                if x <= self.grid_size and y <= self.grid_size and self.occupied(x, y, half):
+                    heapq.heappush(heap, (self.block_lower_bound(point, x, y, half), counter, (x, y, half)))
+                    counter += 1
+
+
+class HierarchicalGrid(SpatialIndex):
+    def __init__(self, boundary: Polygon, grid_size: int = 4, limit_cells: int = 16, levels: int = 4,
+                 curve: str = 'z'):
         self.boundary = boundary
         self.grid_size = grid_size
 
         minx, miny, maxx, maxy = boundary.bounds
+        self.bounds = BoundaryBox(minx, miny, maxx, maxy)
 
         self.width = maxx - minx
         self.height = maxy - miny
 
         self.limit_cells = limit_cells
         self.levels = levels
-        self.grids: List[Dict[int, List[Geometry]]] = [{} for _ in range(levels)]
+        self.grids: List[GridLevel] = [
+            GridLevel(pow(grid_size, level + 1),
+                      self.width / pow(grid_size, level + 1),
+                      self.height / pow(grid_size, level + 1),
+                      curve)
+            for level in range(levels)]
 
     def add_object(self, obj: Geometry):
-        minx, miny, maxx, maxy = Polygon(shapely.envelope(obj)).bounds
+        self.insert(Entry(obj))
+
+    def insert(self, entry: Entry):
+        if not contains(self.bounds, entry):
+            raise ValueError("ElementOutside")
 
         for level in range(self.levels):
+            grid = self.grids[level]
 
-            cell_width = self.width / pow(self.grid_size, level + 1)
-            cell_height = self.height / pow(self.grid_size, level + 1)
+            next_cell_width = grid.cell_width / self.grid_size
+            next_cell_height = grid.cell_height / self.grid_size
 
-            grid_x1_on_next = int(minx // (cell_width / self.grid_size))
-            grid_y1_on_next = int(miny // (cell_height / self.grid_size))
-            grid_x2_on_next = int(maxx // (cell_width / self.grid_size))
-            grid_y2_on_next = int(maxy // (cell_height / self.grid_size))
+            grid_x1_on_next = int(entry.x_min // next_cell_width)
+            grid_y1_on_next = int(entry.y_min // next_cell_height)
+            grid_x2_on_next = int(entry.x_max // next_cell_width)
+            grid_y2_on_next = int(entry.y_max // next_cell_height)
 
             covered_on_next = (grid_x2_on_next - grid_x1_on_next + 1) * (grid_y2_on_next - grid_y1_on_next + 1)
 
             # Если след уровень превышает ограничение, то останавливаемся на текущем
             if covered_on_next >= self.limit_cells or level == self.levels - 1:
+                grid.add(entry)
+                break
 
-                grid_x1, grid_y1 = int(minx // cell_width), int(miny // cell_height)
-                grid_x2, grid_y2 = int(maxx // cell_width), int(maxy // cell_height)
+    def get_objects_in_cell(self, level, cell_id):
+        return self.grids[level].cells.get(cell_id, [])
 
-                for x in range(grid_x1, grid_x2 + 1):
-                    for y in range(grid_y1, grid_y2 + 1):
-                        cell_id = z_curve.z_encode(x, y)
-                        if cell_id not in self.grids[level]:
-                            self.grids[level][cell_id] = []
+    def search(self, search: Geometry):
+        return refine(self.search_candidates(geometry_to_box(search)), search)
 
-                        self.grids[level][cell_id].append(obj)
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return list(self.iter_candidates(search_box))
 
-                break
+    def iter_candidates(self, search_box: BoundaryBox) -> Iterator[Entry]:
+        seen = set()
 
-    def get_objects_in_cell(self, level, cell_id):
-        return self.grids[level].get(cell_id, [])
+        # Каждый уровень: только накрытые запросом ячейки, запись с нескольких ячеек берется один раз
+        for grid in self.grids:
+            if grid.extent is None or not intersection(grid.extent, search_box):
+                continue
 
+            for entry in grid.search_candidates(search_box):
+                if id(entry) not in seen and intersection(entry, search_box):
+                    seen.add(id(entry))
+                    yield entry
 
-def build_hierarchical_grid(boundary: Polygon, shapes: List[shapely.Geometry], grid_size: int = 4, limit_cells: int = 16,
-                     levels: int = 4):
-    grid = HierarchicalGrid(boundary, grid_size, limit_cells, levels)
+    def find_nearest_neighbor(self, point: Point):
+        nearest = next(self.nearest_entries(point), None)
+        return nearest[0].shape if nearest is not None else None
 
-    for shape in shapes:
-        grid.add_object(shape)
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        """
+        Общая куча для всех уровней: в ней лежат найденные записи (точное расстояние)
+        и обходы уровней (нижняя граница расстояния до еще не просмотренных ячеек).
+        Уровень начинает обходиться только когда до MBR его записей дошла очередь,
+        поэтому уровни дальше уже найденного ближайшего не просматриваются совсем.
+        """
+        heap = []
+        counter = 0
+        seen = set()
 
-    return grid
+        for grid in self.grids:
+            if grid.extent is not None:
+                heap.append((distance(grid.extent, point), _LEVEL, counter, (grid, None)))
+                counter += 1
 
+        heapq.heapify(heap)
 
-def hierarchical_grid_find_nearest_neighbor(grid: HierarchicalGrid, point: Point):
-    min_distance = float('inf')
-    nearest_neighbor = None
-
-    query_x, query_y = point.x, point.y
-
-    for level in range(0, grid.levels):
-
-        if len(grid.grids[level]) == 0:
-            continue
-
-        cell_width = grid.width / pow(grid.grid_size, level + 1)
-        cell_height = grid.height / pow(grid.grid_size, level + 1)
-
-        cell_x, cell_y = int(query_x // cell_width), int(query_y // cell_height)
-
-        # Содержащая ячейка и ячейки вокруг нее
-        nearest_cells = [(cell_x, cell_y), *circular_traversal(cell_x, cell_y, 1)]
-
-        # TODO Нужен distinct ???
-
-        neighbors = [cc for c in nearest_cells for cc in grid.grids[level].get(z_curve.z_encode(c[0], c[1]), [])]
-
-        neighbor, distance = get_nearest(neighbors, point)
-
-        if distance < min_distance:
-            nearest_neighbor = neighbor
-            min_distance = distance
-
-        # TODO Подумать
-        #  Перебор ближайших
-        #  Возможно полный перебор будет быстрее (см ниже полный перебор)
-
-        # Если в смежных ячейках нет соседей, то бежим по остальным
-        if neighbor is None:
-
-            max_x_radius = max(cell_x, pow(grid.grid_size, level + 1) - cell_x)
-            max_y_radius = max(cell_y, pow(grid.grid_size, level + 1) - cell_y)
-            max_radius = max(max_x_radius, max_y_radius)
-
-            # Бежим с 2ки, тк в ближайшее заходили выше
-            for r in range(2, max_radius + 1):
-                # Если расстояние до след ячеек уже больше чем до ближайшего соседа
-                if max(r * cell_width, r * cell_height) > min_distance:
-                    break
-
-                nearest_cells = circular_traversal(cell_x, cell_y, r)
-
-                neighbors = [cc for c in nearest_cells for cc in
-                             grid.grids[level].get(z_curve.z_encode(c[0], c[1]), [])]
-
-                neighbor, distance = get_nearest(neighbors, point)
+        while len(heap) > 0:
+            item_distance, kind, _, item = heapq.heappop(heap)
+
+            if max_distance is not None and item_distance > max_distance:
+                return
+
+            if kind == _ENTRY:
+                yield item, item_distance
+                continue
+
+            grid, cells_iter = item
+            if cells_iter is None:
+                cells_iter = grid.cells_by_distance(point)
+
+            step = next(cells_iter, None)
+            if step is None:
+                continue
+
+            cells, bound = step
+
+            for code in cells:
+                for entry in grid.cells[code]:
+                    if id(entry) in seen:
+                        continue
+                    seen.add(id(entry))
 
-                # Ближайших на этом уровне, дальше можно не искать
-                if neighbor is not None:
+                    heapq.heappush(heap, (shapely.distance(entry.shape, point), _ENTRY, counter, entry))
+                    counter += 1
 
-                    if distance < min_distance:
-                        nearest_neighbor = neighbor
-                        min_distance = distance
+            if bound < INF:
+                heapq.heappush(heap, (bound, _LEVEL, counter, (grid, cells_iter)))
+                counter += 1
 
-                    break
 
-        # TODO Подумать
-        #  Полный перебор:
-        #  Может он выгоднее? Бегать только по ячейкам в которых есть записи
-        #  Без него в получения в самой удаленной точке будет хуже
-        #  Да и если ячейки в БД, то может проще сразу все получить, их не так много
-        # if neighbor is None:
-        #
-        #     c_cell_x = cell_x + cell_width / 2
-        #     c_cell_y = cell_y + cell_height / 2
-        #
-        #     nearest_cells = []
-        #
-        #     square_min_distance = float('inf')
-        #
-        #     # TODO Подумать
-        #     #  Добавить какой-то радиус? Все ячейки может быть много для последнего уровня
-        #     #  Сначала в этом радиусе получать, а потом увеличивать?
-        #     for (key, cell) in grid.grids[level].items():
-        #         (x, y) = z_curve.z_decode(key)
-        #         c_x = x + cell_width / 2
-        #         c_y = y + cell_height / 2
-        #
-        #         distance = square_distance(c_cell_x, c_cell_y, c_x, c_y)
-        #
-        #         if distance < square_min_distance:
-        #             square_min_distance = distance
-        #             nearest_cells = [cell]
-        #
-        #         if distance == square_min_distance:
-        #             nearest_cells.append(cell)
-        #
-        #     if len(nearest_cells) == 0:
-        #         continue
-        #
-        #     neighbors = [cc for c in nearest_cells for cc in c]
-        #
-        #     neighbor, distance = get_nearest(neighbors, point)
-        #
-        #     if distance < min_distance:
-        #         nearest_neighbor = neighbor
-        #         min_distance = distance
+def build_hierarchical_grid(boundary: Polygon, shapes: List[shapely.Geometry], grid_size: int = 4, limit_cells: int = 16,
+                     levels: int = 4, curve: str = 'z'):
+    grid = HierarchicalGrid(boundary, grid_size, limit_cells, levels, curve)
 
-    return nearest_neighbor
+    for shape in shapes:
+        grid.add_object(shape)
 
-
-def square_distance(x1, y1, x2, y2):
-    return (x2 - x1) ** 2 + (y2 - y1) ** 2
-
-
-def circular_traversal(x_c, y_c, r):
-    x = 0
-    y = r
-    delta = 3 - 2 * y
-
-    cells = []
-
-    while x <= y:
-        cells.append((x_c + x, y_c + y))
-        cells.append((x_c + x, y_c - y))
-        cells.append((x_c - x, y_c + y))
-        cells.append((x_c - x, y_c - y))
-        cells.append((x_c + y, y_c + x))
-        cells.append((x_c + y, y_c - x))
-        cells.append((x_c - y, y_c + x))
-        cells.append((x_c - y, y_c - x))
-
-        delta += 4 * x + 6 if delta < 0 else 4 * (x - y - 1) + 10
-        x += 1
-
-    return cells
-
-
-def get_nearest(neighbors: List[Geometry], point: Point):
-    min_distance = float('inf')
-    nearest = None
-
-    for neighbor in neighbors:
-        # TODO Дистанцию считать от MBR
-        #  Подумать:
-        #  Если до MBR ближе, то и до фигуры ближе?
-        #  А если точка содержится в MBR, то может быть что до другой фигуры будет ближе
-        distance = shapely.distance(point, neighbor)
-
-        if distance < min_distance:
-            min_distance = distance
-            nearest = neighbor
-
-    return nearest, min_distance
+    return grid
+
+
+def hierarchical_grid_find_nearest_neighbor(grid: HierarchicalGrid, point: Point):
+    return grid.find_nearest_neighbor(point)
 
 
 def plot_hierarchical_grid(grid: HierarchicalGrid):
-    for level in range(grid.levels):
-        cells = grid.grids[level]
-        for (key, cell) in cells.items():
-            xmin, ymin = z_curve.z_decode(key)
+    for level in grid.grids:
+        for (key, cell) in level.cells.items():
+            xmin, ymin = level.decode(key)
 
-            width = grid.width / pow(grid.grid_size, level + 1)
-            height = grid.height / pow(grid.grid_size, level + 1)
-            xmin = xmin * width
-            ymin = ymin * height
+            xmin = xmin * level.cell_width
+            ymin = ymin * level.cell_height
 
-            box = shapely.box(xmin, ymin, xmin + width, ymin + height)
+            box = shapely.box(xmin, ymin, xmin + level.cell_width, ymin + level.cell_height)
             add_to_plot_geometry(box, 'black')
 
-            for shape in cell:
-                add_to_plot_geometry(shape, 'orange')
+            for entry in cell:
+                add_to_plot_geometry(entry.shape, 'orange')
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import numpy as np
+
+from z_curve import quantize
+
+# Кривая Гильберта на сетке 2^bits x 2^bits. В отличие от Z-кривой соседние коды всегда соседние ячейки,
+# но, как и у Z-кривой, выровненный блок 2^k x 2^k - непрерывный отрезок кодов длины 4^k.
+# API повторяет z_curve: скалярные hilbert_encode/hilbert_decode и векторные *_many над uint64 (до 32 бит на ось).
+
+
+def hilbert_encode(x, y, bits: int = 32):
+    n = 1 << bits
+    d = 0
+    s = n >> 1
+
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+
+        # Поворот четверти, чтобы следующий уровень шел в том же порядке
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+
+        s >>= 1
+
+    return d
+
+
+def hilbert_decode(d, bits: int = 32):
+    x = y = 0
+    s = 1
+
+    while s < (1 << bits):
+        rx = 1 & (d >> 1)
+        ry = 1 & (d ^ rx)
+
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+
+        x += s * rx
+        y += s * ry
+
+        d >>= 2
+        s <<= 1
+
+    return (x, y)
+
+
+def hilbert_encode_many(xs, ys, bits: int = 32) -> np.ndarray:
+    x = np.array(xs, dtype=np.uint64)
+    y = np.array(ys, dtype=np.uint64)
+    d = np.zeros(x.shape, dtype=np.uint64)
+
+    full = np.uint64((1 << bits) - 1)
+
+    for level in range(bits - 1, -1, -1):
+        s = np.uint64(1 << level)
+
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += (s * s) * ((3 * rx.astype(np.uint64)) ^ ry.astype(np.uint64))
+
+        flip = ~ry & rx
+        x = np.where(flip, full - x, x)
+        y = np.where(flip, full - y, y)
+
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+
+    return d
+
+
+def hilbert_decode_many(codes, bits: int = 32) -> (np.ndarray, np.ndarray):
+    t = np.array(codes, dtype=np.uint64)
+    x = np.zeros(t.shape, dtype=np.uint64)
+    y = np.zeros(t.shape, dtype=np.uint64)
+
+    for level in range(bits):
+        s = np.uint64(1 << level)
+
+        rx = np.uint64(1) & (t >> np.uint64(1))
+        ry = np.uint64(1) & (t ^ rx)
+
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, s - np.uint64(1) - x, x)
+        y = np.where(flip, s - np.uint64(1) - y, y)
+
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+
+        x = x + s * rx
+        y = y + s * ry
+
+        t = t >> np.uint64(2)
+
+    return x, y
+
+
+def hilbert_encode_in_box(xs, ys, box, bits: int = 32) -> np.ndarray:
+    """
+    Коды Гильберта точек с вещественными координатами: координаты квантуются на сетку 2^bits x 2^bits
+    внутри box (BoundaryBox или любой объект с x_min, y_min, x_max, y_max).
+    """
+    return hilbert_encode_many(quantize(xs, box.x_min, box.x_max, bits), quantize(ys, box.y_min, box.y_max, bits),
+                               bits)
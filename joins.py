@@ -0,0 +1,590 @@
+from __future__ import annotations
+
+import heapq
+import math
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import shapely
+
+from common import Entry, intersection, entry_ids, entry_boxes
+from kd_tree_point import ImplicitKDTree
+from r_tree import RTree
+from sweep import iter_overlapping_pairs, iter_self_overlapping_pairs
+
+# Сколько пар-кандидатов копится перед векторной проверкой точного предиката и выдачей пачки
+JOIN_BATCH_SIZE = 4096
+
+JOIN_PREDICATES = ('intersects', 'contains', 'within')
+
+# До какого числа пар списки записей сравниваются полным перебором, а не заметанием
+DENSE_PAIRS_LIMIT = 4096
+
+# Вместимость узлов R-дерева, в которое k-NN соединение упаковывает эталон без собственных узлов
+KNN_PACK_CAPACITY = 16
+
+# Сколько записей эталона копится у листа запросов перед одним векторным слиянием в k лучших
+KNN_MERGE_SIZE = 64
+
+# Узел эталона делится в общем обходе, только если его MBR во столько раз больше MBR узла запросов,
+# иначе узел запросов спускается до листа и дальше эталон обходится best-first от этого узла
+KNN_SPLIT_RATIO = 16
+
+
+def is_entry_index(index) -> bool:
+    # Индексы объектов (деревья, сетки, BruteForce, ZOrderIndex) отдают кандидатов-записи по MBR
+    return hasattr(index, 'search_candidates')
+
+
+def as_point_tree(points) -> ImplicitKDTree:
+    """
+    ImplicitKDTree из дерева (как есть), массива координат (n, 2), списка точек shapely
+    или объектного индекса (точки - центроиды его записей, ids - id записей).
+    """
+    if isinstance(points, ImplicitKDTree):
+        return points
+
+    if is_entry_index(points):
+        entries = index_entries(points)
+        centroids = shapely.centroid(np.array([e.shape for e in entries], dtype=object))
+        return ImplicitKDTree.build(np.column_stack((shapely.get_x(centroids), shapely.get_y(centroids))),
+                                    entry_ids(entries))
+
+    points = np.asarray(points)
+
+    if points.dtype == object:
+        points = shapely.get_coordinates(points)
+
+    return ImplicitKDTree.build(points.reshape(-1, 2))
+
+
+def boxes_distance(a, b) -> float:
+    # a, b - (x_min, y_min, x_max, y_max)
+    dx = max(a[0] - b[2], b[0] - a[2], 0.0)
+    dy = max(a[1] - b[3], b[1] - a[3], 0.0)
+    return math.hypot(dx, dy)
+
+
+def knn_join(queries, reference, k: int = 1, max_distance: float | None = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Для каждой точки queries - k ближайших записей reference: массивы (n, k) id и расстояний, как find_nearest_many.
+    Строки идут в порядке ids дерева запросов (для массива или списка точек - в исходном порядке,
+    для объектного индекса запросов - по возрастанию id записей, точка запроса - центроид записи).
+    Если соседей меньше k (или они дальше max_distance), хвост заполняется id = -1 и расстоянием inf.
+
+    Оба набора обходятся одновременно (dual-tree): пара узлов (запрос, эталон) отбрасывается, когда расстояние
+    между их MBR больше границы узла запросов - наибольшего из k-х расстояний его точек.
+    reference - ImplicitKDTree, точки или объектный индекс: у деревьев обходятся их узлы (expand()),
+    остальные индексы (сетки, BruteForce, ZOrderIndex) на время соединения упаковываются в STR R-дерево.
+    """
+    query_tree = as_point_tree(queries)
+
+    if is_entry_index(reference):
+        distances, ids = dual_tree_knn_nodes(query_tree, index_root(reference), k, max_distance)
+    else:
+        reference_tree = as_point_tree(reference)
+        distances, positions = dual_tree_knn(query_tree, reference_tree, k, max_distance)
+        ids = np.where(positions >= 0, reference_tree.ids[np.maximum(positions, 0)], -1)
+
+    # Из порядка точек в дереве запросов - в порядке их ids
+    order = np.argsort(query_tree.ids, kind='stable')
+
+    return ids[order], distances[order]
+
+
+def index_root(index):
+    # Корень дерева индекса; индекс без узлов упаковывается в R-дерево по всем своим записям
+    if hasattr(index, 'root'):
+        return index.root
+
+    return RTree(KNN_PACK_CAPACITY).bulk_load(index_entries(index)).root
+
+
+def _merge_leaf(best_distances: np.ndarray, best_keys: np.ndarray, qs: int, qe: int, distances: np.ndarray,
+                keys: np.ndarray, k: int, unique: bool = False) -> float:
+    """
+    Добавляет к k лучшим точкам запросов qs..qe кандидатов keys с расстояниями distances (qe - qs, len(keys)).
+    unique - одна запись могла прийти раньше из другого листа: повтор в строке отбрасывается.
+    Возвращает новую границу листа - наибольшее из k-х расстояний.
+    """
+    merged_distances = np.concatenate((best_distances[qs:qe], distances), axis=1)
+    merged_keys = np.concatenate((best_keys[qs:qe], np.broadcast_to(keys, distances.shape)), axis=1)
+
+    if unique:
+        order = np.argsort(merged_keys, axis=1, kind='stable')
+        sorted_keys = np.take_along_axis(merged_keys, order, axis=1)
+        rows, columns = np.nonzero((sorted_keys[:, 1:] == sorted_keys[:, :-1]) & (sorted_keys[:, 1:] >= 0))
+
+        merged_distances[rows, order[rows, columns + 1]] = np.inf
+        merged_keys[rows, order[rows, columns + 1]] = -1
+
+    keep = np.argpartition(merged_distances, k - 1, axis=1)[:, :k]
+    best_distances[qs:qe] = np.take_along_axis(merged_distances, keep, axis=1)
+    best_keys[qs:qe] = np.take_along_axis(merged_keys, keep, axis=1)
+
+    return float(best_distances[qs:qe].max())
+
+
+def _tighten(bound: List[float], q: int, value: float):
+    # Новая граница листа поднимается к корню (нумерация кучи), пока она меняет границы предков
+    bound[q] = min(bound[q], value)
+
+    while q > 0:
+        q = (q - 1) // 2
+        value = max(bound[2 * q + 1], bound[2 * q + 2])
+
+        if value >= bound[q]:
+            break
+
+        bound[q] = value
+
+
+def _initial_bounds(query_tree: ImplicitKDTree, max_distance: float | None) -> List[float]:
+    # Граница узла запросов: ни одна его точка не ищет соседей дальше нее. У пустых узлов - -inf
+    initial = math.inf if max_distance is None else max_distance
+    return [initial if end > start else -math.inf
+            for start, end in zip(query_tree.node_start.tolist(), query_tree.node_end.tolist())]
+
+
+def _sorted_knn(best_distances: np.ndarray, best_keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(best_distances, axis=1, kind='stable')
+    return np.take_along_axis(best_distances, order, axis=1), np.take_along_axis(best_keys, order, axis=1)
+
+
+def dual_tree_knn(query_tree: ImplicitKDTree, reference_tree: ImplicitKDTree, k: int,
+                  max_distance: float | None = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Массивы (n, k) расстояний и позиций в reference_tree.points для точек query_tree (в порядке query_tree.points).
+    """
+    n = len(query_tree)
+
+    best_distances = np.full((n, k), np.inf)
+    best_positions = np.full((n, k), -1, dtype=np.int64)
+
+    if n == 0 or len(reference_tree) == 0 or k <= 0:
+        return best_distances, best_positions
+
+    query_points, reference_points = query_tree.points, reference_tree.points
+    query_start, query_end = query_tree.node_start.tolist(), query_tree.node_end.tolist()
+    reference_start, reference_end = reference_tree.node_start.tolist(), reference_tree.node_end.tolist()
+    query_bounds, reference_bounds = query_tree.node_bounds.tolist(), reference_tree.node_bounds.tolist()
+
+    query_count, reference_count = len(query_start), len(reference_start)
+
+    bound = _initial_bounds(query_tree, max_distance)
+
+    stack = [(0, 0)]
+
+    while len(stack) > 0:
+        q, r = stack.pop()
+
+        if boxes_distance(query_bounds[q], reference_bounds[r]) > bound[q]:
+            continue
+
+        query_leaf = 2 * q + 1 >= query_count
+        reference_leaf = 2 * r + 1 >= reference_count
+
+        if query_leaf and reference_leaf:
+            qs, qe = query_start[q], query_end[q]
+            rs, re = reference_start[r], reference_end[r]
+
+            block = query_points[qs:qe]
+            pair_distances = np.hypot(block[:, 0, None] - reference_points[None, rs:re, 0],
+                                      block[:, 1, None] - reference_points[None, rs:re, 1])
+
+            if max_distance is not None:
+                pair_distances[pair_distances > max_distance] = np.inf
+
+            _tighten(bound, q, _merge_leaf(best_distances, best_positions, qs, qe, pair_distances,
+                                           np.arange(rs, re), k))
+            continue
+
+        # Делим узел, который не является листом (при выборе - больший по числу точек)
+        if reference_leaf or (not query_leaf and query_end[q] - query_start[q] >= reference_end[r] - reference_start[r]):
+            for child in (2 * q + 2, 2 * q + 1):
+                if query_end[child] > query_start[child]:
+                    stack.append((child, r))
+        else:
+            children = [child for child in (2 * r + 1, 2 * r + 2) if reference_end[child] > reference_start[child]]
+
+            # Ближний узел эталона кладется последним, чтобы обработать его первым и быстрее сузить границу
+            children.sort(key=lambda c: boxes_distance(query_bounds[q], reference_bounds[c]), reverse=True)
+            stack.extend((q, child) for child in children)
+
+    return _sorted_knn(best_distances, best_positions)
+
+
+def _box(box) -> Tuple[float, float, float, float]:
+    return box.x_min, box.y_min, box.x_max, box.y_max
+
+
+def _box_size(box) -> float:
+    return math.hypot(box[2] - box[0], box[3] - box[1])
+
+
+def dual_tree_knn_nodes(query_tree: ImplicitKDTree, root, k: int,
+                        max_distance: float | None = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Массивы (n, k) расстояний и id записей для точек query_tree (в порядке query_tree.points),
+    эталон - дерево объектов: узлы с expand(), возвращающим (записи узла, дочерние узлы).
+    Пары (узел запросов, узел эталона) отсекаются по расстоянию между MBR; записи узла эталона идут пачкой
+    с общим MBR и сравниваются с листом запросов точно (для точек - по координатам, иначе shapely.distance).
+    Узел эталона делится, только если он намного больше узла запросов (KNN_SPLIT_RATIO), пачка спускается
+    по запросам; дойдя до листа запросов, эталон обходится best-first, а пачки сливаются в k лучших вместе.
+    """
+    n = len(query_tree)
+
+    best_distances = np.full((n, k), np.inf)
+    best_keys = np.full((n, k), -1, dtype=np.int64)
+
+    if n == 0 or k <= 0:
+        return best_distances, best_keys
+
+    query_points = query_tree.points
+    query_start, query_end = query_tree.node_start.tolist(), query_tree.node_end.tolist()
+    query_bounds = query_tree.node_bounds.tolist()
+    query_count = len(query_start)
+    query_shapes = None
+
+    bound = _initial_bounds(query_tree, max_distance)
+
+    # Номер (key) каждой записи эталона; повтор записи (R+-дерево) включает удаление повторов при слиянии
+    entries: List[Entry] = []
+    keys = {}
+    repeated = False
+
+    # Пачка записей узла строится один раз и переиспользуется для всех узлов запросов
+    bundles = {}
+
+    def bundle(node, node_entries: List[Entry]):
+        nonlocal repeated
+
+        if id(node) in bundles:
+            return bundles[id(node)]
+
+        bundle_keys = []
+        for entry in node_entries:
+            key = keys.get(id(entry))
+
+            if key is None:
+                key = keys[id(entry)] = len(entries)
+                entries.append(entry)
+            else:
+                repeated = True
+
+            bundle_keys.append(key)
+
+        boxes = entry_boxes(node_entries)
+        points = bool(((boxes[:, 0] == boxes[:, 2]) & (boxes[:, 1] == boxes[:, 3])).all())
+        shapes = None if points else np.array([e.shape for e in node_entries], dtype=object)
+        box = (boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+
+        bundles[id(node)] = box, (np.array(bundle_keys, dtype=np.int64), boxes, shapes)
+        return bundles[id(node)]
+
+    def merge(q: int, items):
+        # Все накопленные пачки сравниваются с листом запросов q и сливаются в k лучших за один шаг
+        nonlocal query_shapes
+
+        qs, qe = query_start[q], query_end[q]
+        parts = []
+
+        for bundle_keys, boxes, shapes in items:
+            if shapes is None:
+                block = query_points[qs:qe]
+                parts.append(np.hypot(block[:, 0, None] - boxes[None, :, 0], block[:, 1, None] - boxes[None, :, 1]))
+            else:
+                if query_shapes is None:
+                    query_shapes = shapely.points(query_points)
+                parts.append(shapely.distance(shapes[None, :], query_shapes[qs:qe, None]))
+
+        pair_distances = np.concatenate(parts, axis=1)
+
+        if max_distance is not None:
+            pair_distances[pair_distances > max_distance] = np.inf
+
+        merged_keys = np.concatenate([bundle_keys for bundle_keys, _, _ in items])
+        _tighten(bound, q, _merge_leaf(best_distances, best_keys, qs, qe, pair_distances, merged_keys, k, repeated))
+
+    def expand(node) -> list:
+        # (MBR, узел или пачка) для детей узла эталона и пачки его собственных записей
+        node_entries, children = node.expand()
+
+        items = [(_box(child), child) for child in children]
+        if len(node_entries) > 0:
+            items.append(bundle(node, node_entries))
+
+        return items
+
+    def leaf_search(q: int, box, node):
+        # Лист запросов против поддерева эталона: best-first по расстоянию между MBR,
+        # пачки копятся и сливаются вместе (не меньше KNN_MERGE_SIZE записей), после чего граница сужается
+        query_box = query_bounds[q]
+        heap = [(boxes_distance(query_box, box), 0, node)]
+        counter = 1
+        pending, pending_size = [], 0
+
+        while len(heap) > 0:
+            item_distance, _, item = heap[0]
+
+            if item_distance > bound[q]:
+                if len(pending) == 0:
+                    break
+
+                merge(q, pending)
+                pending, pending_size = [], 0
+                continue
+
+            heapq.heappop(heap)
+
+            if isinstance(item, tuple):
+                pending.append(item)
+                pending_size += len(item[0])
+
+                if pending_size >= KNN_MERGE_SIZE:
+                    merge(q, pending)
+                    pending, pending_size = [], 0
+                continue
+
+            for child_box, child in expand(item):
+                child_distance = boxes_distance(query_box, child_box)
+
+                if child_distance <= bound[q]:
+                    heapq.heappush(heap, (child_distance, counter, child))
+                    counter += 1
+
+        if len(pending) > 0:
+            merge(q, pending)
+
+    stack = [(0, _box(root), root)]
+
+    while len(stack) > 0:
+        q, box, item = stack.pop()
+
+        if boxes_distance(query_bounds[q], box) > bound[q]:
+            continue
+
+        if 2 * q + 1 >= query_count:
+            if isinstance(item, tuple):
+                merge(q, [item])
+            else:
+                leaf_search(q, box, item)
+            continue
+
+        # Пачка записей спускается по дереву запросов, как и узел эталона, не намного больший узла запросов
+        if isinstance(item, tuple) or KNN_SPLIT_RATIO * _box_size(query_bounds[q]) > _box_size(box):
+            for child in (2 * q + 2, 2 * q + 1):
+                if query_end[child] > query_start[child]:
+                    stack.append((child, box, item))
+            continue
+
+        items = expand(item)
+
+        # Ближние кладутся последними, чтобы обработать их первыми и быстрее сузить границу
+        items.sort(key=lambda p: boxes_distance(query_bounds[q], p[0]), reverse=True)
+        stack.extend((q, child_box, child) for child_box, child in items)
+
+    best_distances, best_keys = _sorted_knn(best_distances, best_keys)
+
+    ids = np.full(best_keys.shape, -1, dtype=np.int64)
+    found = best_keys >= 0
+    if found.any():
+        ids[found] = entry_ids(entries)[best_keys[found]]
+
+    return best_distances, ids
+
+
+def index_entries(index) -> List[Entry]:
+    """
+    Все записи индекса, каждая один раз (в сетках и R+-дереве запись может лежать в нескольких ячейках / листах).
+    """
+    if hasattr(index, 'root'):
+        entries = []
+        stack = [index.root]
+
+        while len(stack) > 0:
+            node_entries, children = stack.pop().expand()
+            entries.extend(node_entries)
+            stack.extend(children)
+    elif isinstance(getattr(index, 'entries', None), list):
+        return list(index.entries)
+    elif getattr(index, 'store', None) is not None:
+        # ZOrderIndex, StaticFixedGrid
+        return list(index.store.entries())
+    elif hasattr(index, 'grids'):
+        entries = [entry for grid in index.grids for cell in grid.cells.values() for entry in cell]
+    elif hasattr(index, 'cells'):
+        entries = [entry for cell in index.cells.values() for entry in cell]
+    else:
+        raise ValueError("UnsupportedIndex")
+
+    return list({id(e): e for e in entries}.values())
+
+
+def overlapping_entries(entries_a: List[Entry], entries_b: List[Entry]) -> Iterator[Tuple[Entry, Entry]]:
+    # Все пары с пересекающимися MBR одним векторным шагом вместо len(a) * len(b) вызовов intersection
+    if len(entries_a) == 0 or len(entries_b) == 0:
+        return
+
+    a, b = entry_boxes(entries_a), entry_boxes(entries_b)
+
+    # Маленькие списки (листья) - полное сравнение, большие - плоское заметание
+    if len(a) * len(b) <= DENSE_PAIRS_LIMIT:
+        mask = ((a[:, None, 0] <= b[None, :, 2]) & (a[:, None, 2] >= b[None, :, 0]) &
+                (a[:, None, 1] <= b[None, :, 3]) & (a[:, None, 3] >= b[None, :, 1]))
+        batches = [np.nonzero(mask)]
+    else:
+        batches = iter_overlapping_pairs(a, b)
+
+    for rows_a, rows_b in batches:
+        for i, j in zip(rows_a.tolist(), rows_b.tolist()):
+            yield entries_a[i], entries_b[j]
+
+
+def candidate_pairs(index_a, index_b) -> Iterator[Tuple[Entry, Entry]]:
+    """
+    Пары записей (a, b) с пересекающимися MBR, возможно с повторами.
+    Два дерева (узлы с expand()) обходятся синхронно: стек пар (узел или запись A, узел или запись B),
+    пара спускается, только если MBR пересекаются. Для остальных индексов - плоское заметание по всем MBR.
+    """
+    if not (hasattr(index_a, 'root') and hasattr(index_b, 'root')):
+        yield from overlapping_entries(index_entries(index_a), index_entries(index_b))
+        return
+    stack = [(index_a.root, index_b.root)]
+
+    while len(stack) > 0:
+        a, b = stack.pop()
+
+        if not intersection(a, b):
+            continue
+
+        a_is_entry, b_is_entry = isinstance(a, Entry), isinstance(b, Entry)
+
+        if a_is_entry:
+            entries_b, children_b = b.expand()
+            yield from overlapping_entries([a], entries_b)
+            stack.extend((a, child) for child in children_b)
+        elif b_is_entry:
+            entries_a, children_a = a.expand()
+            yield from overlapping_entries(entries_a, [b])
+            stack.extend((child, b) for child in children_a)
+        else:
+            # Записи могут лежать и во внутренних узлах (KDTree, Quadtree), поэтому сверяются все четыре сочетания
+            entries_a, children_a = a.expand()
+            entries_b, children_b = b.expand()
+
+            yield from overlapping_entries(entries_a, entries_b)
+
+            stack.extend((entry, child) for entry in entries_a for child in children_b if intersection(entry, child))
+            stack.extend((child, entry) for child in children_a for entry in entries_b if intersection(child, entry))
+            stack.extend((child_a, child_b) for child_a in children_a for child_b in children_b
+                         if intersection(child_a, child_b))
+
+
+def spatial_join(index_a, index_b, predicate: str = 'intersects',
+                 batch_size: int = JOIN_BATCH_SIZE) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Все пары (a из index_a, b из index_b), для которых выполняется predicate(a, b):
+    intersects, contains (a содержит b) или within (a внутри b).
+    Результат выдается пачками (ids_a, ids_b); точный предикат проверяется одним векторным вызовом на пачку.
+    """
+    if predicate not in JOIN_PREDICATES:
+        raise ValueError("UnknownPredicate")
+
+    # Повторы пар бывают только у записей, лежащих в нескольких листах (R+-дерево):
+    # запоминаются лишь пары с такими записями, остальные выдаются без учета
+    repeated_a, repeated_b = repeated_entries(index_a), repeated_entries(index_b)
+
+    if len(repeated_a) == 0 and len(repeated_b) == 0:
+        return refine_pairs(candidate_pairs(index_a, index_b), predicate, batch_size)
+
+    seen = set()
+
+    def unique_pairs():
+        for a, b in candidate_pairs(index_a, index_b):
+            if id(a) in repeated_a or id(b) in repeated_b:
+                key = (id(a), id(b))
+
+                if key in seen:
+                    continue
+                seen.add(key)
+
+            yield a, b
+
+    return refine_pairs(unique_pairs(), predicate, batch_size)
+
+
+def repeated_entries(index) -> set:
+    # id записей, которые дерево хранит в нескольких узлах. Плоские индексы соединяются через index_entries,
+    # там повторов нет
+    if not hasattr(index, 'root'):
+        return set()
+
+    visited, repeated = set(), set()
+    stack = [index.root]
+
+    while len(stack) > 0:
+        node_entries, children = stack.pop().expand()
+
+        for entry in node_entries:
+            if id(entry) in visited:
+                repeated.add(id(entry))
+            visited.add(id(entry))
+
+        stack.extend(children)
+
+    return repeated
+
+
+def self_join(index, predicate: str = 'intersects',
+              batch_size: int = JOIN_BATCH_SIZE) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Пары разных записей одного индекса, для которых выполняется predicate(a, b), пачками (ids_a, ids_b):
+    например, дубликаты и наложения участков. Для intersects каждая пара выдается один раз.
+    """
+    if predicate not in JOIN_PREDICATES:
+        raise ValueError("UnknownPredicate")
+
+    entries = index_entries(index)
+
+    def pairs():
+        for rows_a, rows_b in iter_self_overlapping_pairs(entry_boxes(entries)):
+            for i, j in zip(rows_a.tolist(), rows_b.tolist()):
+                yield entries[i], entries[j]
+
+                # contains и within несимметричны - проверяются оба порядка
+                if predicate != 'intersects':
+                    yield entries[j], entries[i]
+
+    return refine_pairs(pairs(), predicate, batch_size)
+
+
+def refine_pairs(pairs: Iterator[Tuple[Entry, Entry]], predicate: str,
+                 batch_size: int = JOIN_BATCH_SIZE) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    # Точная проверка пар-кандидатов одним векторным вызовом предиката на пачку
+    test = getattr(shapely, predicate)
+
+    batch_a: List[Entry] = []
+    batch_b: List[Entry] = []
+
+    def refine():
+        shapes_a = np.array([e.shape for e in batch_a], dtype=object)
+        shapes_b = np.array([e.shape for e in batch_b], dtype=object)
+        ids_a, ids_b = entry_ids(batch_a), entry_ids(batch_b)
+
+        mask = test(shapes_a, shapes_b)
+
+        batch_a.clear()
+        batch_b.clear()
+
+        return ids_a[mask], ids_b[mask]
+
+    for a, b in pairs:
+        batch_a.append(a)
+        batch_b.append(b)
+
+        if len(batch_a) >= batch_size:
+            yield refine()
+
+    if len(batch_a) > 0:
+        yield refine()
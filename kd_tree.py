@@ -1,16 +1,19 @@
 from __future__ import annotations
 
-from typing import List
+from typing import List, Iterator, Tuple
 
+import numpy as np
 import shapely
 from shapely import Polygon, Geometry, Point
 
-from common import geometry_to_box, BoundaryBox, Entry, contains, get_nearest, intersection, plot_get_color, \
-    add_to_plot_box, strict_contains
+from common import geometry_to_box, BoundaryBox, Entry, contains, plot_get_color, add_to_plot_box, strict_contains, \
+    nearest_iter, refine, collect_candidates, iter_candidates, SpatialIndex
 from shapely_plot import add_to_plot_geometry
 
 
 class KDTreeNode(BoundaryBox):
+    __slots__ = ('median', 'entries', 'depth', 'left', 'right')
+
     def __init__(self, x_min, y_min, x_max, y_max, depth):
         super().__init__(x_min, y_min, x_max, y_max)
 
@@ -23,13 +26,16 @@ class KDTreeNode(BoundaryBox):
     def is_leaf(self):
         return self.left is None or self.right is None
 
+    def expand(self):
+        return self.entries, [] if self.is_leaf() else [self.left, self.right]
+
 
-class KDTree(object):
+class KDTree(SpatialIndex):
     def __init__(self, boundary: Polygon, bucket_capacity, max_depth):
         x_min, y_min, x_max, y_max = (shapely.envelope(boundary)).bounds
         self.root = KDTreeNode(x_min, y_min, x_max, y_max, 0)
 
-        # TODO Эти параметры учитываются только при динамическом добавлении
+        # При динамическом добавлении узел делится при заполнении, при build - сразу до нужного размера
         self.bucket_capacity = bucket_capacity
         self.max_depth = max_depth
 
@@ -67,74 +73,98 @@ class KDTree(object):
 
         median = find_median(node.entries, axis)
 
-        node.median = median
-
-        if axis == 0:
-            node.left = KDTreeNode(node.x_min, node.y_min, median, node.y_max, depth)
-            node.right = KDTreeNode(median, node.y_min, node.x_max, node.y_max, depth)
-        else:
-            node.left = KDTreeNode(node.x_min, node.y_min, node.x_max, median, depth)
-            node.right = KDTreeNode(node.x_min, median, node.x_max, node.y_max, depth)
+        create_children(node, axis, median)
 
-        entries = node.entries.copy()
+        # Один проход вместо list.remove для каждой перенесенной записи
+        remaining = []
 
-        for entry in entries:
+        for entry in node.entries:
             if strict_contains(node.left, entry):
-                node.entries.remove(entry)
                 node.left.entries.append(entry)
             elif contains(node.right, entry):
-                node.entries.remove(entry)
                 node.right.entries.append(entry)
+            else:
+                remaining.append(entry)
 
-    def find_nearest_neighbor(self, point: Point):
-        nearest, _ = self.find_nearest_neighbor_internal(self.root, point, None, float('inf'))
-        return nearest.shape
+        node.entries = remaining
 
-    def find_nearest_neighbor_internal(self, node: KDTreeNode, point: Point, nearest: Entry | None, min_distance):
-        if node is None:
-            return nearest, min_distance
+    def build(self, entries: List[Entry]):
+        """
+        Статическое построение сверху вниз по массивам MBR: узел с не менее чем bucket_capacity записями
+        делится по медиане координат (как в find_median, через np.partition), пока глубина не больше max_depth.
+        Записи распределяются по тому же правилу, что и в split: строго внутри левого - влево,
+        внутри правого - вправо, остальные (пересекающие медиану) остаются в узле.
+        Получается то же дерево, что и при делении split всех записей сверху вниз, но не то, что при
+        последовательных insert: там медиана считается по записям, накопившимся к моменту переполнения листа.
+        """
+        bounds = np.array([(e.x_min, e.y_min, e.x_max, e.y_max) for e in entries], dtype=np.float64).reshape(-1, 4)
 
-        candidate, distance = get_nearest(node.entries, point)
+        root = self.root
 
-        if distance < min_distance:
-            nearest = candidate
-            min_distance = distance
+        outside = ((bounds[:, 0] < root.x_min) | (bounds[:, 1] < root.y_min) |
+                   (bounds[:, 2] > root.x_max) | (bounds[:, 3] > root.y_max))
 
-        if not node.is_leaf():
-            k = 2  # двумерное пространство
-            axis = node.depth % k
-            point_tuple = [point.x, point.y]
-
-            if node.median >= point_tuple[axis]:
-                nearest, min_distance = self.find_nearest_neighbor_internal(node.left, point, nearest, min_distance)
-                if node.median - point_tuple[axis] < min_distance:
-                    nearest, min_distance = self.find_nearest_neighbor_internal(node.right, point, nearest, min_distance)
-            else:
-                nearest, min_distance = self.find_nearest_neighbor_internal(node.right, point, nearest, min_distance)
-                if point_tuple[axis] - node.median < min_distance:
-                    nearest, min_distance = self.find_nearest_neighbor_internal(node.left, point, nearest, min_distance)
+        if outside.any():
+            raise ValueError("ElementOutside")
+
+        root.entries, root.left, root.right, root.median = [], None, None, None
+
+        stack = [(root, np.arange(len(entries)))]
+
+        while len(stack) > 0:
+            node, rows = stack.pop()
+
+            if len(rows) < self.bucket_capacity or node.depth + 1 > self.max_depth:
+                node.entries = list(map(entries.__getitem__, rows.tolist()))
+                continue
+
+            axis = node.depth % 2
+
+            b = bounds[rows]
+
+            # Медиана 2n координат (минимумы и максимумы) - среднее двух средних элементов
+            n = len(rows)
+            coords = np.partition(b[:, (axis, axis + 2)].ravel(), (n - 1, n))
+            median = float((coords[n - 1] + coords[n]) / 2)
 
-        return nearest, min_distance
+            create_children(node, axis, median)
+            left, right = node.left, node.right
+
+            to_left = ((b[:, 0] > left.x_min) & (b[:, 2] < left.x_max) &
+                       (b[:, 1] > left.y_min) & (b[:, 3] < left.y_max))
+            to_right = ~to_left & ((b[:, 0] >= right.x_min) & (b[:, 2] <= right.x_max) &
+                                   (b[:, 1] >= right.y_min) & (b[:, 3] <= right.y_max))
+
+            node.entries = list(map(entries.__getitem__, rows[~(to_left | to_right)].tolist()))
+
+            stack.append((right, rows[to_right]))
+            stack.append((left, rows[to_left]))
+
+        return self
+
+    def find_nearest_neighbor(self, point: Point):
+        nearest = next(self.nearest_entries(point), None)
+        return nearest[0].shape if nearest is not None else None
+
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        return nearest_iter(self.root, point, max_distance)
 
     def search(self, search: Geometry):
         search_box = geometry_to_box(search)
 
-        if contains(self.root, search_box):
-            candidates = self.internal_search(self.root, search_box)
-            shapes = list(map(lambda e: e.shape, candidates))
-            return list(filter(lambda s: s.intersects(search), shapes))
+        if self.covers(search_box):
+            return refine(collect_candidates(self.root, search_box), search)
         else:
             return None
 
-    def internal_search(self, node: KDTreeNode, search_box: BoundaryBox) -> List[Entry]:
-        search_result = list(filter(lambda e: intersection(e, search_box), node.entries))
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return collect_candidates(self.root, search_box)
 
-        if not node.is_leaf():
-            for child in [node.left, node.right]:
-                if intersection(child, search_box):
-                    search_result.extend(self.internal_search(child, search_box))
+    def iter_candidates(self, search_box: BoundaryBox) -> Iterator[Entry]:
+        return iter_candidates(self.root, search_box)
 
-        return search_result
+    def covers(self, search_box: BoundaryBox) -> bool:
+        return contains(self.root, search_box)
 
 
 # def build_kd_tree(boundary: Polygon, shapes: List[shapely.Geometry], depth=0):
@@ -264,9 +294,24 @@ class KDTree(object):
 #     return l[0] if len(l) > 0 else None
 
 
+def create_children(node: KDTreeNode, axis: int, median: float):
+    depth = node.depth + 1
+
+    node.median = median
+
+    if axis == 0:
+        node.left = KDTreeNode(node.x_min, node.y_min, median, node.y_max, depth)
+        node.right = KDTreeNode(median, node.y_min, node.x_max, node.y_max, depth)
+    else:
+        node.left = KDTreeNode(node.x_min, node.y_min, node.x_max, median, depth)
+        node.right = KDTreeNode(node.x_min, median, node.x_max, node.y_max, depth)
+
+
 def find_median(entries: List[Entry], axes):
-    all_coords = [[(minx, miny), (maxx, maxy)] for minx, miny, maxx, maxy in map(lambda e: e.boundary.bounds, entries)]
-    all_coords = [cc[axes] for c in all_coords for cc in c]
+    if axes == 0:
+        all_coords = [c for e in entries for c in (e.x_min, e.x_max)]
+    else:
+        all_coords = [c for e in entries for c in (e.y_min, e.y_max)]
     all_coords.sort()
 
     if len(all_coords) % 2 == 1:
@@ -1,10 +1,16 @@
 from __future__ import annotations
 
+import heapq
+import json
+import math
+import os
 from typing import List
 
+import numpy as np
 import shapely
 from shapely import Polygon, Geometry, Point
 
+from common import PointIndex, merge_nearest, points_within, sorted_by_distance
 from shapely_plot import add_to_plot_geometry
 
 
@@ -114,3 +120,175 @@ def plot_kd_tree_point(tree: KDTreePoint):
     plot_kd_tree_point(tree.left)
     plot_kd_tree_point(tree.right)
 
+
+# Размер листа неявного k-d дерева: в листе расстояния считаются одним векторным вызовом
+LEAF_SIZE = 16
+
+
+class ImplicitKDTree(PointIndex):
+    """
+    k-d дерево точек без объектов-узлов: координаты лежат в одном массиве points (n, 2),
+    переставленном так, что каждый узел - непрерывный отрезок [node_start, node_end).
+    Узлы пронумерованы как в куче (дети узла i - 2i + 1 и 2i + 2), для каждого хранится MBR его точек.
+    Построение - np.argpartition по более широкой оси (O(n log n)), поиск - итеративный, без рекурсии.
+    Все поля - массивы NumPy, поэтому дерево сериализуется pickle и открывается с диска через mmap.
+    """
+
+    def __init__(self, points: np.ndarray, ids: np.ndarray, node_start: np.ndarray, node_end: np.ndarray,
+                 node_bounds: np.ndarray, leaf_size: int = LEAF_SIZE):
+        self.points = points
+        self.ids = ids
+        self.node_start = node_start
+        self.node_end = node_end
+        self.node_bounds = node_bounds
+        self.leaf_size = leaf_size
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def node_count(self) -> int:
+        return len(self.node_start)
+
+    def is_leaf(self, node: int) -> bool:
+        return 2 * node + 1 >= len(self.node_start)
+
+    @staticmethod
+    def build(points, ids=None, leaf_size: int = LEAF_SIZE) -> ImplicitKDTree:
+        points = np.array(points, dtype=np.float64).reshape(-1, 2)
+        n = len(points)
+        ids = np.arange(n, dtype=np.int64) if ids is None else np.array(ids, dtype=np.int64)
+
+        # Глубина, при которой в листах не больше leaf_size точек
+        depth = max(0, math.ceil(math.log2(n / leaf_size))) if n > 0 else 0
+        node_count = (1 << (depth + 1)) - 1
+
+        node_start = np.zeros(node_count, dtype=np.int64)
+        node_end = np.zeros(node_count, dtype=np.int64)
+        node_bounds = np.empty((node_count, 4), dtype=np.float64)
+
+        node_end[0] = n
+
+        # Нумерация кучи - это обход в ширину: родитель всегда обрабатывается раньше детей
+        for node in range(node_count):
+            start, end = node_start[node], node_end[node]
+            segment = points[start:end]
+
+            if end > start:
+                low, high = segment.min(axis=0), segment.max(axis=0)
+                node_bounds[node] = (low[0], low[1], high[0], high[1])
+            else:
+                node_bounds[node] = (math.inf, math.inf, -math.inf, -math.inf)
+
+            left = 2 * node + 1
+            if left >= node_count:
+                continue
+
+            middle = (start + end) // 2
+
+            if end - start > 1:
+                axis = 0 if high[0] - low[0] >= high[1] - low[1] else 1
+                order = np.argpartition(segment[:, axis], middle - start)
+                points[start:end] = segment[order]
+                ids[start:end] = ids[start:end][order]
+
+            node_start[left], node_end[left] = start, middle
+            node_start[left + 1], node_end[left + 1] = middle, end
+
+        return ImplicitKDTree(points, ids, node_start, node_end, node_bounds, leaf_size)
+
+    @staticmethod
+    def from_points(points: List[Point], leaf_size: int = LEAF_SIZE) -> ImplicitKDTree:
+        return ImplicitKDTree.build(shapely.get_coordinates(points), leaf_size=leaf_size)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+        for name in ['points', 'ids', 'node_start', 'node_end', 'node_bounds']:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+
+        with open(os.path.join(path, 'kd_tree.json'), 'w') as f:
+            json.dump({'leaf_size': self.leaf_size}, f)
+
+    @staticmethod
+    def open(path: str, mmap_mode: str | None = 'r') -> ImplicitKDTree:
+        with open(os.path.join(path, 'kd_tree.json'), 'r') as f:
+            info = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        return ImplicitKDTree(load('points'), load('ids'), load('node_start'), load('node_end'), load('node_bounds'),
+                              info['leaf_size'])
+
+    def node_distance(self, node: int, x: float, y: float) -> float:
+        x_min, y_min, x_max, y_max = self.node_bounds[node].tolist()
+        dx = max(x_min - x, x - x_max, 0.0)
+        dy = max(y_min - y, y - y_max, 0.0)
+        return math.hypot(dx, dy)
+
+    def query_positions(self, x: float, y: float, k: int = 1,
+                        max_distance: float | None = None) -> (np.ndarray, np.ndarray):
+        """
+        То же, что query, но вместо ids - позиции в массиве points.
+        Узлы обходятся best-first по расстоянию до их MBR, пока оно не больше k-го найденного.
+        """
+        best_distances = np.empty(0, dtype=np.float64)
+        best_positions = np.empty(0, dtype=np.int64)
+
+        if k <= 0:
+            return best_distances, best_positions
+
+        bound = math.inf if max_distance is None else max_distance
+
+        heap = [(0.0, 0)] if len(self.points) > 0 else []
+
+        while len(heap) > 0:
+            node_distance, node = heapq.heappop(heap)
+
+            if node_distance > bound:
+                break
+
+            if self.is_leaf(node):
+                start, end = self.node_start[node], self.node_end[node]
+                segment = self.points[start:end]
+                best_distances, best_positions, bound = merge_nearest(best_distances, best_positions, segment, start,
+                                                                      x, y, k, bound)
+            else:
+                for child in (2 * node + 1, 2 * node + 2):
+                    if self.node_end[child] > self.node_start[child]:
+                        child_distance = self.node_distance(child, x, y)
+
+                        if child_distance <= bound:
+                            heapq.heappush(heap, (child_distance, child))
+
+        order = np.argsort(best_distances, kind='stable')
+        return best_distances[order], best_positions[order]
+
+    def query_radius(self, x: float, y: float, radius: float) -> (np.ndarray, np.ndarray):
+        """
+        Все точки на расстоянии не больше radius: (расстояния, ids) по возрастанию расстояния.
+        """
+        distances_parts, ids_parts = [], []
+
+        stack = [0] if len(self.points) > 0 else []
+
+        while len(stack) > 0:
+            node = stack.pop()
+
+            if self.node_end[node] == self.node_start[node] or self.node_distance(node, x, y) > radius:
+                continue
+
+            if self.is_leaf(node):
+                start, end = self.node_start[node], self.node_end[node]
+                distances, ids = points_within(self.points[start:end], self.ids[start:end], x, y, radius)
+                distances_parts.append(distances)
+                ids_parts.append(ids)
+            else:
+                stack.extend((2 * node + 2, 2 * node + 1))
+
+        return sorted_by_distance(distances_parts, ids_parts)
+
+
+def build_implicit_kd_tree(points: List[Point], leaf_size: int = LEAF_SIZE) -> ImplicitKDTree:
+    return ImplicitKDTree.from_points(points, leaf_size)
@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import heapq
+import json
+import math
+import os
+from typing import List
+
+import numpy as np
+import shapely
+from shapely import Polygon, Geometry, Point
+
+from common import concat_ranges, merge_nearest, points_within, sorted_by_distance, PointIndex
+from z_curve import z_encode, z_decode, z_encode_many, quantize
+
+# Вместимость листа: лист делится, если в нем больше точек
+BUCKET_CAPACITY = 64
+
+# Не больше 31 уровня, чтобы код ячейки вместе с длиной ее отрезка помещался в uint64
+MAX_DEPTH = 31
+
+
+class LinearQuadtree(PointIndex):
+    """
+    Линейное (безуказательное) квадродерево точек. Вместо объектов-узлов хранится отсортированный массив ключей
+    занятых листьев: locational code (Z-код левой нижней ячейки листа на самой мелкой сетке 2^bits x 2^bits)
+    и уровень. Лист уровня level - отрезок Z-кодов длины 4^(bits - level), точки отсортированы по Z-коду,
+    поэтому точки листа (и любого узла) - непрерывный отрезок [leaf_start, leaf_end) массива points.
+    Спуск по дереву - двоичный поиск по leaf_codes. Все поля - массивы NumPy, дерево сохраняется на диск
+    и открывается через mmap.
+    """
+
+    def __init__(self, points: np.ndarray, ids: np.ndarray, leaf_codes: np.ndarray, leaf_levels: np.ndarray,
+                 leaf_start: np.ndarray, leaf_end: np.ndarray, bounds, bits: int,
+                 bucket_capacity: int = BUCKET_CAPACITY):
+        self.points = points
+        self.ids = ids
+        self.leaf_codes = leaf_codes
+        self.leaf_levels = leaf_levels
+        self.leaf_start = leaf_start
+        self.leaf_end = leaf_end
+        self.x_min, self.y_min, self.x_max, self.y_max = bounds
+        self.bits = bits
+        self.bucket_capacity = bucket_capacity
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def leaf_count(self) -> int:
+        return len(self.leaf_codes)
+
+    @property
+    def bounds(self):
+        return self.x_min, self.y_min, self.x_max, self.y_max
+
+    @staticmethod
+    def build(points, ids=None, boundary: Polygon | None = None, bucket_capacity: int = BUCKET_CAPACITY,
+              max_depth: int = MAX_DEPTH) -> LinearQuadtree:
+        """
+        Построение по уровням: точки сортируются по Z-коду, на каждом уровне отрезки точек с общим префиксом кода
+        длиной больше bucket_capacity делятся на отрезки следующего уровня, остальные становятся листьями.
+        Без boundary область - MBR точек.
+        """
+        points = np.array(points, dtype=np.float64).reshape(-1, 2)
+        n = len(points)
+        ids = np.arange(n, dtype=np.int64) if ids is None else np.array(ids, dtype=np.int64)
+
+        if boundary is not None:
+            bounds = shapely.envelope(boundary).bounds
+        elif n > 0:
+            bounds = (*points.min(axis=0).tolist(), *points.max(axis=0).tolist())
+        else:
+            bounds = (0.0, 0.0, 0.0, 0.0)
+
+        x_min, y_min, x_max, y_max = bounds
+
+        outside = ((points[:, 0] < x_min) | (points[:, 0] > x_max) |
+                   (points[:, 1] < y_min) | (points[:, 1] > y_max))
+
+        if outside.any():
+            raise ValueError("ElementOutside")
+
+        bits = min(max_depth, MAX_DEPTH)
+
+        codes = z_encode_many(quantize(points[:, 0], x_min, x_max, bits), quantize(points[:, 1], y_min, y_max, bits))
+
+        order = np.argsort(codes, kind='stable')
+        points, ids, codes = points[order], ids[order], codes[order]
+
+        leaf_codes, leaf_levels, leaf_start, leaf_end = [], [], [], []
+
+        # Отрезки точек с общим префиксом кода на текущем уровне
+        starts = np.zeros(1 if n > 0 else 0, dtype=np.int64)
+        ends = np.full(len(starts), n, dtype=np.int64)
+
+        for level in range(bits + 1):
+            shift = np.uint64(2 * (bits - level))
+            final = (ends - starts <= bucket_capacity) | (level == bits)
+
+            leaf_codes.append((codes[starts[final]] >> shift) << shift)
+            leaf_levels.append(np.full(int(final.sum()), level, dtype=np.int8))
+            leaf_start.append(starts[final])
+            leaf_end.append(ends[final])
+
+            starts, ends = starts[~final], ends[~final]
+
+            if len(starts) == 0:
+                break
+
+            # Отрезки следующего уровня начинаются там, где меняется префикс кода
+            positions = concat_ranges(starts, ends)
+            prefixes = codes[positions] >> np.uint64(2 * (bits - level - 1))
+
+            first = np.flatnonzero(np.r_[True, prefixes[1:] != prefixes[:-1]])
+            starts = positions[first]
+            ends = positions[np.r_[first[1:], len(positions)] - 1] + 1
+
+        leaf_codes, leaf_start = np.concatenate(leaf_codes), np.concatenate(leaf_start)
+        order = np.argsort(leaf_start, kind='stable')
+
+        return LinearQuadtree(points, ids, leaf_codes[order], np.concatenate(leaf_levels)[order], leaf_start[order],
+                              np.concatenate(leaf_end)[order], bounds, bits, bucket_capacity)
+
+    @staticmethod
+    def from_points(points: List[Point], boundary: Polygon | None = None, bucket_capacity: int = BUCKET_CAPACITY,
+                    max_depth: int = MAX_DEPTH) -> LinearQuadtree:
+        return LinearQuadtree.build(shapely.get_coordinates(points), boundary=boundary,
+                                    bucket_capacity=bucket_capacity, max_depth=max_depth)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+        for name in ['points', 'ids', 'leaf_codes', 'leaf_levels', 'leaf_start', 'leaf_end']:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+
+        with open(os.path.join(path, 'linear_quad_tree.json'), 'w') as f:
+            json.dump({'bounds': list(self.bounds), 'bits': self.bits, 'bucket_capacity': self.bucket_capacity}, f)
+
+    @staticmethod
+    def open(path: str, mmap_mode: str | None = 'r') -> LinearQuadtree:
+        with open(os.path.join(path, 'linear_quad_tree.json'), 'r') as f:
+            info = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        return LinearQuadtree(load('points'), load('ids'), load('leaf_codes'), load('leaf_levels'), load('leaf_start'),
+                              load('leaf_end'), info['bounds'], info['bits'], info['bucket_capacity'])
+
+    def span(self, level: int) -> int:
+        # Сколько кодов самой мелкой сетки занимает ячейка уровня level
+        return 1 << (2 * (self.bits - level))
+
+    def cell_of(self, x: float, y: float) -> (int, int):
+        return (int(quantize(x, self.x_min, self.x_max, self.bits)),
+                int(quantize(y, self.y_min, self.y_max, self.bits)))
+
+    def leaves_in_cell(self, code: int, level: int) -> (int, int):
+        # Листья внутри ячейки - отрезок [lo, hi) массива leaf_codes
+        lo = int(np.searchsorted(self.leaf_codes, np.uint64(code), 'left'))
+        hi = int(np.searchsorted(self.leaf_codes, np.uint64(code + self.span(level)), 'left'))
+        return lo, hi
+
+    def locate(self, x: float, y: float) -> int:
+        """
+        Номер листа, в который попадает точка (x, y), или -1, если ее ячейка не занята.
+        """
+        code = z_encode(*self.cell_of(x, y))
+        leaf = int(np.searchsorted(self.leaf_codes, np.uint64(code), 'right')) - 1
+
+        if leaf >= 0 and code < int(self.leaf_codes[leaf]) + self.span(int(self.leaf_levels[leaf])):
+            return leaf
+
+        return -1
+
+    def cell_distance(self, code: int, level: int, x: float, y: float) -> float:
+        # Нижняя оценка расстояния до точек ячейки: ячейка расширена на одну ячейку самой мелкой сетки,
+        # чтобы погрешность квантования не сделала оценку больше настоящего расстояния
+        cells = 1 << self.bits
+        width, height = (self.x_max - self.x_min) / cells, (self.y_max - self.y_min) / cells
+
+        ix, iy = z_decode(code)
+        size = 1 << (self.bits - level)
+
+        dx = max(self.x_min + (ix - 1) * width - x, x - (self.x_min + (ix + size + 1) * width), 0.0)
+        dy = max(self.y_min + (iy - 1) * height - y, y - (self.y_min + (iy + size + 1) * height), 0.0)
+        return math.hypot(dx, dy)
+
+    def box_positions(self, x_min: float, y_min: float, x_max: float, y_max: float) -> np.ndarray:
+        """
+        Позиции (в массиве points) точек внутри прямоугольника, в Z-порядке.
+        Ячейки строго внутри прямоугольника на сетке берутся целиком, без проверки координат.
+        """
+        qx_min, qy_min = self.cell_of(x_min, y_min)
+        qx_max, qy_max = self.cell_of(x_max, y_max)
+
+        parts = []
+
+        stack = [(0, 0)] if self.leaf_count > 0 else []
+
+        while len(stack) > 0:
+            code, level = stack.pop()
+
+            lo, hi = self.leaves_in_cell(code, level)
+
+            if lo == hi:
+                continue
+
+            ix, iy = z_decode(code)
+            last = (1 << (self.bits - level)) - 1
+
+            if ix > qx_max or ix + last < qx_min or iy > qy_max or iy + last < qy_min:
+                continue
+
+            if ix > qx_min and ix + last < qx_max and iy > qy_min and iy + last < qy_max:
+                parts.append(np.arange(self.leaf_start[lo], self.leaf_end[hi - 1]))
+                continue
+
+            if self.leaf_levels[lo] == level:
+                start = self.leaf_start[lo]
+                segment = self.points[start:self.leaf_end[lo]]
+                mask = ((segment[:, 0] >= x_min) & (segment[:, 0] <= x_max) &
+                        (segment[:, 1] >= y_min) & (segment[:, 1] <= y_max))
+                parts.append(start + np.flatnonzero(mask))
+                continue
+
+            quarter = self.span(level + 1)
+            stack.extend((code + quadrant * quarter, level + 1) for quadrant in (3, 2, 1, 0))
+
+        if len(parts) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        return np.concatenate(parts)
+
+    def query_box(self, x_min: float, y_min: float, x_max: float, y_max: float) -> np.ndarray:
+        """
+        ids точек внутри прямоугольника (границы включительно).
+        """
+        return self.ids[self.box_positions(x_min, y_min, x_max, y_max)]
+
+    def search(self, search: Geometry) -> List[Point]:
+        positions = self.box_positions(*shapely.bounds(search).tolist())
+        candidates = self.points[positions]
+        mask = shapely.intersects_xy(search, candidates[:, 0], candidates[:, 1])
+        return list(shapely.points(candidates[mask]))
+
+    def query_positions(self, x: float, y: float, k: int = 1,
+                        max_distance: float | None = None) -> (np.ndarray, np.ndarray):
+        """
+        То же, что query, но вместо ids - позиции в массиве points.
+        Ячейки обходятся best-first по нижней оценке расстояния, пока она не больше k-го найденного.
+        """
+        best_distances = np.empty(0, dtype=np.float64)
+        best_positions = np.empty(0, dtype=np.int64)
+
+        if k <= 0:
+            return best_distances, best_positions
+
+        bound = math.inf if max_distance is None else max_distance
+
+        heap = [(0.0, 0, 0)] if self.leaf_count > 0 else []
+
+        while len(heap) > 0:
+            cell_distance, code, level = heapq.heappop(heap)
+
+            if cell_distance > bound:
+                break
+
+            lo, hi = self.leaves_in_cell(code, level)
+
+            if lo == hi:
+                continue
+
+            if self.leaf_levels[lo] == level:
+                start = self.leaf_start[lo]
+                segment = self.points[start:self.leaf_end[lo]]
+                best_distances, best_positions, bound = merge_nearest(best_distances, best_positions, segment, start,
+                                                                      x, y, k, bound)
+            else:
+                quarter = self.span(level + 1)
+
+                for child in range(code, code + 4 * quarter, quarter):
+                    child_lo, child_hi = self.leaves_in_cell(child, level + 1)
+
+                    if child_lo < child_hi:
+                        child_distance = self.cell_distance(child, level + 1, x, y)
+
+                        if child_distance <= bound:
+                            heapq.heappush(heap, (child_distance, child, level + 1))
+
+        order = np.argsort(best_distances, kind='stable')
+        return best_distances[order], best_positions[order]
+
+    def query_radius(self, x: float, y: float, radius: float) -> (np.ndarray, np.ndarray):
+        """
+        Все точки на расстоянии не больше radius: (расстояния, ids) по возрастанию расстояния.
+        """
+        distances_parts, ids_parts = [], []
+
+        stack = [(0, 0)] if self.leaf_count > 0 else []
+
+        while len(stack) > 0:
+            code, level = stack.pop()
+
+            lo, hi = self.leaves_in_cell(code, level)
+
+            if lo == hi or self.cell_distance(code, level, x, y) > radius:
+                continue
+
+            if self.leaf_levels[lo] == level:
+                start, end = self.leaf_start[lo], self.leaf_end[lo]
+                distances, ids = points_within(self.points[start:end], self.ids[start:end], x, y, radius)
+                distances_parts.append(distances)
+                ids_parts.append(ids)
+            else:
+                quarter = self.span(level + 1)
+                stack.extend((code + quadrant * quarter, level + 1) for quadrant in (3, 2, 1, 0))
+
+        return sorted_by_distance(distances_parts, ids_parts)
+
+
+def build_linear_quad_tree(points: List[Point], boundary: Polygon | None = None,
+                           bucket_capacity: int = BUCKET_CAPACITY, max_depth: int = MAX_DEPTH) -> LinearQuadtree:
+    return LinearQuadtree.from_points(points, boundary, bucket_capacity, max_depth)
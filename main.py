@@ -7,11 +7,14 @@ import shapely
 
 from brute_force import BruteForce
 from common import uniform_distribution, Entry, StopWatch, gaussian_distribution, generate_random_point, \
-    generate_random_box, generate_random_size_box
+    generate_random_box, generate_random_size_box, make_entries
 from fixed_grid import FixedGrid
+from hierarchical_grid import HierarchicalGrid
 from kd_tree import KDTree
 from quad_tree import Quadtree
-from r_tree import RTree
+from r_plus_tree import RPlusTree
+from r_star_tree import RStarTree
+from r_tree import RTree, build_r_tree_str as r_tree_bulk_load, build_r_tree_hilbert as r_tree_hilbert_load
 
 import matplotlib.pyplot as plt
 
@@ -28,9 +31,15 @@ kd_tree_node_capacity = 5
 quad_tree_node_capacity = 5
 r_tree_linear_node_capacity = 5
 r_tree_quadratic_node_capacity = 5
+r_star_tree_node_capacity = 5
+r_plus_tree_node_capacity = 5
 kd_tree_max_depth = 14
 quad_tree_max_depth = 14
 grid_dimension_size = 10000
+hierarchical_grid_dimension_size = 10
+hierarchical_grid_limit_cells = 16
+hierarchical_grid_levels = 4
+brute_force_vectorized = True
 
 min_length_range = 1
 max_length_range = 5
@@ -50,8 +59,13 @@ tight = 'tight'
 kd_tree_key = 'kd_tree'
 quad_tree_key = 'quad_tree'
 grid_key = 'grid'
+hierarchical_grid_key = 'hierarchical_grid'
 r_tree_l_key = 'r_tree_l'
 r_tree_q_key = 'r_tree_q'
+r_tree_str_key = 'r_tree_str'
+r_tree_hilbert_key = 'r_tree_hilbert'
+r_star_tree_key = 'r_star_tree'
+r_plus_tree_key = 'r_plus_tree'
 brute_force_key = 'brute_force'
 
 building_filename = f'results/building_{type}.json'
@@ -78,7 +92,7 @@ def generate_entries(distribution) -> List[Entry]:
         elif distribution == tight:
             points = gaussian_distribution(space_size, 10 * num_entries, space_size / 2, space_size / 2, space_size / 5)
 
-        return list(Entry(p) for p in points)
+        return make_entries(points)
 
     if type == 'polygons':
         points = []
@@ -92,25 +106,27 @@ def generate_entries(distribution) -> List[Entry]:
         polygons = [generate_random_size_box(p.x, p.y, space_size, min_length_polygon, max_length_polygon) for p in
                     points]
 
-        return list(Entry(p) for p in polygons)
+        return make_entries(polygons)
 
 
 def build_kd_tree(entries: List[Entry]):
-    structure = KDTree(boundary, kd_tree_node_capacity, kd_tree_max_depth)
-    for entry in entries:
-        structure.insert(entry)
-    return structure
+    return KDTree(boundary, kd_tree_node_capacity, kd_tree_max_depth).build(entries)
 
 
 def build_quad_tree(entries: List[Entry]):
-    structure = Quadtree(boundary, quad_tree_node_capacity, quad_tree_max_depth)
+    return Quadtree(boundary, quad_tree_node_capacity, quad_tree_max_depth).build(entries)
+
+
+def build_fixed_grid(entries: List[Entry]):
+    structure = FixedGrid(boundary, grid_dimension_size)
     for entry in entries:
         structure.insert(entry)
     return structure
 
 
-def build_fixed_grid(entries: List[Entry]):
-    structure = FixedGrid(boundary, grid_dimension_size)
+def build_hierarchical_grid(entries: List[Entry]):
+    structure = HierarchicalGrid(boundary, hierarchical_grid_dimension_size, hierarchical_grid_limit_cells,
+                                 hierarchical_grid_levels)
     for entry in entries:
         structure.insert(entry)
     return structure
@@ -123,8 +139,30 @@ def build_r_tree(entries: List[Entry], algorithm):
     return structure
 
 
+def build_r_tree_str(entries: List[Entry]):
+    return r_tree_bulk_load(entries, r_tree_linear_node_capacity)
+
+
+def build_r_tree_hilbert(entries: List[Entry]):
+    return r_tree_hilbert_load(entries, r_tree_linear_node_capacity)
+
+
+def build_r_star_tree(entries: List[Entry]):
+    structure = RStarTree(r_star_tree_node_capacity)
+    for entry in entries:
+        structure.insert(entry)
+    return structure
+
+
+def build_r_plus_tree(entries: List[Entry]):
+    structure = RPlusTree(r_plus_tree_node_capacity)
+    for entry in entries:
+        structure.insert(entry)
+    return structure
+
+
 def build_brute_force(entries: List[Entry]):
-    structure = BruteForce()
+    structure = BruteForce(brute_force_vectorized)
     for entry in entries:
         structure.insert(entry)
     return structure
@@ -147,7 +185,12 @@ def building(new: bool = False):
     print('quad_tree_max_depth:', quad_tree_max_depth)
     print('r_tree_linear_node_capacity:', r_tree_linear_node_capacity)
     print('r_tree_quadratic_node_capacity:', r_tree_quadratic_node_capacity)
+    print('r_star_tree_node_capacity:', r_star_tree_node_capacity)
+    print('r_plus_tree_node_capacity:', r_plus_tree_node_capacity)
     print('grid_dimension_size:', grid_dimension_size)
+    print('hierarchical_grid_dimension_size:', hierarchical_grid_dimension_size)
+    print('hierarchical_grid_limit_cells:', hierarchical_grid_limit_cells)
+    print('hierarchical_grid_levels:', hierarchical_grid_levels)
     print()
 
     if new:
@@ -159,8 +202,13 @@ def building(new: bool = False):
                 'quad_tree_node_capacity': quad_tree_node_capacity,
                 'r_tree_linear_node_capacity': r_tree_linear_node_capacity,
                 'r_tree_quadratic_node_capacity': r_tree_quadratic_node_capacity,
+                'r_star_tree_node_capacity': r_star_tree_node_capacity,
+                'r_plus_tree_node_capacity': r_plus_tree_node_capacity,
 
                 'grid_dimension_size': grid_dimension_size,
+                'hierarchical_grid_dimension_size': hierarchical_grid_dimension_size,
+                'hierarchical_grid_limit_cells': hierarchical_grid_limit_cells,
+                'hierarchical_grid_levels': hierarchical_grid_levels,
 
                 'kd_tree_max_depth': kd_tree_max_depth,
                 'quad_tree_max_depth': quad_tree_max_depth,
@@ -214,6 +262,13 @@ def building(new: bool = False):
         print('grid build', stopwatch.elapsed())
         print()
 
+        print('hierarchical_grid building...')
+        stopwatch.start()
+        build_hierarchical_grid(entries)
+        result[hierarchical_grid_key] = stopwatch.stop()
+        print('hierarchical_grid build', stopwatch.elapsed())
+        print()
+
         print('r_tree_linear building...')
         stopwatch.start()
         build_r_tree(entries, 'linear')
@@ -228,6 +283,34 @@ def building(new: bool = False):
         print('r_tree_quadratic build', stopwatch.elapsed())
         print()
 
+        print('r_tree_str building...')
+        stopwatch.start()
+        build_r_tree_str(entries)
+        result[r_tree_str_key] = stopwatch.stop()
+        print('r_tree_str build', stopwatch.elapsed())
+        print()
+
+        print('r_tree_hilbert building...')
+        stopwatch.start()
+        build_r_tree_hilbert(entries)
+        result[r_tree_hilbert_key] = stopwatch.stop()
+        print('r_tree_hilbert build', stopwatch.elapsed())
+        print()
+
+        print('r_star_tree building...')
+        stopwatch.start()
+        build_r_star_tree(entries)
+        result[r_star_tree_key] = stopwatch.stop()
+        print('r_star_tree build', stopwatch.elapsed())
+        print()
+
+        print('r_plus_tree building...')
+        stopwatch.start()
+        build_r_plus_tree(entries)
+        result[r_plus_tree_key] = stopwatch.stop()
+        print('r_plus_tree build', stopwatch.elapsed())
+        print()
+
         print('brute_force building...')
         stopwatch.start()
         build_brute_force(entries)
@@ -290,7 +373,12 @@ def search_range(new: bool = False):
     print('quad_tree_max_depth:', quad_tree_max_depth)
     print('r_tree_linear_node_capacity:', r_tree_linear_node_capacity)
     print('r_tree_quadratic_node_capacity:', r_tree_quadratic_node_capacity)
+    print('r_star_tree_node_capacity:', r_star_tree_node_capacity)
+    print('r_plus_tree_node_capacity:', r_plus_tree_node_capacity)
     print('grid_dimension_size:', grid_dimension_size)
+    print('hierarchical_grid_dimension_size:', hierarchical_grid_dimension_size)
+    print('hierarchical_grid_limit_cells:', hierarchical_grid_limit_cells)
+    print('hierarchical_grid_levels:', hierarchical_grid_levels)
     print()
 
     if new:
@@ -304,8 +392,13 @@ def search_range(new: bool = False):
                 'quad_tree_node_capacity': quad_tree_node_capacity,
                 'r_tree_linear_node_capacity': r_tree_linear_node_capacity,
                 'r_tree_quadratic_node_capacity': r_tree_quadratic_node_capacity,
+                'r_star_tree_node_capacity': r_star_tree_node_capacity,
+                'r_plus_tree_node_capacity': r_plus_tree_node_capacity,
 
                 'grid_dimension_size': grid_dimension_size,
+                'hierarchical_grid_dimension_size': hierarchical_grid_dimension_size,
+                'hierarchical_grid_limit_cells': hierarchical_grid_limit_cells,
+                'hierarchical_grid_levels': hierarchical_grid_levels,
 
                 'kd_tree_max_depth': kd_tree_max_depth,
                 'quad_tree_max_depth': quad_tree_max_depth,
@@ -383,6 +476,13 @@ def search_range(new: bool = False):
         print(f'end fixed_grid search range {result[grid_key]}')
         print()
 
+        print('hierarchical_grid building...')
+        structure = build_hierarchical_grid(entries)
+        print('start hierarchical_grid search range...')
+        result[hierarchical_grid_key] = iteration(structure, query_ranges)
+        print(f'end hierarchical_grid search range {result[hierarchical_grid_key]}')
+        print()
+
         print('r_tree_linear building...')
         structure = build_r_tree(entries, 'linear')
         print('start r_tree_linear search range...')
@@ -397,6 +497,34 @@ def search_range(new: bool = False):
         print(f'end r_tree_quadratic search range {result[r_tree_q_key]}')
         print()
 
+        print('r_tree_str building...')
+        structure = build_r_tree_str(entries)
+        print('start r_tree_str search range...')
+        result[r_tree_str_key] = iteration(structure, query_ranges)
+        print(f'end r_tree_str search range {result[r_tree_str_key]}')
+        print()
+
+        print('r_tree_hilbert building...')
+        structure = build_r_tree_hilbert(entries)
+        print('start r_tree_hilbert search range...')
+        result[r_tree_hilbert_key] = iteration(structure, query_ranges)
+        print(f'end r_tree_hilbert search range {result[r_tree_hilbert_key]}')
+        print()
+
+        print('r_star_tree building...')
+        structure = build_r_star_tree(entries)
+        print('start r_star_tree search range...')
+        result[r_star_tree_key] = iteration(structure, query_ranges)
+        print(f'end r_star_tree search range {result[r_star_tree_key]}')
+        print()
+
+        print('r_plus_tree building...')
+        structure = build_r_plus_tree(entries)
+        print('start r_plus_tree search range...')
+        result[r_plus_tree_key] = iteration(structure, query_ranges)
+        print(f'end r_plus_tree search range {result[r_plus_tree_key]}')
+        print()
+
         print('brute_force building...')
         structure = build_brute_force(entries)
         print('start brute_force search range...')
@@ -444,7 +572,12 @@ def search_nearest(new: bool = False):
     print('quad_tree_max_depth:', quad_tree_max_depth)
     print('r_tree_linear_node_capacity:', r_tree_linear_node_capacity)
     print('r_tree_quadratic_node_capacity:', r_tree_quadratic_node_capacity)
+    print('r_star_tree_node_capacity:', r_star_tree_node_capacity)
+    print('r_plus_tree_node_capacity:', r_plus_tree_node_capacity)
     print('grid_dimension_size:', grid_dimension_size)
+    print('hierarchical_grid_dimension_size:', hierarchical_grid_dimension_size)
+    print('hierarchical_grid_limit_cells:', hierarchical_grid_limit_cells)
+    print('hierarchical_grid_levels:', hierarchical_grid_levels)
     print()
 
     if new:
@@ -456,8 +589,13 @@ def search_nearest(new: bool = False):
                 'quad_tree_node_capacity': quad_tree_node_capacity,
                 'r_tree_linear_node_capacity': r_tree_linear_node_capacity,
                 'r_tree_quadratic_node_capacity': r_tree_quadratic_node_capacity,
+                'r_star_tree_node_capacity': r_star_tree_node_capacity,
+                'r_plus_tree_node_capacity': r_plus_tree_node_capacity,
 
                 'grid_dimension_size': grid_dimension_size,
+                'hierarchical_grid_dimension_size': hierarchical_grid_dimension_size,
+                'hierarchical_grid_limit_cells': hierarchical_grid_limit_cells,
+                'hierarchical_grid_levels': hierarchical_grid_levels,
 
                 'kd_tree_max_depth': kd_tree_max_depth,
                 'quad_tree_max_depth': quad_tree_max_depth,
@@ -534,6 +672,13 @@ def search_nearest(new: bool = False):
         print(f'end fixed_grid search nearest {result[grid_key]}')
         print()
 
+        print('hierarchical_grid building...')
+        structure = build_hierarchical_grid(entries)
+        print('start hierarchical_grid search nearest...')
+        result[hierarchical_grid_key] = iteration(structure, query_points)
+        print(f'end hierarchical_grid search nearest {result[hierarchical_grid_key]}')
+        print()
+
         print('r_tree_linear building...')
         structure = build_r_tree(entries, 'linear')
         print('start r_tree_linear search nearest...')
@@ -548,6 +693,34 @@ def search_nearest(new: bool = False):
         print(f'end r_tree_quadratic search nearest {result[r_tree_q_key]}')
         print()
 
+        print('r_tree_str building...')
+        structure = build_r_tree_str(entries)
+        print('start r_tree_str search nearest...')
+        result[r_tree_str_key] = iteration(structure, query_points)
+        print(f'end r_tree_str search nearest {result[r_tree_str_key]}')
+        print()
+
+        print('r_tree_hilbert building...')
+        structure = build_r_tree_hilbert(entries)
+        print('start r_tree_hilbert search nearest...')
+        result[r_tree_hilbert_key] = iteration(structure, query_points)
+        print(f'end r_tree_hilbert search nearest {result[r_tree_hilbert_key]}')
+        print()
+
+        print('r_star_tree building...')
+        structure = build_r_star_tree(entries)
+        print('start r_star_tree search nearest...')
+        result[r_star_tree_key] = iteration(structure, query_points)
+        print(f'end r_star_tree search nearest {result[r_star_tree_key]}')
+        print()
+
+        print('r_plus_tree building...')
+        structure = build_r_plus_tree(entries)
+        print('start r_plus_tree search nearest...')
+        result[r_plus_tree_key] = iteration(structure, query_points)
+        print(f'end r_plus_tree search nearest {result[r_plus_tree_key]}')
+        print()
+
         print('brute_force building...')
         structure = build_brute_force(entries)
         print('start brute_force search nearest...')
@@ -607,21 +780,12 @@ def plot(uniform_data: Dict[str, float], sparse_data: Dict[str, float], tight_da
         #     width = bar.get_width()
         #     plt.text(width, bar.get_y() + bar.get_height() / 2, name, va='center', ha='left')
 
+    # Порядок серий на диаграмме снизу вверх
+    order = [brute_force_key, r_plus_tree_key, r_star_tree_key, r_tree_hilbert_key, r_tree_str_key, r_tree_q_key,
+             r_tree_l_key, hierarchical_grid_key, grid_key, quad_tree_key, kd_tree_key]
+
     def sort(kv):
-        name = kv[0]
-
-        if name == kd_tree_key:
-            return 5
-        elif name == quad_tree_key:
-            return 4
-        elif name == grid_key:
-            return 3
-        elif name == r_tree_l_key:
-            return 2
-        elif name == r_tree_q_key:
-            return 1
-        elif name == brute_force_key:
-            return 0
+        return order.index(kv[0])
 
     sorted_data = sorted(combined_data.items(), key=lambda kv: sort(kv))
 
@@ -0,0 +1,143 @@
+import random
+
+import numpy as np
+import shapely
+
+from brute_force import BruteForce
+from common import BoundaryBox, make_entries, generate_random_point, generate_random_box, intersection
+from entry_store import EntryStore
+from fixed_grid import FixedGrid, StaticFixedGrid
+from r_plus_tree import build_r_plus_tree
+from r_star_tree import build_r_star_tree
+from r_tree import build_r_tree_str
+from z_order_index import ZOrderIndex
+
+
+def build_grids(boundary, entries, grid_size: int = 10):
+    grid = FixedGrid(boundary, grid_size)
+
+    for entry in entries:
+        grid.insert(entry)
+
+    return [grid, StaticFixedGrid.build(boundary, EntryStore.from_entries(entries), grid_size)]
+
+
+def build_brute_force(entries) -> BruteForce:
+    structure = BruteForce()
+
+    for entry in entries:
+        structure.insert(entry)
+
+    return structure
+
+
+def test_fixed_grid_nearest_off_origin():
+    # Сетка не с началом в (0, 0): ячейки считаются от x_min / y_min
+    random.seed(10)
+    boundary = shapely.box(-500, -500, 500, 500)
+    entries = make_entries([generate_random_point(-500, -500, 500, 500) for _ in range(300)])
+
+    oracle = build_brute_force(entries)
+
+    for grid in build_grids(boundary, entries):
+        for _ in range(100):
+            point = generate_random_point(-600, -600, 600, 600)
+
+            expected_ids, expected_distances = oracle.find_nearest_many([point], 3)
+
+            assert shapely.distance(grid.find_nearest_neighbor(point), point) == expected_distances[0, 0]
+
+            ids, distances = grid.find_nearest_many([point], 3)
+            assert distances.tolist() == expected_distances.tolist()
+
+
+def test_fixed_grid_range_queries_off_origin():
+    # search, search_many и count идут через одни и те же ячейки, что и insert
+    random.seed(7)
+    boundary = shapely.box(-500, -500, 500, 500)
+    shapes = [generate_random_point(-500, -500, 500, 500) for _ in range(300)]
+    entries = make_entries(shapes)
+
+    for grid in build_grids(boundary, entries):
+        for _ in range(30):
+            x_min, x_max = sorted(random.uniform(-500, 500) for _ in range(2))
+            y_min, y_max = sorted(random.uniform(-500, 500) for _ in range(2))
+            query = shapely.box(x_min, y_min, x_max, y_max)
+            expected = {i for i, shape in enumerate(shapes) if shapely.intersects(shape, query)}
+
+            assert len(grid.search(query)) == len(expected)
+            assert set(grid.search_many([query])[0].tolist()) == expected
+            assert grid.count(query) == len(expected)
+
+
+def test_r_trees_viewport_larger_than_data():
+    # Корень R-деревьев - MBR данных: окно просмотра шире данных все равно находит записи
+    random.seed(22)
+    shapes = [generate_random_point(100, 100, 200, 200) for _ in range(200)]
+    query = shapely.box(0, 0, 300, 300)
+
+    for build in [build_r_tree_str, build_r_star_tree, build_r_plus_tree]:
+        tree = build(make_entries(shapes), 8)
+
+        assert len(tree.search(query)) == len(shapes)
+        assert len(list(tree.iter_search(query))) == len(shapes)
+        assert tree.count(query) == len(shapes)
+        assert tree.exists(query)
+        assert sorted(tree.search_many([query])[0].tolist()) == list(range(len(shapes)))
+
+
+def test_z_order_index_nearest():
+    random.seed(23)
+    boundary = shapely.box(0, 0, 100, 100)
+    shapes = ([generate_random_point() for _ in range(200)] +
+              [generate_random_box(max_length=8) for _ in range(200)])
+    entries = make_entries(shapes)
+
+    index = ZOrderIndex.from_entries(boundary, entries)
+    oracle = build_brute_force(entries)
+
+    points = [generate_random_point(-20, -20, 120, 120) for _ in range(50)]
+
+    ids, distances = index.find_nearest_many(points, 5)
+    expected_ids, expected_distances = oracle.find_nearest_many(points, 5)
+    assert distances.tolist() == expected_distances.tolist()
+
+    for point, expected in zip(points, expected_distances.tolist()):
+        assert shapely.distance(index.find_nearest_neighbor(point), point) == expected[0]
+
+        nearest = [d for _, d in index.find_k_nearest(point, 5, max_distance=expected[2])]
+        assert nearest == [d for d in expected if d <= expected[2]]
+
+
+def test_brute_force_vectorized_nearest_on_opened_store(tmp_path):
+    random.seed(2)
+    shapes = [generate_random_point() for _ in range(500)] + [generate_random_box() for _ in range(500)]
+
+    EntryStore.from_shapes(shapes).save(str(tmp_path))
+    store = EntryStore.open(str(tmp_path))
+    structure = BruteForce.from_store(store)
+
+    oracle = build_brute_force(make_entries(shapes))
+    point = generate_random_point()
+
+    expected_ids, expected_distances = oracle.find_nearest_many([point], 3)
+    ids, distances = structure.find_nearest_many([point], 3)
+    assert distances.tolist() == expected_distances.tolist()
+
+    nearest = structure.find_nearest_neighbor(point)
+    assert shapely.distance(nearest.shape, point) == expected_distances[0, 0]
+
+    # Разобраны только геометрии, просмотренные по нижней оценке, а не все хранилище
+    assert np.equal(store._shapes[:len(store)], None).sum() > len(shapes) // 2
+
+
+def test_brute_force_vectorized_candidates():
+    random.seed(3)
+    shapes = [generate_random_box() for _ in range(200)]
+    structure = BruteForce.from_store(EntryStore.from_shapes(shapes))
+
+    search_box = BoundaryBox(20, 20, 60, 60)
+    expected = {i for i, shape in enumerate(shapes) if intersection(make_entries([shape])[0], search_box)}
+
+    assert {e.id for e in structure.iter_candidates(search_box)} == expected
+    assert {e.id for e in structure.search_candidates(search_box)} == expected
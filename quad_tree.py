@@ -1,15 +1,19 @@
 from __future__ import annotations
 
-from typing import List
+from typing import List, Iterator, Tuple
 
+import numpy as np
 import shapely
 from shapely import Polygon, Geometry, Point
 
-from common import BoundaryBox, Entry, contains, get_nearest, geometry_to_box, intersection, plot_get_color, \
-    add_to_plot_box, distance, strict_contains
+from common import BoundaryBox, Entry, contains, geometry_to_box, plot_get_color, add_to_plot_box, strict_contains, \
+    nearest_iter, refine, collect_candidates, iter_candidates, SpatialIndex
+from z_curve import z_encode_many, z_common_level
 
 
 class QuadtreeNode(BoundaryBox):
+    __slots__ = ('top_left', 'top_right', 'bottom_left', 'bottom_right', 'entries', 'depth')
+
     def __init__(self, x_min, y_min, x_max, y_max, depth):
         super().__init__(x_min, y_min, x_max, y_max)
 
@@ -25,6 +29,12 @@ class QuadtreeNode(BoundaryBox):
         return (self.top_left is None or self.top_right is None or
                 self.bottom_left is None or self.bottom_right is None)
 
+    def expand(self):
+        if self.is_leaf():
+            return self.entries, []
+
+        return self.entries, [self.top_left, self.top_right, self.bottom_right, self.bottom_left]
+
 
 def get_containing_child(node: QuadtreeNode, entry: Entry):
     if node.is_leaf():
@@ -42,7 +52,7 @@ def get_containing_child(node: QuadtreeNode, entry: Entry):
     return node.bottom_right if strict_contains(node.bottom_right, entry) else None
 
 
-class Quadtree(object):
+class Quadtree(SpatialIndex):
     def __init__(self, boundary: Polygon, bucket_capacity: int, max_depth: int):
         x_min, y_min, x_max, y_max = (shapely.envelope(boundary)).bounds
         self.root = QuadtreeNode(x_min, y_min, x_max, y_max, 0)
@@ -73,73 +83,170 @@ class Quadtree(object):
         if not node.is_leaf():
             return
 
-        depth = node.depth + 1
-
-        if depth > self.max_depth:
+        if node.depth + 1 > self.max_depth:
             return
 
-        midx, midy = (node.x_min + node.x_max) / 2, (node.y_min + node.y_max) / 2
-
-        node.top_left = QuadtreeNode(node.x_min, midy, midx, node.y_max, depth)
-
-        node.top_right = QuadtreeNode(midx, midy, node.x_max, node.y_max, depth)
+        create_children(node)
 
-        node.bottom_left = QuadtreeNode(node.x_min, node.y_min, midx, midy, depth)
-
-        node.bottom_right = QuadtreeNode(midx, node.y_min, node.x_max, midy, depth)
-
-        entries = node.entries.copy()
+        entries = node.entries
+        node.entries = []
 
         for entry in entries:
             containing_child = get_containing_child(node, entry)
             if containing_child is not None:
-                node.entries.remove(entry)
                 containing_child.entries.append(entry)
+            else:
+                node.entries.append(entry)
 
-    def find_nearest_neighbor(self, point: Point):
-        nearest, _ = self.find_nearest_neighbor_internal(self.root, point, None, float('inf'))
-        return nearest.shape
+    def build(self, entries: List[Entry]):
+        """
+        Статическое построение сверху вниз, по уровням. Для каждой записи через NumPy считается глубина
+        самого глубокого квадранта, строго содержащего ее MBR: углы квантуются на сетку 2^bits x 2^bits корня,
+        глубина - длина общего префикса Z-кодов минимального и максимального углов, а путь вниз - пары бит Z-кода.
+        Узлы делятся по тому же правилу, что и при вставке: узел с не менее чем bucket_capacity записями
+        делится, пока глубина не больше max_depth; записи, не попавшие строго внутрь потомка, остаются в узле.
+        """
+        bounds = np.array([(e.x_min, e.y_min, e.x_max, e.y_max) for e in entries], dtype=np.float64).reshape(-1, 4)
+
+        root = self.root
 
-    def find_nearest_neighbor_internal(self, node: QuadtreeNode, point: Point, nearest: Entry | None, min_distance):
-        if node is None:
-            return nearest, min_distance
+        outside = ((bounds[:, 0] < root.x_min) | (bounds[:, 1] < root.y_min) |
+                   (bounds[:, 2] > root.x_max) | (bounds[:, 3] > root.y_max))
 
-        candidate, candidate_distance = get_nearest(node.entries, point)
+        if outside.any():
+            raise ValueError("ElementOutside")
 
-        if candidate_distance < min_distance:
-            nearest = candidate
-            min_distance = candidate_distance
+        root.entries = []
+        root.top_left = root.top_right = root.bottom_left = root.bottom_right = None
 
-        if not node.is_leaf():
-            nodes = list(map(lambda n: [n, distance(n, point)],
-                             [node.top_left, node.top_right, node.bottom_right, node.bottom_left]))
-            nodes = sorted(nodes, key=lambda n: n[1])
+        bits = min(self.max_depth, 32)
+        cells = 1 << bits
+
+        # Номера ячеек: для минимума - ячейка, чья левая граница строго меньше координаты,
+        # для максимума - ячейка, чья правая граница строго больше. Так общий префикс дает строгое содержание.
+        scale = np.array([cells / (root.x_max - root.x_min), cells / (root.y_max - root.y_min)])
+        low = np.ceil((bounds[:, :2] - (root.x_min, root.y_min)) * scale) - 1
+        high = np.floor((bounds[:, 2:] - (root.x_min, root.y_min)) * scale)
+
+        # Касающиеся границы корня не лежат строго ни в одном квадранте
+        touches = (low < 0).any(axis=1) | (high >= cells).any(axis=1)
+
+        low = np.clip(low, 0, cells - 1).astype(np.uint64)
+        high = np.clip(high, 0, cells - 1).astype(np.uint64)
+
+        z_min = z_encode_many(low[:, 0], low[:, 1])
+        target = np.where(touches, 0, z_common_level(z_min, z_encode_many(high[:, 0], high[:, 1]), bits))
+
+        # Обход по уровням: на каждом уровне все записи обрабатываются одним векторным шагом
+        nodes = [root]
+        node_ids = np.zeros(1, dtype=np.int64)
+        node_bounds = np.array([[root.x_min, root.y_min, root.x_max, root.y_max]])
+        all_nodes = [root]
+
+        rows = np.arange(len(entries))
+        row_nodes = np.zeros(len(entries), dtype=np.int64)
+
+        placed_nodes, placed_rows = [], []
+
+        for depth in range(self.max_depth + 1):
+            divided = np.bincount(row_nodes, minlength=len(nodes)) >= self.bucket_capacity
+
+            if depth + 1 > self.max_depth:
+                divided[:] = False
+
+            goes_down = divided[row_nodes] & (target[rows] > depth)
 
-            for node in nodes:
-                if node[1] < min_distance:
-                    nearest, min_distance = self.find_nearest_neighbor_internal(node[0], point, nearest, min_distance)
+            # Квадрант: младший бит - правая половина (x), старший - верхняя (y)
+            quadrant = np.zeros(len(rows), dtype=np.int64)
 
-        return nearest, min_distance
+            if goes_down.any():
+                shift = np.uint64(2 * (bits - 1 - depth))
+                quadrant[goes_down] = ((z_min[rows[goes_down]] >> shift) & np.uint64(3)).astype(np.int64)
+
+            # Границы потомков в порядке квадрантов, та же арифметика, что в create_children
+            parents = node_bounds[divided]
+            mid_x, mid_y = (parents[:, 0] + parents[:, 2]) / 2, (parents[:, 1] + parents[:, 3]) / 2
+
+            child_bounds = np.stack([
+                np.column_stack([parents[:, 0], parents[:, 1], mid_x, mid_y]),
+                np.column_stack([mid_x, parents[:, 1], parents[:, 2], mid_y]),
+                np.column_stack([parents[:, 0], mid_y, mid_x, parents[:, 3]]),
+                np.column_stack([mid_x, mid_y, parents[:, 2], parents[:, 3]]),
+            ], axis=1).reshape(-1, 4)
+
+            child_of_row = 4 * (np.cumsum(divided) - 1)[row_nodes] + quadrant
+
+            # Квантование только подсказывает потомка, строгое содержание проверяется по его настоящим границам
+            b, c = bounds[rows[goes_down]], child_bounds[child_of_row[goes_down]]
+            goes_down[goes_down] = ((b[:, 0] > c[:, 0]) & (b[:, 2] < c[:, 2]) &
+                                    (b[:, 1] > c[:, 1]) & (b[:, 3] < c[:, 3]))
+
+            placed_nodes.append(node_ids[row_nodes[~goes_down]])
+            placed_rows.append(rows[~goes_down])
+
+            if not divided.any():
+                break
+
+            children = []
+            for node in (nodes[i] for i in np.flatnonzero(divided).tolist()):
+                create_children(node)
+                children += [node.bottom_left, node.bottom_right, node.top_left, node.top_right]
+
+            nodes = children
+            node_ids = np.arange(len(all_nodes), len(all_nodes) + len(children))
+            node_bounds = child_bounds
+            all_nodes += children
+
+            rows, row_nodes = rows[goes_down], child_of_row[goes_down]
+
+        placed_nodes, placed_rows = np.concatenate(placed_nodes), np.concatenate(placed_rows)
+        order = np.lexsort((placed_rows, placed_nodes))
+        placed_nodes, placed_rows = placed_nodes[order], placed_rows[order]
+
+        starts = np.flatnonzero(np.r_[True, placed_nodes[1:] != placed_nodes[:-1]]) if len(order) > 0 else []
+
+        for start, end in zip(starts, list(starts[1:]) + [len(order)]):
+            all_nodes[placed_nodes[start]].entries = list(map(entries.__getitem__, placed_rows[start:end].tolist()))
+
+        return self
+
+    def find_nearest_neighbor(self, point: Point):
+        nearest = next(self.nearest_entries(point), None)
+        return nearest[0].shape if nearest is not None else None
+
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        return nearest_iter(self.root, point, max_distance)
 
     def search(self, search: Geometry):
         search_box = geometry_to_box(search)
 
-        if contains(self.root, search_box):
-            candidates = self.internal_search(self.root, search_box)
-            shapes = list(map(lambda e: e.shape, candidates))
-            return list(filter(lambda s: s.intersects(search), shapes))
+        if self.covers(search_box):
+            return refine(collect_candidates(self.root, search_box), search)
         else:
             return None
 
-    def internal_search(self, node: QuadtreeNode, search_box: BoundaryBox) -> List[Entry]:
-        search_result = list(filter(lambda n: intersection(n, search_box), node.entries))
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return collect_candidates(self.root, search_box)
 
-        if not node.is_leaf():
-            for child in [node.top_left, node.top_right, node.bottom_right, node.bottom_left]:
-                if intersection(child, search_box):
-                    search_result.extend(self.internal_search(child, search_box))
+    def iter_candidates(self, search_box: BoundaryBox) -> Iterator[Entry]:
+        return iter_candidates(self.root, search_box)
+
+    def covers(self, search_box: BoundaryBox) -> bool:
+        return contains(self.root, search_box)
+
+
+def create_children(node: QuadtreeNode):
+    depth = node.depth + 1
+
+    midx, midy = (node.x_min + node.x_max) / 2, (node.y_min + node.y_max) / 2
+
+    node.top_left = QuadtreeNode(node.x_min, midy, midx, node.y_max, depth)
+
+    node.top_right = QuadtreeNode(midx, midy, node.x_max, node.y_max, depth)
+
+    node.bottom_left = QuadtreeNode(node.x_min, node.y_min, midx, midy, depth)
 
-        return search_result
+    node.bottom_right = QuadtreeNode(midx, node.y_min, node.x_max, midy, depth)
 
 
 def plot_quad_tree(tree: Quadtree):
@@ -1,398 +1,237 @@
-# from __future__ import annotations
-#
-# from typing import List
-#
-# import shapely
-# from shapely import Geometry, Polygon
-#
-# from shapely_plot import add_to_plot_geometry
-#
-#
-# class BoundaryBox:
-#     def __init__(self, x_min, y_min, x_max, y_max):
-#         self.x_min = x_min
-#         self.y_min = y_min
-#         self.x_max = x_max
-#         self.y_max = y_max
-#
-#     def area(self) -> float:
-#         return (self.x_max - self.x_min) * (self.y_max - self.y_min)
-#
-#
-# class Entry(BoundaryBox):
-#     def __init__(self, shape: Geometry):
-#         x_min, y_min, x_max, y_max = (shapely.envelope(shape)).bounds
-#         super().__init__(x_min, y_min, x_max, y_max)
-#         self.shape = shape
-#
-#
-# class RPlusTreeNode(BoundaryBox):
-#     def __init__(self, children: List[RPlusTreeNode | Entry] | None = None, parent: RPlusTreeNode = None,
-#                  is_leaf: bool = False):
-#         mbr = union(*children)
-#         super().__init__(mbr.x_min, mbr.y_min, mbr.x_max, mbr.y_max)
-#         self.children = children
-#         self.parent = parent
-#         self.is_leaf = is_leaf
-#
-#     def add_child(self, node: RPlusTreeNode | Entry):
-#         self.children.append(node)
-#
-#
-# def union(*boundaries: BoundaryBox):
-#     minx, miny, = float('inf'), float('inf')
-#     maxx, maxy = float('-inf'), float('-inf')
-#
-#     for boundary in boundaries:
-#         minx, miny = min(boundary.x_min, minx), min(boundary.y_min, miny)
-#         maxx, maxy = max(boundary.x_max, maxx), max(boundary.y_max, maxy)
-#
-#     return BoundaryBox(minx, miny, maxx, maxy)
-#
-#
-# def intersection(rect1: BoundaryBox, rect2: BoundaryBox) -> bool:
-#     return (rect1.x_min <= rect2.x_max and
-#             rect1.x_max >= rect2.x_min and
-#             rect1.y_min <= rect2.y_max and
-#             rect1.y_max >= rect2.y_min)
-#
-#
-# def box_to_geometry(box: BoundaryBox):
-#     return shapely.box(box.x_min, box.y_min, box.x_max, box.y_max)
-#
-#
-# def geometry_to_box(shape: Geometry):
-#     x_min, y_min, x_max, y_max = Polygon(shapely.envelope(shape)).bounds
-#     return BoundaryBox(x_min, y_min, x_max, y_max)
-#
-#
-# def _sweep(children: List[RPlusTreeNode], axis):
-#     temp_left = [child.x_min if axis == 0 else child.y_min for child in children]
-#     temp_right = [child.x_max if axis == 0 else child.y_max for child in children]
-#
-#     # temp_left.sort()
-#     # temp_right.sort()
-#     #
-#     # if temp_left[0] == temp_left[-1] or temp_right[0] == temp_right[-1]:
-#     #     return float('-inf')
-#     #
-#     # cutLine = temp_left[len(children) // 2]
-#     # if temp_left[0] == cutLine:
-#     #     for i in range(len(children) // 2 + 1, len(children)):
-#     #         if temp_left[i] != cutLine:
-#     #             cutLine = temp_left[i]
-#     #             break
-#
-#     all_coords = [*temp_left, *temp_right]
-#     all_coords.sort()
-#
-#     if len(all_coords) % 2 == 1:
-#         # Нечетное количество элементов, возвращаем одну точку
-#         cutLine = all_coords[len(all_coords) // 2]
-#     else:
-#         # Четное количество элементов, возвращаем две точки
-#         median_1 = all_coords[len(all_coords) // 2 - 1]
-#         median_2 = all_coords[len(all_coords) // 2]
-#         cutLine = (median_1 + median_2) / 2
-#
-#     return cutLine
-#
-#
-# def _evaluate(children: List[RPlusTreeNode]):
-#     cutLine_x = _sweep(children, 0)
-#     cutLine_y = _sweep(children, 1)
-#
-#     if cutLine_x == float('-inf') or cutLine_y == float('-inf'):
-#         return [1, cutLine_y] if cutLine_x == float('-inf') else [0, cutLine_x]
-#
-#     num_cut_x = sum(1 for c in children if c.x_min < cutLine_x < c.x_max)
-#     num_cut_y = sum(1 for c in children if c.y_min < cutLine_y < c.y_max)
-#
-#     return [0, cutLine_x] if num_cut_x < num_cut_y else [1, cutLine_y]
-#
-#
-# def _needCut(node: RPlusTreeNode, cut_info: List[int | float]):
-#     axis = int(cut_info[0])
-#     cutLine = cut_info[1]
-#
-#     if (node.x_min if axis == 0 else node.y_min) < cutLine and (node.x_max if axis == 0 else node.y_max) <= cutLine:
-#         return 1
-#     elif (node.x_min if axis == 0 else node.y_min) >= cutLine:
-#         return 2
-#     else:
-#         return 0
-#
-#
-# def _partition(node: RPlusTreeNode | Entry, cut_info: List[int | float]):
-#     axis = int(cut_info[0])
-#     cutLine = cut_info[1]
-#
-#     if not isinstance(node, Entry):
-#         nn = [RPlusTreeNode(node.children.copy(), None, node.is_leaf),
-#               RPlusTreeNode(node.children.copy(), None, node.is_leaf)]
-#
-#         nn[0].children.clear()
-#         nn[1].children.clear()
-#
-#         if axis == 0:
-#             nn[0].x_min = node.x_min
-#         else:
-#             nn[0].y_min = node.y_min
-#
-#         if axis == 0:
-#             nn[0].x_max = cutLine
-#         else:
-#             nn[0].y_max = cutLine
-#
-#         if axis == 0:
-#             nn[1].x_min = cutLine
-#         else:
-#             nn[1].y_min = cutLine
-#
-#         if axis == 0:
-#             nn[1].x_max = node.x_max
-#         else:
-#             nn[1].y_max = node.y_max
-#
-#         for child in node.children:
-#             result = _needCut(child, cut_info)
-#             if result == 1:
-#                 nn[0].add_child(child)
-#                 child.parent = nn[0]
-#             elif result == 2:
-#                 nn[1].add_child(child)
-#                 child.parent = nn[1]
-#             else:
-#                 splits = _partition(child, cut_info)
-#                 nn[0].add_child(splits[0])
-#                 splits[0].parent = nn[0]
-#                 nn[1].add_child(splits[1])
-#                 splits[1].parent = nn[1]
-#
-#         # if len(nn[0].children) == 0 or len(nn[1].children) == 0:
-#         #     print('asdad')
-#
-#         return nn
-#     else:
-#         ee = [Entry(node.shape), Entry(node.shape)]
-#
-#         if axis == 0:
-#             ee[0].x_min = node.x_min
-#         else:
-#             ee[0].y_min = node.y_min
-#
-#         if axis == 0:
-#             ee[0].x_max = cutLine
-#         else:
-#             ee[0].y_max = cutLine
-#
-#         if axis == 0:
-#             ee[1].x_min = cutLine
-#         else:
-#             ee[1].y_min = cutLine
-#
-#         if axis == 0:
-#             ee[1].x_max = node.x_max
-#         else:
-#             ee[1].y_max = node.y_max
-#
-#         return ee
-#
-#
-# def _assign(node: RPlusTreeNode, cut_info: List[int | float]):
-#     result = _needCut(node, cut_info)
-#
-#     if result == 1:
-#         return [node, None]
-#     elif result == 2:
-#         return [None, node]
-#     else:
-#         nn = _partition(node, cut_info)
-#         return nn
-#
-#
-# def _tighten(*nodes: RPlusTreeNode):
-#     for node in nodes:
-#         minx, miny, = float('inf'), float('inf')
-#         maxx, maxy = float('-inf'), float('-inf')
-#
-#         # if len(node.children) == 0:
-#         #     print('asdad')
-#
-#         for child in node.children:
-#             child.parent = node
-#
-#             minx = min(minx, child.x_min)
-#             miny = min(miny, child.y_min)
-#
-#             maxx = max(maxx, child.x_max)
-#             maxy = max(maxy, child.y_max)
-#
-#         # if maxx == float('-inf') or miny == float('inf'):
-#         #     print("sda")
-#
-#         node.x_min, node.y_min = minx, miny
-#         node.x_max, node.y_max = maxx, maxy
-#
-#
-# def _chooseLeaves(node: RPlusTreeNode, entry: Entry):
-#     result: List[RPlusTreeNode] = []
-#
-#     if node is None:
-#         print('node is None')
-#
-#     if node.is_leaf or len(node.children) == 0:
-#         result.append(node)
-#     else:
-#         overlap = False
-#
-#         for child in node.children:
-#             if intersection(child, entry):
-#                 overlap = True
-#                 result.extend(_chooseLeaves(child, entry))
-#
-#         if not overlap:
-#             min_increase = float('inf')
-#             next_node = None
-#
-#             for child in node.children:
-#                 increase = union(child, entry).area() - child.area()
-#                 if increase < min_increase:
-#                     min_increase = increase
-#                     next_node = child
-#                 elif increase == min_increase and child.area() < next_node.area():
-#                     next_node = child
-#
-#             result.extend(_chooseLeaves(next_node, entry))
-#
-#     return result
-#
-#
-# # TODO Получается, перекрытия разрешаются только при переполнении узла. При вставке элемента в несколько узлов,
-# #  каждый узел увеличивается чтобы полностью содержать элемент => появляются перекрытия
-# class RPlusTree(object):
-#     def __init__(self, max_node_capacity=4):
-#         self.root = RPlusTreeNode([], None, True)
-#         self.max_node_capacity = max_node_capacity
-#
-#     def insert(self, shape: Geometry):
-#         entry = Entry(shape)
-#
-#         leaves = _chooseLeaves(self.root, entry)
-#
-#         for leaf in leaves:
-#             leaf.add_child(entry)
-#             entry.parent = leaf
-#
-#             if len(leaf.children) > self.max_node_capacity:
-#                 splits = self._splitNode(leaf)
-#                 self._adjustTree(splits[0], splits[1])
-#             else:
-#                 self._adjustTree(leaf, None)
-#
-#     def _adjustTree(self, node: RPlusTreeNode, new_node: RPlusTreeNode | None):
-#         if node == self.root:
-#             if new_node is not None:
-#                 self.root = RPlusTreeNode([], None, False)
-#
-#                 self.root.add_child(node)
-#                 node.parent = self.root
-#
-#                 self.root.add_child(new_node)
-#                 new_node.parent = self.root
-#
-#             _tighten(self.root)
-#         else:
-#             _tighten(node)
-#
-#             if new_node is not None:
-#                 _tighten(new_node)
-#
-#                 if len(node.parent.children) > self.max_node_capacity:
-#                     splits = self._splitNode(node.parent)
-#                     self._adjustTree(splits[0], splits[1])
-#
-#             if node.parent is not None:
-#                 self._adjustTree(node.parent, None)
-#
-#     def search(self, search: Geometry):
-#         search_box = geometry_to_box(search)
-#
-#         if intersection(self.root, search_box):
-#             entries = self.internal_search(self.root, search_box)
-#             return list(map(lambda e: box_to_geometry(e), entries))
-#         else:
-#             return None
-#
-#     def internal_search(self, node: RPlusTreeNode, search_box: BoundaryBox) -> List[Entry]:
-#         search_result: List[Entry] | None = []
-#
-#         if node.is_leaf:
-#             search_result = list(filter(lambda n: intersection(n, search_box), node.children))
-#         else:
-#             for child in node.children:
-#                 if intersection(child, search_box):
-#                     search_result.extend(self.internal_search(child, search_box))
-#
-#         return search_result
-#
-#     def _splitNode(self, node: RPlusTreeNode):
-#         cc = node.children.copy()
-#         node.children.clear()
-#
-#         nn = [node, RPlusTreeNode(node.children.copy(), node.parent, node.is_leaf)]
-#
-#         if nn[1].parent is not None:
-#             nn[1].parent.add_child(nn[1])
-#
-#         cut_info = _evaluate(cc)
-#
-#         for child in cc:
-#             result = _assign(child, cut_info)
-#
-#             if result[0] is not None:
-#                 nn[0].add_child(result[0])
-#                 result[0].parent = nn[0]
-#
-#             if result[1] is not None:
-#                 nn[1].add_child(result[1])
-#                 result[1].parent = nn[1]
-#
-#         # if len(nn[0].children) == 0 or len(nn[1].children) == 0:
-#         #     print('asdad')
-#
-#         _tighten(*nn)
-#
-#         return nn
-#
-#
-# def plot_r_plus_tree(r_tree: RPlusTree):
-#     plot_r_plus_node_recursive(r_tree.root, 0)
-#
-#
-# def plot_get_color(depth: int):
-#     return 'white' if depth == 0 else 'black'
-#     # return ['orange', 'black', 'grey', 'blue', 'brown', 'violet', 'pink', 'purple', 'indigo'][depth]
-#
-#
-# def plot_r_plus_node(node: RPlusTreeNode, color: str):
-#     add_to_plot_geometry(shapely.box(node.x_min, node.y_min, node.x_max, node.y_max), color)
-#
-#
-# def plot_r_plus_node_recursive(node: RPlusTreeNode, depth: int):
-#     plot_r_plus_node(node, plot_get_color(depth))
-#
-#     if node.is_leaf:
-#         return
-#
-#     for child in node.children:
-#         plot_r_plus_node_recursive(child, depth + 1)
-#
-#
-# def build_r_plus_tree(entries: List[Geometry], max_node_capacity):
-#     kd_tree = RPlusTree(max_node_capacity)
-#
-#     for entry in entries:
-#         kd_tree.insert(entry)
-#
-#     return kd_tree
+from __future__ import annotations
+
+from typing import List, Tuple, Iterator
+
+import shapely
+from shapely import Geometry, Point
+
+from common import BoundaryBox, Entry, union, intersection, geometry_to_box, nearest_iter, refine, \
+    collect_candidates, iter_candidates, SpatialIndex
+from shapely_plot import add_to_plot_geometry
+
+INF = float('inf')
+
+
+class RPlusTreeNode(BoundaryBox):
+    """
+    Узел R+-дерева. region - область пространства, за которую отвечает узел (области соседних узлов не перекрываются),
+    сам BoundaryBox узла - MBR частей записей, обрезанных по region.
+    Запись, пересекающая несколько областей, хранится в каждом листе, в области которого лежит ее часть.
+    """
+
+    __slots__ = ('region', 'children', 'is_leaf')
+
+    def __init__(self, region: BoundaryBox, children: List[RPlusTreeNode | Entry] | None = None,
+                 is_leaf: bool = False):
+        super().__init__(INF, INF, -INF, -INF)
+        self.region = region
+        self.children = children if children is not None else []
+        self.is_leaf = is_leaf
+        self.tighten()
+
+    def add_child(self, node: RPlusTreeNode | Entry):
+        self.children.append(node)
+
+    def expand(self):
+        return (self.children, []) if self.is_leaf else ([], self.children)
+
+    def tighten(self):
+        mbr = union(*map(lambda c: clip(c, self.region) if self.is_leaf else c, self.children))
+        self.x_min, self.y_min, self.x_max, self.y_max = mbr.x_min, mbr.y_min, mbr.x_max, mbr.y_max
+
+
+def clip(box: BoundaryBox, region: BoundaryBox) -> BoundaryBox:
+    return BoundaryBox(max(box.x_min, region.x_min), max(box.y_min, region.y_min),
+                       min(box.x_max, region.x_max), min(box.y_max, region.y_max))
+
+
+def _extent(box: BoundaryBox, axis: int) -> Tuple[float, float]:
+    return (box.x_min, box.x_max) if axis == 0 else (box.y_min, box.y_max)
+
+
+def _split_region(region: BoundaryBox, axis: int, cut_line: float) -> Tuple[BoundaryBox, BoundaryBox]:
+    if axis == 0:
+        return (BoundaryBox(region.x_min, region.y_min, cut_line, region.y_max),
+                BoundaryBox(cut_line, region.y_min, region.x_max, region.y_max))
+
+    return (BoundaryBox(region.x_min, region.y_min, region.x_max, cut_line),
+            BoundaryBox(region.x_min, cut_line, region.x_max, region.y_max))
+
+
+def _child_extent(node: RPlusTreeNode, child: RPlusTreeNode | Entry, axis: int) -> Tuple[float, float]:
+    # Для записей важна только часть внутри области узла, для узлов - их собственная область
+    if node.is_leaf:
+        return _extent(clip(child, node.region), axis)
+
+    return _extent(child.region, axis)
+
+
+def _need_cut(low: float, high: float, cut_line: float):
+    # 1 - целиком слева, 2 - целиком справа, 0 - пересекает линию разреза
+    if high <= cut_line:
+        return 1
+    elif low >= cut_line:
+        return 2
+    else:
+        return 0
+
+
+def _evaluate(node: RPlusTreeNode) -> Tuple[int, float] | None:
+    """
+    Выбор оси и линии разреза: минимум разрезаемых детей, при равенстве - наиболее равные половины.
+    Возвращает None, если ни один разрез не уменьшает обе половины (например, совпадающие точки).
+    """
+    total = len(node.children)
+    best, best_cost = None, None
+
+    for axis in [0, 1]:
+        extents = [_child_extent(node, child, axis) for child in node.children]
+        candidates = sorted(set(v for extent in extents for v in extent if -INF < v < INF))
+
+        for cut_line in candidates:
+            left, right, cut = 0, 0, 0
+
+            for low, high in extents:
+                result = _need_cut(low, high, cut_line)
+                if result == 1:
+                    left += 1
+                elif result == 2:
+                    right += 1
+                else:
+                    cut += 1
+
+            if left + cut == 0 or right + cut == 0 or left + cut >= total or right + cut >= total:
+                continue
+
+            cost = (cut, abs(left - right))
+            if best_cost is None or cost < best_cost:
+                best, best_cost = (axis, cut_line), cost
+
+    return best
+
+
+def _partition(node: RPlusTreeNode, axis: int, cut_line: float) -> Tuple[RPlusTreeNode, RPlusTreeNode]:
+    left_region, right_region = _split_region(node.region, axis, cut_line)
+    left, right = [], []
+
+    for child in node.children:
+        result = _need_cut(*_child_extent(node, child, axis), cut_line)
+
+        if result == 1:
+            left.append(child)
+        elif result == 2:
+            right.append(child)
+        elif node.is_leaf:
+            # Запись попадает в обе половины, каждая видит только свою часть
+            left.append(child)
+            right.append(child)
+        else:
+            # Разрез проходит через дочерний узел - делим его рекурсивно вниз
+            child_left, child_right = _partition(child, axis, cut_line)
+            left.append(child_left)
+            right.append(child_right)
+
+    return (RPlusTreeNode(left_region, left, node.is_leaf),
+            RPlusTreeNode(right_region, right, node.is_leaf))
+
+
+class RPlusTree(SpatialIndex):
+    def __init__(self, max_node_capacity=4):
+        self.root = RPlusTreeNode(BoundaryBox(-INF, -INF, INF, INF), [], True)
+        self.max_node_capacity = max_node_capacity
+
+    def insert(self, entry: Entry):
+        self.internal_insert(self.root, entry)
+
+        if len(self.root.children) > self.max_node_capacity:
+            splits = self.split_node(self.root)
+
+            if splits is not None:
+                self.root = RPlusTreeNode(self.root.region, list(splits), False)
+
+    def internal_insert(self, node: RPlusTreeNode, entry: Entry):
+        if node.is_leaf:
+            node.add_child(entry)
+        else:
+            children = []
+
+            for child in node.children:
+                if intersection(child.region, entry):
+                    self.internal_insert(child, entry)
+
+                    if len(child.children) > self.max_node_capacity:
+                        splits = self.split_node(child)
+
+                        if splits is not None:
+                            children.extend(splits)
+                            continue
+
+                children.append(child)
+
+            node.children = children
+
+        node.tighten()
+
+    def split_node(self, node: RPlusTreeNode) -> Tuple[RPlusTreeNode, RPlusTreeNode] | None:
+        cut_info = _evaluate(node)
+
+        # Разделить нельзя - узел остается переполненным
+        if cut_info is None:
+            return None
+
+        return _partition(node, *cut_info)
+
+    def search(self, search: Geometry):
+        search_box = geometry_to_box(search)
+
+        candidates = collect_candidates(self.root, search_box)
+        # Одна запись может лежать в нескольких листах - убираем повторы
+        return refine(list({id(e): e for e in candidates}.values()), search)
+
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return collect_candidates(self.root, search_box)
+
+    def iter_candidates(self, search_box: BoundaryBox) -> Iterator[Entry]:
+        return iter_candidates(self.root, search_box)
+
+    def find_nearest_neighbor(self, point: Point):
+        nearest = next(self.nearest_entries(point), None)
+        return nearest[0].shape if nearest is not None else None
+
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        return nearest_iter(self.root, point, max_distance)
+
+
+def plot_r_plus_tree(r_tree: RPlusTree):
+    plot_r_plus_node_recursive(r_tree.root, 0)
+
+
+def plot_get_color(depth: int):
+    return 'white' if depth == 0 else 'black'
+    # return ['orange', 'black', 'grey', 'blue', 'brown', 'violet', 'pink', 'purple', 'indigo'][depth]
+
+
+def plot_r_plus_node(node: RPlusTreeNode, color: str):
+    add_to_plot_geometry(shapely.box(node.x_min, node.y_min, node.x_max, node.y_max), color)
+
+
+def plot_r_plus_node_recursive(node: RPlusTreeNode, depth: int):
+    if len(node.children) == 0:
+        return
+
+    plot_r_plus_node(node, plot_get_color(depth))
+
+    if node.is_leaf:
+        return
+
+    for child in node.children:
+        plot_r_plus_node_recursive(child, depth + 1)
+
+
+def build_r_plus_tree(entries: List[Entry], max_node_capacity):
+    tree = RPlusTree(max_node_capacity)
+
+    for entry in entries:
+        tree.insert(entry)
+
+    return tree
@@ -0,0 +1,303 @@
+from __future__ import annotations
+
+import math
+from typing import List, Tuple, Iterator
+
+import shapely
+from shapely import Geometry, Point
+
+from common import BoundaryBox, Entry, union, enlargement, union_area, geometry_to_box, nearest_iter, \
+    refine, collect_candidates, iter_candidates, SpatialIndex
+from shapely_plot import add_to_plot_geometry
+
+EPSILON = 1e-5
+
+# Доля записей, которые переставляются при первом переполнении уровня (по статье R*-tree - 30%)
+REINSERT_FRACTION = 0.3
+
+# Минимальное заполнение узла относительно max_node_capacity (по статье R*-tree - 40%)
+MIN_FILL = 0.4
+
+# При выборе листа по перекрытию рассматриваются только ближайшие по увеличению площади узлы
+CHOOSE_SUBTREE_CANDIDATES = 32
+
+
+class RStarTreeNode(BoundaryBox):
+    __slots__ = ('children', 'is_leaf')
+
+    def __init__(self, children: List[RStarTreeNode | Entry] | None = None, is_leaf: bool = False):
+        mbr = union(*children)
+        super().__init__(mbr.x_min, mbr.y_min, mbr.x_max, mbr.y_max)
+        self.children = children
+        self.is_leaf = is_leaf
+
+    def add_child(self, node: RStarTreeNode | Entry):
+        self.children.append(node)
+
+    def expand(self):
+        return (self.children, []) if self.is_leaf else ([], self.children)
+
+    def tighten(self):
+        mbr = union(*self.children)
+        self.x_min, self.y_min, self.x_max, self.y_max = mbr.x_min, mbr.y_min, mbr.x_max, mbr.y_max
+
+
+class RStarTree(SpatialIndex):
+    def __init__(self, max_node_capacity=4):
+        self.root = RStarTreeNode([], True)
+        self.max_node_capacity = max_node_capacity
+        self.min_node_capacity = max(1, math.floor(MIN_FILL * max_node_capacity))
+
+        # Высота дерева: уровень листьев = 0, уровень корня = height
+        self.height = 0
+
+        self._reinserted_levels = set()
+        self._pending: List[Tuple[RStarTreeNode | Entry, int]] = []
+
+    def insert(self, entry: Entry):
+        # Принудительная перевставка выполняется не более одного раза на уровень за одну вставку
+        self._reinserted_levels = set()
+        self._pending = [(entry, 0)]
+
+        while len(self._pending) > 0:
+            item, level = self._pending.pop(0)
+            self.insert_at_level(item, level)
+
+    def insert_at_level(self, item: RStarTreeNode | Entry, level: int):
+        split_node = self.internal_insert(self.root, self.height, item, level)
+
+        if split_node is not None:
+            self.root = RStarTreeNode([self.root, split_node], False)
+            self.height += 1
+
+    def internal_insert(self, node: RStarTreeNode, node_level: int, item: RStarTreeNode | Entry,
+                        item_level: int) -> RStarTreeNode | None:
+        if node_level == item_level:
+            node.add_child(item)
+        else:
+            child = self.choose_subtree(node, node_level, item)
+            split_node = self.internal_insert(child, node_level - 1, item, item_level)
+
+            if split_node is not None:
+                node.add_child(split_node)
+
+        if len(node.children) > self.max_node_capacity:
+            return self.overflow_treatment(node, node_level)
+
+        node.tighten()
+
+        return None
+
+    def choose_subtree(self, node: RStarTreeNode, node_level: int, item: BoundaryBox) -> RStarTreeNode:
+        if node_level == 1:
+            # Дети - листья: минимизируем увеличение перекрытия
+            candidates = node.children
+
+            if len(candidates) > CHOOSE_SUBTREE_CANDIDATES:
+                candidates = sorted(candidates, key=lambda c: enlargement(c, item))
+                candidates = candidates[:CHOOSE_SUBTREE_CANDIDATES]
+
+            return least_overlap_enlargement(candidates, node.children, item)
+
+        return least_area_enlargement(node.children, item)
+
+    def overflow_treatment(self, node: RStarTreeNode, level: int) -> RStarTreeNode | None:
+        if node is not self.root and level not in self._reinserted_levels:
+            self._reinserted_levels.add(level)
+            self.reinsert(node, level)
+            return None
+
+        split_node = self.rstar_split(node)
+        node.tighten()
+        return split_node
+
+    def reinsert(self, node: RStarTreeNode, level: int):
+        """
+        Принудительная перевставка: из переполненного узла удаляются p записей, наиболее удаленных от его центра,
+        и вставляются заново на тот же уровень, начиная с ближайшей ("close reinsert").
+        """
+        cx, cy = node.centroid()
+        sorted_children = sorted(node.children, key=lambda c: _square_dist(c.centroid(), (cx, cy)), reverse=True)
+
+        p = math.ceil(REINSERT_FRACTION * len(sorted_children))
+
+        node.children = sorted_children[p:]
+        node.tighten()
+
+        for child in reversed(sorted_children[:p]):
+            self._pending.append((child, level))
+
+    def rstar_split(self, node: RStarTreeNode) -> RStarTreeNode:
+        """
+        Разделение переполненного узла: сначала выбирается ось с минимальным суммарным периметром
+        всех допустимых распределений, затем на этой оси - распределение с минимальным перекрытием.
+        Исходный узел оставляет себе первую группу, возвращается новый узел со второй группой.
+        """
+        axis = choose_split_axis(node.children, self.min_node_capacity)
+        distributions = get_axis_distributions(node.children, axis, self.min_node_capacity)
+        group_1, group_2 = distributions[choose_split_index(distributions)]
+
+        node.children = group_1
+        return RStarTreeNode(group_2, node.is_leaf)
+
+    def search(self, search: Geometry):
+        search_box = geometry_to_box(search)
+
+        return refine(collect_candidates(self.root, search_box), search)
+
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return collect_candidates(self.root, search_box)
+
+    def iter_candidates(self, search_box: BoundaryBox) -> Iterator[Entry]:
+        return iter_candidates(self.root, search_box)
+
+    def find_nearest_neighbor(self, point: Point):
+        nearest = next(self.nearest_entries(point), None)
+        return nearest[0].shape if nearest is not None else None
+
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        return nearest_iter(self.root, point, max_distance)
+
+
+def _square_dist(p1, p2):
+    return (p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2
+
+
+def _get_sort_keys(axis: int):
+    if axis == 0:
+        return [lambda e: (e.x_min, e.x_max), lambda e: (e.x_max, e.x_min)]
+    return [lambda e: (e.y_min, e.y_max), lambda e: (e.y_max, e.y_min)]
+
+
+def get_possible_divisions(entries: List[RStarTreeNode | Entry], min_entries: int):
+    """
+    Все разбиения упорядоченного списка на две группы (с сохранением порядка),
+    где в каждой группе не меньше min_entries записей.
+    """
+    return [(entries[:k], entries[k:]) for k in range(min_entries, len(entries) - min_entries + 1)]
+
+
+def _prefix_boxes(entries: List[BoundaryBox]) -> List[BoundaryBox]:
+    boxes = []
+    current = None
+
+    for entry in entries:
+        current = union(current, entry) if current is not None else union(entry)
+        boxes.append(current)
+
+    return boxes
+
+
+def get_axis_margin(entries: List[RStarTreeNode | Entry], axis: int, min_entries: int) -> float:
+    margin = 0.0
+
+    for key in _get_sort_keys(axis):
+        sorted_entries = sorted(entries, key=key)
+
+        # MBR префиксов и суффиксов считаются за один проход вместо union для каждого разбиения
+        prefix = _prefix_boxes(sorted_entries)
+        suffix = _prefix_boxes(sorted_entries[::-1])[::-1]
+
+        for k in range(min_entries, len(entries) - min_entries + 1):
+            margin += prefix[k - 1].perimeter() + suffix[k].perimeter()
+
+    return margin
+
+
+def choose_split_axis(entries: List[RStarTreeNode | Entry], min_entries: int) -> int:
+    margin_x = get_axis_margin(entries, 0, min_entries)
+    margin_y = get_axis_margin(entries, 1, min_entries)
+    return 0 if margin_x <= margin_y else 1
+
+
+def get_axis_distributions(entries: List[RStarTreeNode | Entry], axis: int, min_entries: int):
+    distributions = []
+
+    for key in _get_sort_keys(axis):
+        distributions.extend(get_possible_divisions(sorted(entries, key=key), min_entries))
+
+    return distributions
+
+
+def choose_split_index(distributions) -> int:
+    """
+    Выбирает распределение с минимальным перекрытием групп, при равенстве - с минимальной суммарной площадью.
+    """
+    division_rects = [(union(*d1), union(*d2)) for d1, d2 in distributions]
+    division_overlaps = [get_intersection_area(r1, r2) for r1, r2 in division_rects]
+    min_overlap = min(division_overlaps)
+    indices = [i for i, v in enumerate(division_overlaps) if math.isclose(v, min_overlap, rel_tol=EPSILON)]
+
+    if len(indices) == 1:
+        return indices[0]
+
+    return min(indices, key=lambda i: division_rects[i][0].area() + division_rects[i][1].area())
+
+
+def least_overlap_enlargement(candidates: List[RStarTreeNode], nodes: List[RStarTreeNode],
+                              entry: BoundaryBox) -> RStarTreeNode:
+    enlargements = []
+
+    for node in candidates:
+        enlarged = union(node, entry)
+        others = [n for n in nodes if n is not node]
+        enlargements.append(overlap(enlarged, others) - overlap(node, others))
+
+    min_enlargement = min(enlargements)
+    indices = [i for i, v in enumerate(enlargements) if math.isclose(v, min_enlargement, rel_tol=EPSILON)]
+
+    if len(indices) == 1:
+        return candidates[indices[0]]
+
+    # При равном увеличении перекрытия - по увеличению площади
+    return least_area_enlargement([candidates[i] for i in indices], entry)
+
+
+def least_area_enlargement(nodes: List[RStarTreeNode], entry: BoundaryBox) -> RStarTreeNode:
+    areas = [node.area() for node in nodes]
+    enlargements = [union_area(node, entry) - areas[i] for i, node in enumerate(nodes)]
+    min_enlargement = min(enlargements)
+    indices = [i for i, v in enumerate(enlargements) if math.isclose(v, min_enlargement, rel_tol=EPSILON)]
+
+    if len(indices) == 1:
+        return nodes[indices[0]]
+
+    # При равном увеличении - узел с меньшей площадью
+    return nodes[min(indices, key=lambda i: areas[i])]
+
+
+def overlap(rect: BoundaryBox, rects: List[BoundaryBox]) -> float:
+    return sum(get_intersection_area(rect, r) for r in rects)
+
+
+def get_intersection_area(rect1: BoundaryBox, rect2: BoundaryBox) -> float:
+    x_overlap = max(0.0, min(rect1.x_max, rect2.x_max) - max(rect1.x_min, rect2.x_min))
+    y_overlap = max(0.0, min(rect1.y_max, rect2.y_max) - max(rect1.y_min, rect2.y_min))
+    return x_overlap * y_overlap
+
+
+def plot_r_star_tree(tree: RStarTree):
+    plot_r_star_node_recursive(tree.root, 0)
+
+
+def plot_get_color(depth: int):
+    return 'white' if depth == 0 else 'black'
+
+
+def plot_r_star_node_recursive(node: RStarTreeNode, depth: int):
+    add_to_plot_geometry(shapely.box(node.x_min, node.y_min, node.x_max, node.y_max), plot_get_color(depth))
+
+    if node.is_leaf:
+        return
+
+    for child in node.children:
+        plot_r_star_node_recursive(child, depth + 1)
+
+
+def build_r_star_tree(entries: List[Entry], max_node_capacity):
+    tree = RStarTree(max_node_capacity)
+
+    for entry in entries:
+        tree.insert(entry)
+
+    return tree
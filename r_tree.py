@@ -1,16 +1,25 @@
 from __future__ import annotations
 
+import math
 import random
-from typing import List, Union
+from typing import List, Union, Iterator, Tuple
 
+import numpy as np
 import shapely
 from shapely import Geometry, Point
 
-from common import BoundaryBox, union, intersection, geometry_to_box, Entry, get_nearest, distance, contains
+from common import BoundaryBox, union, geometry_to_box, Entry, enlargement, union_area, nearest_iter, \
+    refine, collect_candidates, iter_candidates, SpatialIndex
+from hilbert import hilbert_encode_in_box
 from shapely_plot import add_to_plot_geometry
 
+# Разрешение сетки центров при сортировке по кривой Гильберта
+HILBERT_BITS = 16
+
 
 class RTreeNode(BoundaryBox):
+    __slots__ = ('children', 'is_leaf')
+
     def __init__(self, children: List[RTreeNode | Entry] | None = None, is_leaf: bool = False):
         mbr = union(*children)
         super().__init__(mbr.x_min, mbr.y_min, mbr.x_max, mbr.y_max)
@@ -20,13 +29,14 @@ class RTreeNode(BoundaryBox):
     def add_child(self, node: RTreeNode | Entry):
         self.children.append(node)
 
+    def expand(self):
+        return (self.children, []) if self.is_leaf else ([], self.children)
+
     def updateMBR(self, box: BoundaryBox):
-        mbr = union(self, box)
-        self.x_min, self.y_min, self.x_max, self.y_max = mbr.x_min, mbr.y_min, mbr.x_max, mbr.y_max
-        self.boundary = shapely.box(self.x_min, self.y_min, self.x_max, self.y_max)
+        self.extend(box)
 
 
-class RTree(object):
+class RTree(SpatialIndex):
     def __init__(self, max_node_capacity=4, algorithm: 'linear' | 'quadratic' = 'linear'):
         self.root = RTreeNode([], True)
         self.max_node_capacity = max_node_capacity
@@ -39,50 +49,44 @@ class RTree(object):
             node_1, node_2 = self.split_node(self.root, self.algorithm)
             self.root = RTreeNode([node_1, node_2])
 
-    def search(self, search: Geometry):
-        search_box = geometry_to_box(search)
+    def bulk_load(self, entries: List[Entry], method: str = 'str'):
+        # Уровни упаковываются снизу вверх, каждый узел заполнен полностью:
+        # str - Sort-Tile-Recursive на каждом уровне,
+        # hilbert - листья по кривой Гильберта центров, верхние уровни - подряд в том же порядке
+        if method == 'hilbert':
+            nodes = pack_in_order(hilbert_sort(entries), self.max_node_capacity, True)
 
-        if contains(self.root, search_box):
-            candidates = self.internal_search(self.root, search_box)
-            shapes = list(map(lambda e: e.shape, candidates))
-            return list(filter(lambda s: s.intersects(search), shapes))
+            while len(nodes) > 1:
+                nodes = pack_in_order(nodes, self.max_node_capacity, False)
         else:
-            return None
+            nodes = str_pack(entries, self.max_node_capacity, True)
 
-    def find_nearest_neighbor(self, point: Point):
-        nearest, _ = self.find_nearest_neighbor_internal(self.root, point, None, float('inf'))
-        return nearest.shape
-
-    def find_nearest_neighbor_internal(self, node: RTreeNode, point: Point, nearest: Entry | None, min_distance):
-        if node.is_leaf:
-            candidate, candidate_distance = get_nearest(node.children, point)
+            while len(nodes) > 1:
+                nodes = str_pack(nodes, self.max_node_capacity, False)
 
-            if candidate_distance < min_distance:
-                nearest = candidate
-                min_distance = candidate_distance
+        self.root = nodes[0] if len(nodes) > 0 else RTreeNode([], True)
 
-            return nearest, min_distance
+        return self
 
-        nodes = list(map(lambda n: [n, distance(n, point)], node.children))
-        nodes = sorted(nodes, key=lambda n: n[1])
+    def search(self, search: Geometry):
+        search_box = geometry_to_box(search)
 
-        for node in nodes:
-            if node[1] < min_distance:
-                nearest, min_distance = self.find_nearest_neighbor_internal(node[0], point, nearest, min_distance)
+        # Корень - MBR данных, а не область индекса: запрос шире данных (окно просмотра) не отбрасывается,
+        # лишнее отсекает обход
+        return refine(collect_candidates(self.root, search_box), search)
 
-        return nearest, min_distance
+    def find_nearest_neighbor(self, point: Point):
+        nearest = next(self.nearest_entries(point), None)
+        return nearest[0].shape if nearest is not None else None
 
-    def internal_search(self, node: RTreeNode, search_box: BoundaryBox) -> List[Entry]:
-        search_result: List[Entry] | None = []
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        return nearest_iter(self.root, point, max_distance)
 
-        if node.is_leaf:
-            search_result = list(filter(lambda n: intersection(n, search_box), node.children))
-        else:
-            for child in node.children:
-                if intersection(child, search_box):
-                    search_result.extend(self.internal_search(child, search_box))
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return collect_candidates(self.root, search_box)
 
-        return search_result
+    def iter_candidates(self, search_box: BoundaryBox) -> Iterator[Entry]:
+        return iter_candidates(self.root, search_box)
 
     def internal_insert(self, node: RTreeNode, entry: Entry) -> [RTreeNode]:
         if node.is_leaf:
@@ -92,7 +96,7 @@ class RTree(object):
             selected_node = None
 
             for child in node.children:
-                increase = union(child, entry).area() - child.area()
+                increase = enlargement(child, entry)
                 if increase < min_increase:
                     min_increase = increase
                     selected_node = child
@@ -127,8 +131,8 @@ class RTree(object):
             idx = next_linear(node.children) if algorithm == 'linear' else next_quadratic(node.children, node_1, node_2)
             child = node.children.pop(idx)
 
-            increase_1 = union(node_1, child).area() - node_1.area()
-            increase_2 = union(node_2, child).area() - node_2.area()
+            increase_1 = enlargement(node_1, child)
+            increase_2 = enlargement(node_2, child)
 
             if len(node_1.children) < self.max_node_capacity and (
                     increase_1 < increase_2 or increase_1 == increase_2 and node_1.area() < node_2.area()
@@ -147,6 +151,52 @@ class RTree(object):
         self.split_node(None)
 
 
+def str_pack(items: List[RTreeNode | Entry], capacity: int, is_leaf: bool) -> List[RTreeNode]:
+    n = len(items)
+
+    if n == 0:
+        return []
+
+    centers_x = np.fromiter(((item.x_min + item.x_max) / 2 for item in items), dtype=np.float64, count=n)
+    centers_y = np.fromiter(((item.y_min + item.y_max) / 2 for item in items), dtype=np.float64, count=n)
+
+    # Делим на вертикальные полосы по S * capacity элементов, внутри полосы сортируем по y
+    leaf_count = math.ceil(n / capacity)
+    slice_size = math.ceil(math.sqrt(leaf_count)) * capacity
+
+    order_x = np.argsort(centers_x, kind='stable')
+
+    nodes = []
+
+    for start in range(0, n, slice_size):
+        slab = order_x[start:start + slice_size]
+        slab = slab[np.argsort(centers_y[slab], kind='stable')]
+
+        for node_start in range(0, len(slab), capacity):
+            nodes.append(RTreeNode([items[i] for i in slab[node_start:node_start + capacity]], is_leaf))
+
+    return nodes
+
+
+def hilbert_sort(items: List[RTreeNode | Entry]) -> List[RTreeNode | Entry]:
+    n = len(items)
+
+    if n == 0:
+        return []
+
+    centers_x = np.fromiter(((item.x_min + item.x_max) / 2 for item in items), dtype=np.float64, count=n)
+    centers_y = np.fromiter(((item.y_min + item.y_max) / 2 for item in items), dtype=np.float64, count=n)
+
+    extent = BoundaryBox(centers_x.min(), centers_y.min(), centers_x.max(), centers_y.max())
+    codes = hilbert_encode_in_box(centers_x, centers_y, extent, HILBERT_BITS)
+
+    return [items[i] for i in np.argsort(codes, kind='stable')]
+
+
+def pack_in_order(items: List[RTreeNode | Entry], capacity: int, is_leaf: bool) -> List[RTreeNode]:
+    return [RTreeNode(items[start:start + capacity], is_leaf) for start in range(0, len(items), capacity)]
+
+
 class DimStats:
     def __init__(self):
         self.minLow = float('inf')
@@ -209,8 +259,7 @@ def quadratic(entries: List[BoundaryBox]):
     if len(entries) > 2:
         for i in range(len(entries)):
             for j in range(1, len(entries)):
-                combined = union(entries[i], entries[j])
-                diff = combined.area() - entries[i].area() - entries[j].area()
+                diff = union_area(entries[i], entries[j]) - entries[i].area() - entries[j].area()
 
                 if diff > max_diff:
                     max_diff = diff
@@ -243,8 +292,8 @@ def next_quadratic(entries: List[BoundaryBox], rect1: BoundaryBox, rect2: Bounda
     max_preference_diff = float('-inf')
 
     for i, e in enumerate(entries):
-        pref1 = union(rect1, e).area() - rect1.area()
-        pref2 = union(rect2, e).area() - rect2.area()
+        pref1 = enlargement(rect1, e)
+        pref2 = enlargement(rect2, e)
         preference_diff = abs(pref1 - pref2)
 
         if max_preference_diff <= preference_diff:
@@ -293,6 +342,14 @@ def build_r_tree(entries: List[Geometry], max_node_capacity, algorithm: TypeAlgo
     return tree
 
 
+def build_r_tree_str(entries: List[Entry], max_node_capacity):
+    return RTree(max_node_capacity).bulk_load(entries)
+
+
+def build_r_tree_hilbert(entries: List[Entry], max_node_capacity):
+    return RTree(max_node_capacity).bulk_load(entries, 'hilbert')
+
+
 def distance_func(shape: Geometry, point: Point):
     return shapely.distance(point, shape)
 
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from common import concat_ranges
+
+# Сколько пар-кандидатов по оси x проверяется по оси y за один векторный шаг (ограничивает память)
+SWEEP_CHUNK = 1 << 20
+
+
+def _as_boxes(boxes) -> np.ndarray:
+    # (n, 4): x_min, y_min, x_max, y_max
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def _chunks(starts: np.ndarray, ends: np.ndarray) -> Iterator[slice]:
+    # Отрезки подряд идущих строк, у которых в сумме не больше SWEEP_CHUNK кандидатов (но хотя бы одна строка)
+    totals = np.cumsum(ends - starts)
+    position = 0
+
+    while position < len(starts):
+        base = totals[position - 1] if position > 0 else 0
+        end = max(int(np.searchsorted(totals, base + SWEEP_CHUNK, 'right')), position + 1)
+        yield slice(position, end)
+        position = end
+
+
+def _sweep(sorted_a: np.ndarray, order_a: np.ndarray, sorted_b: np.ndarray, order_b: np.ndarray,
+           starts: np.ndarray, ends: np.ndarray) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    # Для каждой строки a - кандидаты b[starts:ends] (уже пересекаются по x), остается проверить ось y
+    for rows in _chunks(starts, ends):
+        counts = ends[rows] - starts[rows]
+        a = np.repeat(np.arange(rows.start, rows.stop), counts)
+        b = concat_ranges(starts[rows], ends[rows])
+
+        mask = (sorted_a[a, 1] <= sorted_b[b, 3]) & (sorted_a[a, 3] >= sorted_b[b, 1])
+
+        if mask.any():
+            yield order_a[a[mask]], order_b[b[mask]]
+
+
+def iter_overlapping_pairs(boxes_a, boxes_b) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Пары (i, j) пересекающихся прямоугольников boxes_a[i] и boxes_b[j], пачками.
+    Sort-and-sweep по оси x: оба массива сортируются по x_min, для каждого прямоугольника двоичным поиском
+    берутся прямоугольники другого массива, начавшиеся внутри его отрезка по x. Пара находится ровно один раз:
+    со стороны того, кто начался раньше (при равных x_min - со стороны a). O((n + k) log n).
+    """
+    boxes_a, boxes_b = _as_boxes(boxes_a), _as_boxes(boxes_b)
+
+    if len(boxes_a) == 0 or len(boxes_b) == 0:
+        return
+
+    order_a = np.argsort(boxes_a[:, 0], kind='stable')
+    order_b = np.argsort(boxes_b[:, 0], kind='stable')
+    sorted_a, sorted_b = boxes_a[order_a], boxes_b[order_b]
+
+    # a начался не позже b: x_min(b) в [x_min(a), x_max(a)]
+    starts = np.searchsorted(sorted_b[:, 0], sorted_a[:, 0], 'left')
+    ends = np.searchsorted(sorted_b[:, 0], sorted_a[:, 2], 'right')
+    yield from _sweep(sorted_a, order_a, sorted_b, order_b, starts, ends)
+
+    # b начался строго раньше a: x_min(a) в (x_min(b), x_max(b)]
+    starts = np.searchsorted(sorted_a[:, 0], sorted_b[:, 0], 'right')
+    ends = np.searchsorted(sorted_a[:, 0], sorted_b[:, 2], 'right')
+
+    for j, i in _sweep(sorted_b, order_b, sorted_a, order_a, starts, ends):
+        yield i, j
+
+
+def iter_self_overlapping_pairs(boxes) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Пары (i, j) пересекающихся прямоугольников одного массива, i != j, каждая пара один раз, пачками.
+    """
+    boxes = _as_boxes(boxes)
+
+    if len(boxes) == 0:
+        return
+
+    order = np.argsort(boxes[:, 0], kind='stable')
+    sorted_boxes = boxes[order]
+
+    # Кандидаты позиции p - позиции после нее, начавшиеся не правее ее x_max
+    starts = np.arange(1, len(boxes) + 1)
+    ends = np.maximum(np.searchsorted(sorted_boxes[:, 0], sorted_boxes[:, 2], 'right'), starts)
+
+    yield from _sweep(sorted_boxes, order, sorted_boxes, order, starts, ends)
+
+
+def _collect(batches: Iterator[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    batches = list(batches)
+
+    if len(batches) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    return np.concatenate([i for i, _ in batches]), np.concatenate([j for _, j in batches])
+
+
+def overlapping_pairs(boxes_a, boxes_b) -> Tuple[np.ndarray, np.ndarray]:
+    return _collect(iter_overlapping_pairs(boxes_a, boxes_b))
+
+
+def self_overlapping_pairs(boxes) -> Tuple[np.ndarray, np.ndarray]:
+    return _collect(iter_self_overlapping_pairs(boxes))
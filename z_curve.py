@@ -1,43 +1,44 @@
+import numpy as np
+
+
 def z_encode(x, y):
-    x = (x | x << 16) & 0x0000FFFF
-    x = (x | x << 8) & 0x00FF00FF
-    x = (x | x << 4) & 0x0F0F0F0F
-    x = (x | x << 2) & 0x33333333
-    x = (x | x << 1) & 0x55555555
-
-    y = (y | y << 16) & 0x0000FFFF
-    y = (y | y << 8) & 0x00FF00FF
-    y = (y | y << 4) & 0x0F0F0F0F
-    y = (y | y << 2) & 0x33333333
-    y = (y | y << 1) & 0x55555555
+    # 32 бита на ось, код - до 64 бит
+    x = (x | x << 16) & 0x0000FFFF0000FFFF
+    x = (x | x << 8) & 0x00FF00FF00FF00FF
+    x = (x | x << 4) & 0x0F0F0F0F0F0F0F0F
+    x = (x | x << 2) & 0x3333333333333333
+    x = (x | x << 1) & 0x5555555555555555
+
+    y = (y | y << 16) & 0x0000FFFF0000FFFF
+    y = (y | y << 8) & 0x00FF00FF00FF00FF
+    y = (y | y << 4) & 0x0F0F0F0F0F0F0F0F
+    y = (y | y << 2) & 0x3333333333333333
+    y = (y | y << 1) & 0x5555555555555555
 
     return x | (y << 1)
 
 
 def z_decode(morton):
-    x = morton & 0x55555555
-    x = (x ^ (x >> 1)) & 0x33333333
-    x = (x ^ (x >> 2)) & 0x0F0F0F0F
-    x = (x ^ (x >> 4)) & 0x00FF00FF
-    x = (x ^ (x >> 8)) & 0x0000FFFF
-
-    y = (morton >> 1) & 0x55555555
-    y = (y ^ (y >> 1)) & 0x33333333
-    y = (y ^ (y >> 2)) & 0x0F0F0F0F
-    y = (y ^ (y >> 4)) & 0x00FF00FF
-    y = (y ^ (y >> 8)) & 0x0000FFFF
+    x = morton & 0x5555555555555555
+    x = (x ^ (x >> 1)) & 0x3333333333333333
+    x = (x ^ (x >> 2)) & 0x0F0F0F0F0F0F0F0F
+    x = (x ^ (x >> 4)) & 0x00FF00FF00FF00FF
+    x = (x ^ (x >> 8)) & 0x0000FFFF0000FFFF
+    x = (x ^ (x >> 16)) & 0x00000000FFFFFFFF
+
+    y = (morton >> 1) & 0x5555555555555555
+    y = (y ^ (y >> 1)) & 0x3333333333333333
+    y = (y ^ (y >> 2)) & 0x0F0F0F0F0F0F0F0F
+    y = (y ^ (y >> 4)) & 0x00FF00FF00FF00FF
+    y = (y ^ (y >> 8)) & 0x0000FFFF0000FFFF
+    y = (y ^ (y >> 16)) & 0x00000000FFFFFFFF
 
     return (x, y)
 
 
 def cmp_zorder(za, zb):
-    ax, ay = z_decode(za)
-    bx, by = z_decode(zb)
-
-    a = [ax, ay]
-    b = [bx, by]
-
-    return _cmp_zorder(a, b)
+    # Числовой порядок кодов и есть Z-порядок: декодировать не нужно
+    return (za > zb) - (za < zb)
 
 
 def _cmp_zorder(a, b):
@@ -53,3 +54,75 @@ def _cmp_zorder(a, b):
 
 def less_msb(x, y):
     return x < y and x < (x ^ y)
+
+
+# Векторные версии для массивов NumPy: 32 бита на ось, код - uint64
+
+
+def _spread_bits(v: np.ndarray) -> np.ndarray:
+    v = v.astype(np.uint64) & np.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def _compact_bits(v: np.ndarray) -> np.ndarray:
+    v = v & np.uint64(0x5555555555555555)
+    v = (v ^ (v >> np.uint64(1))) & np.uint64(0x3333333333333333)
+    v = (v ^ (v >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v ^ (v >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v ^ (v >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v ^ (v >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+    return v
+
+
+def z_encode_many(xs, ys) -> np.ndarray:
+    return _spread_bits(np.asarray(xs)) | (_spread_bits(np.asarray(ys)) << np.uint64(1))
+
+
+def z_decode_many(codes) -> (np.ndarray, np.ndarray):
+    codes = np.asarray(codes, dtype=np.uint64)
+    return _compact_bits(codes), _compact_bits(codes >> np.uint64(1))
+
+
+def cmp_zorder_many(za, zb) -> np.ndarray:
+    # -1, 0, 1 поэлементно, без ветвлений и без декодирования
+    za, zb = np.asarray(za, dtype=np.uint64), np.asarray(zb, dtype=np.uint64)
+    return (za > zb).astype(np.int8) - (za < zb).astype(np.int8)
+
+
+def quantize(values, low: float, high: float, bits: int = 32) -> np.ndarray:
+    # Номер ячейки 0..2^bits-1 на отрезке [low, high]; монотонно по значению,
+    # поэтому прямоугольник координат переходит в прямоугольник ячеек
+    cells = 1 << bits
+    scale = cells / (high - low) if high > low else 0.0
+    return np.clip(np.floor((np.asarray(values, dtype=np.float64) - low) * scale), 0, cells - 1).astype(np.uint64)
+
+
+def z_encode_in_box(xs, ys, box, bits: int = 32) -> np.ndarray:
+    """
+    Z-коды точек с вещественными координатами: координаты квантуются на сетку 2^bits x 2^bits
+    внутри box (BoundaryBox или любой объект с x_min, y_min, x_max, y_max).
+    """
+    return z_encode_many(quantize(xs, box.x_min, box.x_max, bits), quantize(ys, box.y_min, box.y_max, bits))
+
+
+def bit_length_many(values) -> np.ndarray:
+    # int.bit_length поэлементно для uint64: старшая и младшая половины по отдельности, чтобы float64 был точным
+    values = np.asarray(values, dtype=np.uint64)
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1]).astype(np.int64)
+
+
+def z_common_level(za, zb, bits: int = 32) -> np.ndarray:
+    """
+    Длина общего префикса Z-кодов в уровнях (парах бит): самый глубокий уровень сетки 2^level x 2^level,
+    на котором обе точки лежат в одной ячейке. 0 - общей ячейки нет, кроме всей области; bits - коды совпадают.
+    """
+    differ = bit_length_many(np.asarray(za, dtype=np.uint64) ^ np.asarray(zb, dtype=np.uint64))
+    return bits - (differ + 1) // 2
@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import json
+import math
+import os
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import shapely
+from shapely import Geometry, Polygon, Point
+
+import z_curve
+from common import BoundaryBox, Entry, geometry_to_box, concat_ranges, refine_mask, iter_refine_rows, \
+    iter_nearest_rows, SpatialIndex
+from entry_store import EntryStore
+
+# Наибольшая разрядность квантования координат центров по каждой оси (код - 2 * ZORDER_BITS бит)
+ZORDER_BITS = 32
+
+# Сколько кодов подряд проверяется за один векторный шаг перед прыжком BIGMIN
+SCAN_CHUNK = 64
+
+# Биты оси x стоят на четных позициях кода, биты оси y - на нечетных
+_DIMENSION_MASKS = [0x5555555555555555, 0xAAAAAAAAAAAAAAAA]
+
+
+def big_min(z: int, z_min: int, z_max: int) -> int | None:
+    """
+    BIGMIN (Tropf, Herzog): наименьший код больше z, точка которого лежит в прямоугольнике [z_min, z_max].
+    z должен быть между z_min и z_max и лежать вне прямоугольника. None - таких кодов нет.
+    """
+    bigmin = None
+
+    # Старшие биты, в которых z_min и z_max совпадают, совпадают и у z - их можно не разбирать
+    for bit_pos in range((z_min ^ z_max).bit_length() - 1, -1, -1):
+        mask = 1 << bit_pos
+
+        # Биты той же оси на позициях не старше bit_pos
+        below = _DIMENSION_MASKS[bit_pos & 1] & ((mask << 1) - 1)
+
+        z_bit, z_min_bit, z_max_bit = z & mask, z_min & mask, z_max & mask
+
+        if not z_bit:
+            if not z_min_bit and z_max_bit:
+                bigmin = (z_min & ~below) | mask
+                z_max = (z_max & ~below) | (below & ~mask)
+            elif z_min_bit:
+                if z_max_bit:
+                    return z_min
+                else:
+                    raise ValueError("illegal BIGMIN state")
+        else:
+            if not z_min_bit:
+                if z_max_bit:
+                    z_min = (z_min & ~below) | mask
+                else:
+                    return bigmin
+            elif not z_max_bit:
+                raise ValueError("illegal BIGMIN state")
+
+    return bigmin
+
+
+class ZOrderIndex(BoundaryBox, SpatialIndex):
+    """
+    Одномерный индекс: записи отсортированы по Z-коду квантованного центра MBR (codes, rows - строки EntryStore).
+    Запрос по прямоугольнику расширяется на максимальную полуширину/полувысоту записей,
+    после чего центры всех подходящих записей лежат в расширенном прямоугольнике.
+    Отрезок кодов [z_min, z_max] просматривается кусками, участки вне прямоугольника перепрыгиваются через BIGMIN.
+    Массивы хранятся как есть, поэтому индекс легко сохранить на диск или в таблицу с B-деревом по коду.
+    """
+
+    def __init__(self, boundary: Polygon, store: EntryStore, codes: np.ndarray, rows: np.ndarray,
+                 half_width: float, half_height: float, bits: int = ZORDER_BITS):
+        x_min, y_min, x_max, y_max = boundary.bounds
+        super().__init__(x_min, y_min, x_max, y_max)
+
+        self.store = store
+        self.codes = codes
+        self.rows = rows
+
+        self.half_width = half_width
+        self.half_height = half_height
+
+        self.bits = bits
+
+    @staticmethod
+    def build(boundary: Polygon, store: EntryStore, bits: int | None = None) -> ZOrderIndex:
+        x_min, y_min, x_max, y_max = boundary.bounds
+
+        # По умолчанию ячеек примерно столько же, сколько записей: мельче - больше прыжков BIGMIN на запрос
+        if bits is None:
+            bits = min(max(1, math.ceil(math.log2(max(len(store), 1)) / 2)), ZORDER_BITS)
+
+        centers_x = (store.x_min + store.x_max) / 2
+        centers_y = (store.y_min + store.y_max) / 2
+
+        codes = z_curve.z_encode_in_box(centers_x, centers_y, BoundaryBox(x_min, y_min, x_max, y_max), bits)
+
+        order = np.argsort(codes, kind='stable')
+
+        half_width = float(((store.x_max - store.x_min) / 2).max()) if len(store) > 0 else 0.0
+        half_height = float(((store.y_max - store.y_min) / 2).max()) if len(store) > 0 else 0.0
+
+        row_dtype = np.int32 if len(store) < 2 ** 31 else np.int64
+
+        return ZOrderIndex(boundary, store, codes[order], order.astype(row_dtype), half_width, half_height, bits)
+
+    @staticmethod
+    def from_entries(boundary: Polygon, entries: List[Entry], bits: int | None = None) -> ZOrderIndex:
+        return ZOrderIndex.build(boundary, EntryStore.from_entries(entries), bits)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+        self.store.save(os.path.join(path, 'store'))
+
+        np.save(os.path.join(path, 'codes.npy'), self.codes)
+        np.save(os.path.join(path, 'rows.npy'), self.rows)
+
+        with open(os.path.join(path, 'z_order.json'), 'w') as f:
+            json.dump({'bounds': [self.x_min, self.y_min, self.x_max, self.y_max], 'bits': self.bits,
+                       'half_width': self.half_width, 'half_height': self.half_height}, f)
+
+    @staticmethod
+    def open(path: str, mmap_mode: str | None = 'r') -> ZOrderIndex:
+        with open(os.path.join(path, 'z_order.json'), 'r') as f:
+            info = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        return ZOrderIndex(shapely.box(*info['bounds']), EntryStore.open(os.path.join(path, 'store'), mmap_mode),
+                           load('codes'), load('rows'), info['half_width'], info['half_height'], info['bits'])
+
+    def code_ranges(self, search_box: BoundaryBox) -> (np.ndarray, np.ndarray):
+        """
+        Отрезки позиций [start, end) в codes, коды которых лежат в расширенном прямоугольнике запроса.
+        """
+        qx_min = int(z_curve.quantize(search_box.x_min - self.half_width, self.x_min, self.x_max, self.bits))
+        qy_min = int(z_curve.quantize(search_box.y_min - self.half_height, self.y_min, self.y_max, self.bits))
+        qx_max = int(z_curve.quantize(search_box.x_max + self.half_width, self.x_min, self.x_max, self.bits))
+        qy_max = int(z_curve.quantize(search_box.y_max + self.half_height, self.y_min, self.y_max, self.bits))
+
+        z_min = z_curve.z_encode_many(qx_min, qy_min)
+        z_max = z_curve.z_encode_many(qx_max, qy_max)
+
+        # Сравнение по одной оси без декодирования: биты оси под маской упорядочены так же, как координата
+        x_mask, y_mask = np.uint64(_DIMENSION_MASKS[0]), np.uint64(_DIMENSION_MASKS[1])
+        zx_min, zx_max = z_min & x_mask, z_max & x_mask
+        zy_min, zy_max = z_min & y_mask, z_max & y_mask
+
+        codes = self.codes
+
+        position = int(np.searchsorted(codes, z_min, 'left'))
+        end = int(np.searchsorted(codes, z_max, 'right'))
+
+        starts, ends = [], []
+
+        while position < end:
+            chunk = codes[position:min(position + SCAN_CHUNK, end)]
+            xs, ys = chunk & x_mask, chunk & y_mask
+            inside = (xs >= zx_min) & (xs <= zx_max) & (ys >= zy_min) & (ys <= zy_max)
+
+            # Длина начального участка внутри прямоугольника
+            run = len(chunk) if inside.all() else int(np.argmin(inside))
+
+            if run > 0:
+                if len(ends) > 0 and ends[-1] == position:
+                    ends[-1] = position + run
+                else:
+                    starts.append(position)
+                    ends.append(position + run)
+
+            if run == len(chunk):
+                position += run
+                continue
+
+            # Первый код вне прямоугольника: прыжок на следующий код, который снова внутри
+            next_code = big_min(int(chunk[run]), int(z_min), int(z_max))
+
+            if next_code is None:
+                break
+
+            position = int(np.searchsorted(codes, np.uint64(next_code), 'left'))
+
+        return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+    def search_rows(self, search_box: BoundaryBox) -> np.ndarray:
+        starts, ends = self.code_ranges(search_box)
+        rows = self.rows[concat_ranges(starts, ends)]
+
+        store = self.store
+        mask = ((store.x_min[rows] <= search_box.x_max) & (store.x_max[rows] >= search_box.x_min) &
+                (store.y_min[rows] <= search_box.y_max) & (store.y_max[rows] >= search_box.y_min))
+
+        return rows[mask]
+
+    def search_ids(self, search: Geometry) -> np.ndarray:
+        rows = self.search_rows(geometry_to_box(search))
+        return self.store.ids[rows[refine_mask(self.store.geometries(rows), self.store.bounds(rows), search)]]
+
+    def search(self, search: Geometry):
+        rows = self.search_rows(geometry_to_box(search))
+        shapes = self.store.geometries(rows)
+        return list(shapes[refine_mask(shapes, self.store.bounds(rows), search)])
+
+    def iter_refined(self, search_box: BoundaryBox, search: Geometry, limit: int | None) -> Iterator[Geometry]:
+        return iter_refine_rows(self.store, self.search_rows(search_box), search, limit)
+
+    def search_candidates(self, search_box: BoundaryBox) -> List[Entry]:
+        return list(self.store.entries(self.search_rows(search_box)))
+
+    def find_nearest_neighbor(self, point: Point):
+        nearest = next(self.nearest_entries(point), None)
+        return nearest[0].shape if nearest is not None else None
+
+    def nearest_entries(self, point: Point, max_distance: float | None = None) -> Iterator[Tuple[Entry, float]]:
+        # Z-порядок не дает границы расстояния - строки перебираются по расстоянию до MBR из массивов хранилища
+        return iter_nearest_rows(self.store, point, max_distance)
+